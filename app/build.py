@@ -0,0 +1,783 @@
+# Jiggy index build
+# Copyright (C) 2022 William S. Kish
+
+
+from time import time, perf_counter_ns
+import os
+from sqlmodel import Session, select, delete, update, func
+import hnswlib
+import psutil
+import numpy as np
+from optimizer import optimize_hnswlib_params, ivfpq_params
+from s3 import bucket
+from file_cache import file_cache
+from changelog import CHANGE_LOG_MARGIN, prune_vector_changes, vector_changes
+import s3_bucket as S3
+import tempfile
+import threading
+import hashlib
+import subprocess
+import vector_codec
+from flat_index import FlatIndex, exact_knn, recall, hold_out
+from pq_index import IVFPQIndex, VECTORS_SUFFIX
+from zstd_codec import CompressedReader, COMPRESSED_SUFFIX
+
+from db import engine
+
+from models import *
+   
+CPU_COUNT = psutil.cpu_count()
+
+# hnswlib threads per build; set lower when running several build workers per node
+BUILD_THREADS = int(os.environ.get('JIGGY_BUILD_THREADS', max(1, CPU_COUNT//2)))
+
+# local scratch space for the pipes index files are saved through
+SCRATCH_DIR = os.environ.get('JIGGY_SCRATCH_DIR', tempfile.gettempdir())
+
+
+# Get CPU details
+try:
+    # MACOS get CPU
+    CPU_INFO = str(subprocess.check_output(["sysctl", "-n", "machdep.cpu.brand_string"]).rstrip())
+except:
+    # linux get CPU
+    o = str(subprocess.check_output(['cat', '/proc/cpuinfo']))
+    m = [x for x in o.split("\\n") if "model name" in x]
+    CPU_INFO = m[0].split(":")[-1].lstrip()
+    
+print("CPU_INFO", CPU_INFO)
+
+
+
+###
+##  Index
+###
+TEST_QUERIES = 1000          # queries sampled from the collection when there is no uploaded test query set
+TEST_K = 10
+TEST_TARGET_RECALL = 0.99    # recall targeted by the ef_search search when the index has no target_recall
+TEST_LATENCY_QUERIES = 2000  # single queries timed at the selected ef_search for the latency percentiles
+TEST_PROBE_LATENCY_QUERIES = 200    # single queries timed at most at each other ef probed by the ef_search search
+TEST_PROBE_LATENCY_SECONDS = 10     # time limit of the single queries timed at each other ef probed
+# batch query threads measured, up to the threads a build is allotted as other builds share the node
+TEST_THREAD_COUNTS = sorted({1 << i for i in range(BUILD_THREADS.bit_length())} | {BUILD_THREADS})
+
+
+def _test_queries(collection, vector_list):
+    """
+    return (queries, self_rows): the collection's uploaded test queries, or queries sampled from the
+    vectors under test.  self_rows holds the row of each sampled query within vector_list, which is held
+    out of its own results, or is None for uploaded queries.
+    """
+    if collection.test_queries_objkey:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, "queries.npy")
+            try:
+                bucket.download_file(collection.test_queries_objkey, filename)
+                queries = np.load(filename)
+            except Exception as e:
+                print("unable to load test queries:", e)
+                queries = None
+        if queries is not None and queries.ndim == 2 and queries.shape[1] == vector_list.shape[1] and len(queries):
+            return queries.astype(np.float32), None
+    self_rows = np.random.choice(len(vector_list), min(TEST_QUERIES, len(vector_list)), replace=False)
+    return vector_list[self_rows], self_rows
+
+
+def _search_ef(measure, low, high, target):
+    """
+    return the smallest ef in [low, high] for which measure(ef) reaches the target recall, assuming recall
+    increases with ef: double ef until the target is reached, then binary search the last doubling.
+    returns high if the target is never reached.
+    """
+    failing = low - 1
+    ef = low
+    while measure(ef) < target:
+        if ef >= high:
+            return high
+        failing = ef
+        ef = min(2 * ef, high)
+    passing = ef
+    while passing - failing > 1:
+        mid = (passing + failing) // 2
+        if measure(mid) >= target:
+            passing = mid
+        else:
+            failing = mid
+    return passing
+
+
+def _query_latencies(hnsw_index, query_data, k, count=TEST_LATENCY_QUERIES, max_seconds=None):
+    """
+    return the latency in seconds of each of count single vector queries, cycling through query_data,
+    stopping early once max_seconds have been spent if specified
+    """
+    hnsw_index.set_num_threads(1)
+    hnsw_index.knn_query(query_data[:1], k)   # warm up
+    latencies = np.empty(count)
+    deadline = None if max_seconds is None else perf_counter_ns() + max_seconds * 1e9
+    for i in range(count):
+        query = query_data[i % len(query_data)][None, :]
+        t0 = perf_counter_ns()
+        hnsw_index.knn_query(query, k)
+        latencies[i] = perf_counter_ns() - t0
+        if deadline is not None and latencies[i] + t0 > deadline:
+            return latencies[:i+1] / 1e9
+    return latencies / 1e9
+
+
+def _batch_qps(hnsw_index, query_data, k):
+    """
+    return the throughput of querying all of query_data as one batch, keyed by the number of query threads
+    """
+    batch_qps = {}
+    for threads in TEST_THREAD_COUNTS:
+        hnsw_index.set_num_threads(threads)
+        t0 = perf_counter_ns()
+        hnsw_index.knn_query(query_data, k)
+        batch_qps[str(threads)] = len(query_data) / max(perf_counter_ns() - t0, 1) * 1e9
+    return batch_qps
+
+
+def _test_index(index, collection, vector_list, vids, hnsw_index, shard=None, ef_range=None):
+    """
+    measure the recall and qps of the index over a range of ef values, recording an IndexTest for each,
+    and return the smallest ef meeting the index's target recall (or TEST_TARGET_RECALL).
+    ef_range is the (lowest, highest) ef to search, by default from k to the larger of the index size and ef_construction;
+    for ivfpq indexes the ef is the nprobe.
+    """
+    print("test index")
+    NUMVECTOR = len(vector_list)
+    top_k = min(TEST_K, NUMVECTOR - 1) if NUMVECTOR > 1 else 1
+    target = index.target_recall or TEST_TARGET_RECALL
+
+    query_data, self_rows = _test_queries(collection, vector_list)
+    if NUMVECTOR < 2:
+        self_rows = None    # nothing to hold a single vector out against
+    # sampled queries are in the index, so fetch one extra neighbor and hold the query itself out
+    fetch_k = top_k if self_rows is None else top_k + 1
+
+    t0 = time()
+    truth_idx, _ = exact_knn(vector_list, query_data, fetch_k, hnsw_index.space)
+    labels_bf = vids[truth_idx]
+    if self_rows is not None:
+        labels_bf = hold_out(labels_bf, vids[self_rows], top_k)
+    print("exact knn of %d queries in %.1f seconds" % (len(query_data), time()-t0))
+
+    results = {}    # ef -> (recall, IndexTest id)
+    def measure(ef):
+        if ef in results:
+            return results[ef][0]
+        hnsw_index.set_ef(ef)
+        hnsw_index.set_num_threads(BUILD_THREADS)
+        labels_hnsw, distances_hnsw = hnsw_index.knn_query(query_data, fetch_k)
+        if self_rows is not None:
+            labels_hnsw = hold_out(labels_hnsw, vids[self_rows], top_k)
+        ef_recall = recall(labels_hnsw, labels_bf)
+
+        # a probe's latency is a smaller, time limited sample; the selected ef is timed in full below
+        latencies = _query_latencies(hnsw_index, query_data, top_k, TEST_PROBE_LATENCY_QUERIES, TEST_PROBE_LATENCY_SECONDS)
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+        qps = 1 / latencies.mean()
+
+        print("HNSW Search @ EF=%4d:  RECALL: %4.1f %%    QPS: %.1f    p50/p95/p99: %.2f/%.2f/%.2f ms" % (ef, 100*ef_recall, qps,
+                                                                                                      1000*p50, 1000*p95, 1000*p99))
+        result = IndexTest(index_id    = index.id,
+                           test_count  = len(query_data),
+                           test_k      = top_k,
+                           recall      = ef_recall,
+                           qps         = qps,
+                           cpu_info    = CPU_INFO,
+                           hnswlib_ef  = ef,
+                           shard       = shard,
+                           latency_p50 = p50,
+                           latency_p95 = p95,
+                           latency_p99 = p99)
+        with Session(engine) as session:
+            session.add(result)
+            session.commit()
+            results[ef] = (ef_recall, result.id)
+        return ef_recall
+
+    low, high = ef_range or (fetch_k, max(NUMVECTOR, hnsw_index.ef_construction, fetch_k))
+    ef = _search_ef(measure, low, high, target)
+
+    # full latency percentiles and batch throughput at the selected ef_search, which is what the index is served with
+    hnsw_index.set_ef(ef)
+    latencies = _query_latencies(hnsw_index, query_data, top_k)
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    print("Selected EF=%d:  QPS: %.1f    p50/p95/p99: %.2f/%.2f/%.2f ms" % (ef, 1/latencies.mean(), 1000*p50, 1000*p95, 1000*p99))
+    batch_qps = _batch_qps(hnsw_index, query_data, top_k)
+    print("Batch QPS by threads:", ", ".join("%s: %.0f" % item for item in batch_qps.items()))
+    with Session(engine) as session:
+        session.exec(update(IndexTest).where(IndexTest.id == results[ef][1]).values(qps = 1/latencies.mean(),
+                                                                                     latency_p50 = p50,
+                                                                                     latency_p95 = p95,
+                                                                                     latency_p99 = p99,
+                                                                                     batch_qps = batch_qps))
+        session.commit()
+    hnsw_index.set_num_threads(BUILD_THREADS)
+    print("Test Complete: ef_search %d for target recall %.3f" % (ef, target))
+    return ef
+
+    
+    
+BUILD_CHUNK = 10000            # vectors fetched from the server-side cursor and indexed per chunk
+BUILD_STATUS_INTERVAL = 5     # minimum seconds between build progress status updates
+
+
+_build_status_updated = {}    # (model name, id) -> time of last out of band build_status update, while building
+
+
+def _update_build_status(target, build_status):
+    """
+    update the build_status of an Index or IndexShard out of band of the build session, rate limited per target
+    """
+    model = type(target)
+    key = (model.__name__, target.id)
+    now = time()
+    if now - _build_status_updated.get(key, 0) < BUILD_STATUS_INTERVAL:
+        return
+    _build_status_updated[key] = now
+    with Session(engine) as session:
+        session.exec(update(model).where(model.id == target.id).values(build_status=build_status))
+        session.commit()
+
+
+def _decode_rows(rows, vids, vectors):
+    """
+    decode (vector_id, vector, vector_data) rows into the vids and vectors array views
+    """
+    dimension = vectors.shape[1]
+    vids[:] = [row[0] for row in rows]
+    datas = [row[2] for row in rows]
+    if all(data is not None and len(data) == 4*dimension for data in datas):
+        # fast path for float32 storage: one copy of the packed chunk straight into the matrix
+        vectors[:] = np.frombuffer(b''.join(datas), dtype=vector_codec.VECTOR_DTYPE).reshape(-1, dimension)
+    elif all(data is not None and len(data) == 2*dimension for data in datas):
+        # float16 storage: widened to float32 as the packed chunk is copied into the matrix
+        vectors[:] = np.frombuffer(b''.join(datas), dtype=vector_codec.STORAGE_DTYPES['float16']).reshape(-1, dimension)
+    elif all(data is None for data in datas):
+        # array storage: the real[] lists are converted in one call
+        vectors[:] = [row[1] for row in rows]
+    else:
+        # a collection being converted between vector storages (see migrate.convert_collection)
+        for i, (vector_id, vector, vector_data) in enumerate(rows):
+            vectors[i] = vector_codec.unpack_vector(vector, vector_data, dimension)
+
+
+def _load_vectors(session, collection, count, on_chunk=None, where=None):
+    """
+    stream up to count vectors of the collection (or those matching the where clauses,
+    e.g. an index shard) through a server-side cursor into a preallocated
+    int64 vector_id array and float32 vector matrix, calling on_chunk(vids, vectors, loaded) with
+    views of each chunk as it is filled.  Vectors inserted after count was taken are not included.
+    returns the (vids, vectors) arrays trimmed to the number of vectors actually loaded.
+    """
+    dimension = collection.dimension
+    vids = np.empty(count, dtype=np.int64)
+    vectors = np.empty((count, dimension), dtype=np.float32)
+    statement = select(Vector.vector_id, Vector.vector, Vector.vector_data).where(*(where or [Vector.collection_id == collection.id]))
+    statement = statement.execution_options(stream_results=True, yield_per=BUILD_CHUNK)
+    loaded = 0
+    for rows in session.exec(statement).partitions(BUILD_CHUNK):
+        rows = rows[:count-loaded]
+        if not rows:
+            break
+        end = loaded + len(rows)
+        _decode_rows(rows, vids[loaded:end], vectors[loaded:end])
+        if on_chunk:
+            on_chunk(vids[loaded:end], vectors[loaded:end], end)
+        loaded = end
+    return vids[:loaded], vectors[:loaded]
+
+
+INCREMENTAL_MAX_DELETED_FRACTION = 0.25   # rebuild from scratch once this fraction of the graph is deleted elements
+
+
+def _load_vector_ids(session, collection, vector_ids, on_chunk=None):
+    """
+    load the specified vectors of the collection in chunks into a preallocated int64 vector_id array
+    and float32 vector matrix, calling on_chunk(vids, vectors, loaded) as each chunk is filled.
+    returns the (vids, vectors) arrays trimmed to the vectors that still exist.
+    """
+    vids = np.empty(len(vector_ids), dtype=np.int64)
+    vectors = np.empty((len(vector_ids), collection.dimension), dtype=np.float32)
+    loaded = 0
+    for i in range(0, len(vector_ids), BUILD_CHUNK):
+        statement = select(Vector.vector_id, Vector.vector, Vector.vector_data).where(Vector.collection_id == collection.id,
+                                                                                      Vector.vector_id.in_(vector_ids[i:i+BUILD_CHUNK]))
+        rows = session.exec(statement).all()
+        if not rows:
+            continue
+        end = loaded + len(rows)
+        _decode_rows(rows, vids[loaded:end], vectors[loaded:end])
+        if on_chunk:
+            on_chunk(vids[loaded:end], vectors[loaded:end], end)
+        loaded = end
+    return vids[:loaded], vectors[:loaded]
+
+
+def _update_base_index(session, index, collection):
+    """
+    incrementally update the previous index with the same tag: add the vectors inserted or replaced since
+    the previous index was requested and mark the deleted ones as deleted.
+    returns the updated hnswlib index, or None if a full build is required instead.
+    """
+    since = float(index.base_created_at) - CHANGE_LOG_MARGIN
+    inserted, deleted = vector_changes(session, collection.id, since)
+    # check the deleted fraction the update would leave before doing any of its work.  index.deleted_elements is
+    # inherited from the base; vectors inserted and deleted since the base was built make this an overestimate.
+    deleted_elements = (index.deleted_elements or 0) + len(deleted)
+    deleted_fraction = deleted_elements / max(index.count + deleted_elements, 1)
+    if deleted_fraction > INCREMENTAL_MAX_DELETED_FRACTION:
+        print("%.0f%% of base index elements would be deleted; rebuilding" % (100*deleted_fraction))
+        return None
+    hnsw_index = hnswlib.Index(space=index.metric, dim=collection.dimension)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        try:
+            if index.base_md5 is not None:
+                # loaded while held, so the cached file can not be evicted before it is read
+                with file_cache.open(bucket, index.objkey, index.base_md5) as filename:
+                    hnsw_index.load_index(filename, max_elements=0)
+            else:
+                filename = os.path.join(tmpdir, "base-%d.hnsf" % index.id)
+                bucket.download_file(index.objkey, filename)
+                hnsw_index.load_index(filename, max_elements=0)
+        except (S3.Exceptions.BucketException, ValueError) as e:
+            print("base index unavailable:", e)
+            return None
+    hnsw_index.set_num_threads(BUILD_THREADS)
+    # replaced vectors reuse their existing element, so this is an upper bound on the new capacity
+    hnsw_index.resize_index(hnsw_index.get_current_count() + len(inserted))
+
+    index.build_status = "Incremental update of index with %d inserted and %d deleted vectors in progress." % (len(inserted), len(deleted))
+    session.commit()
+
+    def add_chunk(chunk_vids, chunk_vectors, loaded):
+        hnsw_index.add_items(chunk_vectors, chunk_vids)
+
+    _load_vector_ids(session, collection, inserted, add_chunk)
+    for vector_id in deleted:
+        try:
+            hnsw_index.mark_deleted(vector_id)
+        except RuntimeError:
+            pass   # not in the base index (inserted and deleted since it was built)
+    index.deleted_elements = max(hnsw_index.get_current_count() - index.count, 0)
+    return hnsw_index
+
+
+def _partition(index, shard):
+    """
+    the where clauses selecting the vectors of the collection that belong to the shard of the index.
+    vectors are assigned to shards by a hash of their vector_id.
+    """
+    clauses = [Vector.collection_id == index.collection_id]
+    if shard is not None:
+        clauses.append(func.hashint8(Vector.vector_id).op('&')(0x7fffffff) % index.shards == shard.shard)
+    return clauses
+
+
+def _optimize_index(index, collection, index_elements):
+    """
+    select the index parameters for the target_recall and budgets of the index with the optimizer,
+    recording its predictions.  returns the optimizer result.
+    """
+    opt = optimize_hnswlib_params(collection.dimension,
+                                  index_elements,
+                                  index.target_recall,
+                                  max_latency_seconds = index.max_latency_seconds,
+                                  max_index_bytes = index.max_index_bytes,
+                                  max_build_seconds = index.max_build_seconds,
+                                  cpu_info = CPU_INFO)
+    index.hnswlib_M = opt['index_M']
+    index.hnswlib_ef = opt['index_ef_construction']
+    index.hnswlib_ef_search = opt['test_ef']
+    index.predicted_recall = opt['recall']
+    index.predicted_latency_seconds = opt['latency_seconds']
+    index.predicted_index_bytes = opt['index_bytes']
+    index.predicted_build_seconds = opt['creation_seconds']
+    return opt
+
+
+def _start_sharded_index(session, index, collection):
+    """
+    resolve the index parameters shared by all shards, once, under a lock on the index row
+    """
+    session.refresh(index, with_for_update=True)
+    if index.target_library == IndexLibraries.hnswlib and index.target_recall and index.hnswlib_M is None:
+        _optimize_index(index, collection, collection.count // index.shards)
+    if index.target_library == IndexLibraries.ivfpq and index.ivf_nlist is None:
+        _size_ivfpq_index(index, collection, collection.count // index.shards)
+    if index.hnswlib_ef_search is None:
+        index.hnswlib_ef_search = index.hnswlib_ef
+    if index.state in (IndexBuildState.queued, IndexBuildState.prep):
+        index.state = IndexBuildState.indexing
+        index.build_status = "Sharded index build of %d shards in progress." % index.shards
+    session.commit()
+
+
+def _finish_sharded_index(session, index, ef_search):
+    """
+    complete the sharded index once all of its shards are complete.
+    the index ef_search is the largest of the minimum ef_search measured for each shard, its size the total of
+    the shard sizes and its build time that of the slowest shard (the shards build in parallel).
+    """
+    session.refresh(index, with_for_update=True)
+    shards = list(session.exec(select(IndexShard).where(IndexShard.index_id == index.id)))
+    complete = [s for s in shards if s.state == IndexBuildState.complete]
+    if ef_search is not None:
+        # the first shard to complete replaces the ef_search default set when the build started
+        field = 'ivf_nprobe' if index.target_library == IndexLibraries.ivfpq else 'hnswlib_ef_search'
+        setattr(index, field, ef_search if len(complete) == 1 else max(getattr(index, field) or 0, ef_search))
+    if len(complete) == index.shards:
+        index.count = sum(s.count for s in complete)
+        index.index_bytes = sum(s.index_bytes or 0 for s in complete)
+        index.build_seconds = max(s.build_seconds or 0 for s in complete)
+        if index.compression_level is not None:
+            index.compressed_bytes = sum(s.compressed_bytes or 0 for s in complete)
+        index.completed_at = time()
+        index.state = IndexBuildState.complete
+        index.build_status = "Sharded index build of %d vectors in %d shards completed." % (index.count, index.shards)
+    else:
+        index.build_status = "Sharded index build in progress: %d of %d shards complete." % (len(complete), index.shards)
+    session.commit()
+
+
+def _test_flat_index(index, collection, flat_index, shard=None):
+    """
+    record the latency of the exact flat index, which has a recall of 1
+    """
+    query_data, _ = _test_queries(collection, flat_index.vectors)
+    top_k = min(TEST_K, len(flat_index.vectors))
+    latencies = _query_latencies(flat_index, query_data, top_k)
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    print("Flat Search:  QPS: %.1f    p50/p95/p99: %.2f/%.2f/%.2f ms" % (1/latencies.mean(), 1000*p50, 1000*p95, 1000*p99))
+    with Session(engine) as session:
+        session.add(IndexTest(index_id    = index.id,
+                              test_count  = len(query_data),
+                              test_k      = top_k,
+                              recall      = 1.0,
+                              qps         = 1/latencies.mean(),
+                              cpu_info    = CPU_INFO,
+                              shard       = shard,
+                              latency_p50 = p50,
+                              latency_p95 = p95,
+                              latency_p99 = p99))
+        session.commit()
+
+
+class _UploadStream:
+    """
+    the read end of the pipe an index is saved to, as read by the upload: computes the md5 of the
+    bytes and copies them to a file in the node-local file cache.  If the save failed the upload
+    fails at the end of the pipe, rather than completing with a truncated index.
+    """
+    def __init__(self, f, copy):
+        self.f = f
+        self.copy = copy
+        self.md5 = hashlib.md5()
+        self.nbytes = 0
+        self.failed = False
+
+    def seekable(self):
+        return False
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        if not data and self.failed:
+            raise RuntimeError("index save failed")
+        self.md5.update(data)
+        self.nbytes += len(data)
+        self.copy.write(data)
+        return data
+
+
+def _save_upload(save, objkey):
+    """
+    save an index with save(filename) to a pipe that is streamed to a multipart upload of the bucket objkey,
+    computing the md5 and copying the index into the node-local file cache in the same pass.
+    returns (index bytes, md5, filename of the copy to be added to the file cache)
+    """
+    with tempfile.TemporaryDirectory(dir=SCRATCH_DIR) as tmpdir:
+        fifo = os.path.join(tmpdir, "index.fifo")
+        os.mkfifo(fifo)
+        # open both ends here; holding a write end open means the upload sees the end of the pipe only
+        # after the save has finished, whether or not the save ever opened the pipe
+        rfd = os.open(fifo, os.O_RDONLY | os.O_NONBLOCK)
+        os.set_blocking(rfd, True)
+        wfd = os.open(fifo, os.O_WRONLY)
+        copy_filename = file_cache.temp_filename()
+        stream = _UploadStream(open(rfd, 'rb'), open(copy_filename, 'wb'))
+        errors = []
+        def upload():
+            try:
+                bucket.upload_fileobj(stream, objkey)
+            except Exception as e:
+                errors.append(e)
+                # drain the pipe so the save does not block forever on it
+                while stream.f.read(1024*1024):
+                    pass
+        thread = threading.Thread(target=upload)
+        thread.start()
+        try:
+            save(fifo)
+        except Exception:
+            stream.failed = True
+            raise
+        finally:
+            os.close(wfd)
+            thread.join()
+            stream.f.close()
+            stream.copy.close()
+            if stream.failed or errors:
+                os.unlink(copy_filename)
+        if errors:
+            raise errors[0]
+    return stream.nbytes, stream.md5.hexdigest(), copy_filename
+
+
+def _check_collection_not_deleting(collection_id):
+    """
+    raise RuntimeError if the collection is being deleted, so a build stops before uploading objects
+    (the deletion waits for running builds to stop before it deletes their objects, see deletion.delete_collection)
+    """
+    with Session(engine) as session:
+        collection = session.get(Collection, collection_id)
+        if collection is None or collection.deleting:
+            raise RuntimeError("collection %d is being deleted" % collection_id)
+
+
+def _store_index(index, target, save):
+    """
+    save, upload and cache the index (or index shard) target with save(filename), recording its size and md5.
+    if the index has a compression_level, the compressed artifact is uploaded too, compressed from the local copy.
+    """
+    _check_collection_not_deleting(index.collection_id)
+    target.index_bytes, target.md5, filename = _save_upload(save, target.objkey)
+    try:
+        if index.compression_level is not None:
+            t0 = time()
+            reader = CompressedReader(filename, index.compression_level, BUILD_THREADS)
+            try:
+                bucket.upload_fileobj(reader, target.objkey + COMPRESSED_SUFFIX)
+            finally:
+                reader.close()
+            target.compressed_bytes = reader.nbytes
+            print("compressed index %.1f MB to %.1f MB in %.1f seconds" % (target.index_bytes/1024/1024,
+                                                                           target.compressed_bytes/1024/1024,
+                                                                           time()-t0))
+    except Exception:
+        os.unlink(filename)
+        raise
+    # seed this node's file cache, so an incremental rebuild or query here does not download the index again
+    file_cache.add(filename, target.md5)
+
+
+def _create_flat_index(session, index, collection, shard, target):
+    """
+    build, save and upload the flat index (or flat index shard) target
+    """
+    t0 = time()
+    def progress(chunk_vids, chunk_vectors, loaded):
+        _update_build_status(target, "Flat index build of %d (dimension %d) vectors in progress: %d%% loaded." % (target.count,
+                                                                                                                  collection.dimension,
+                                                                                                                  100*loaded/max(target.count, 1)))
+    vids, vectors = _load_vectors(session, collection, target.count, progress, _partition(index, shard))
+    target.count = len(vids)
+    flat_index = FlatIndex(index.metric, vectors, vids)
+    target.build_status = "Saving index."
+    target.state = IndexBuildState.saving
+    session.commit()
+    target.build_seconds = time()-t0
+    _store_index(index, target, flat_index.save_index)
+    target.completed_at = time()
+    target.build_status = "Flat index build of %d (dimension %d) vectors completed in %.1f seconds generating %.1f MB index." % (target.count,
+                                                                                                                                   collection.dimension,
+                                                                                                                                   target.build_seconds,
+                                                                                                                                   target.index_bytes/1024/1024)
+    if target.count:
+        target.state = IndexBuildState.testing
+        session.commit()
+        _test_flat_index(index, collection, flat_index, shard = None if shard is None else shard.shard)
+    target.state = IndexBuildState.complete
+
+
+def _size_ivfpq_index(index, collection, index_elements):
+    """
+    size the code and inverted lists of an ivfpq index for its pq_m or max_index_bytes
+    """
+    params = ivfpq_params(collection.dimension, index_elements, index.max_index_bytes, index.pq_m)
+    index.pq_m = params['pq_m']
+    index.ivf_nlist = params['nlist']
+    index.predicted_index_bytes = params['index_bytes']
+
+
+def _create_ivfpq_index(session, index, collection, shard, target):
+    """
+    build, save, upload and test the ivfpq index (or ivfpq index shard) target
+    """
+    if shard is None:
+        _size_ivfpq_index(index, collection, target.count)
+    target.build_status = "IVF-PQ index build of %d (dimension %d) vectors in progress." % (target.count, collection.dimension)
+    session.commit()
+    t0 = time()
+    def progress(chunk_vids, chunk_vectors, loaded):
+        _update_build_status(target, "IVF-PQ index build of %d (dimension %d) vectors in progress: %d%% loaded." % (target.count,
+                                                                                                                    collection.dimension,
+                                                                                                                    100*loaded/max(target.count, 1)))
+    vids, vectors = _load_vectors(session, collection, target.count, progress, _partition(index, shard))
+    target.count = len(vids)
+    flat_index = FlatIndex(index.metric, vectors, vids)
+    pq_index = IVFPQIndex.build(index.metric, flat_index, index.ivf_nlist, index.pq_m, BUILD_THREADS)
+    target.build_seconds = time()-t0
+    target.build_status = "Saving index."
+    target.state = IndexBuildState.saving
+    session.commit()
+    _store_index(index, target, pq_index.save_index)
+    # the full vectors compress poorly and are only needed for serving, so they are stored uncompressed only
+    _, _, vectors_filename = _save_upload(pq_index.flat.save_index, target.objkey + VECTORS_SUFFIX)
+    file_cache.add(vectors_filename, target.md5, VECTORS_SUFFIX)
+    target.completed_at = time()
+    target.build_status = "IVF-PQ index build of %d (dimension %d) vectors completed in %.1f seconds generating %.1f MB index." % (target.count,
+                                                                                                                                     collection.dimension,
+                                                                                                                                     target.build_seconds,
+                                                                                                                                     target.index_bytes/1024/1024)
+    target.state = IndexBuildState.testing
+    session.commit()
+    nprobe = _test_index(index, collection, flat_index.vectors, vids, pq_index,
+                         shard = None if shard is None else shard.shard,
+                         ef_range = (1, index.ivf_nlist))
+    if shard is None:
+        index.ivf_nprobe = nprobe
+    target.state = IndexBuildState.complete
+    return nprobe
+
+
+def _create_index(index, shard=None):
+    """
+    build the index, or the specified IndexShard of a sharded index
+    """
+    _check_collection_not_deleting(index.collection_id)
+    with Session(engine) as session:
+        print("create_index:", index, shard)
+        session.add(index)
+        collection = session.get(Collection, index.collection_id)
+        # build progress is reported on the shard for sharded indexes
+        target = index
+        if shard is not None:
+            session.add(shard)
+            target = shard
+            _start_sharded_index(session, index, collection)
+        target.build_status = "Preparing data for indexing."
+        target.state = IndexBuildState.prep
+        session.commit()
+        statement = select(func.count()).select_from(Vector).where(*_partition(index, shard))
+        target.state = IndexBuildState.indexing
+        target.count = session.exec(statement).one()
+        if index.target_library in (IndexLibraries.flat, IndexLibraries.ivfpq):
+            nprobe = None
+            if index.target_library == IndexLibraries.flat:
+                _create_flat_index(session, index, collection, shard, target)
+            else:
+                nprobe = _create_ivfpq_index(session, index, collection, shard, target)
+            prune_vector_changes(session, collection.id)
+            session.commit()
+            if shard is not None:
+                _finish_sharded_index(session, index, nprobe)
+            return
+        # autoselect index parameters using learned model if target_recall has been specified, unless they were
+        # selected when the build was admitted (see worker.estimate_index_build_bytes)
+        # (incremental builds keep the parameters of the index they are built from)
+        if index.target_recall and index.hnswlib_M is None and index.base_created_at is None and shard is None:
+            index.build_status = "Autoselecting index parameters."
+            session.commit()
+            opt = _optimize_index(index, collection, index.count)
+            index.completed_at = time() + opt['creation_seconds']
+
+        if index.hnswlib_ef_search is None:
+            index.hnswlib_ef_search = index.hnswlib_ef
+
+        target.build_status = "Index build of %d (dimension %d) vectors in progress." % (target.count,
+                                                                                         collection.dimension)
+        session.commit()
+        
+        t0 = time()
+        hnsw_index = None
+        vids = vector_list = None
+        if index.base_created_at is not None:
+            hnsw_index = _update_base_index(session, index, collection)
+        if hnsw_index is None:
+            index.deleted_elements = 0
+            hnsw_index = hnswlib.Index(space=index.metric, dim=collection.dimension)
+            hnsw_index.set_num_threads(BUILD_THREADS)
+        
+            hnsw_index.init_index(max_elements=max(target.count, 1),
+                                  ef_construction= index.hnswlib_ef,
+                                  M=index.hnswlib_M)
+
+            def add_chunk(chunk_vids, chunk_vectors, loaded):
+                hnsw_index.add_items(chunk_vectors, chunk_vids)
+                _update_build_status(target, "Index build of %d (dimension %d) vectors in progress: %d%% indexed." % (target.count,
+                                                                                                                       collection.dimension,
+                                                                                                                       100*loaded/max(target.count, 1)))
+
+            vids, vector_list = _load_vectors(session, collection, target.count, add_chunk, _partition(index, shard))
+            target.count = len(vids)
+
+        target.build_status = "Saving index."
+        target.state = IndexBuildState.saving
+        session.commit()
+        HNSW_INDEX_CREATE_TIME = time()-t0
+        _store_index(index, target, hnsw_index.save_index)
+        INDEX_SIZE_BYTES = target.index_bytes
+        target.build_seconds = HNSW_INDEX_CREATE_TIME
+        target.completed_at = time()
+        target.build_status = "Index build of %d (dimension %d) vectors completed in %.1f seconds generating %.1f MB index." % (target.count,
+                                                                                                                                collection.dimension,
+                                                                                                                                HNSW_INDEX_CREATE_TIME,
+                                                                                                                                INDEX_SIZE_BYTES/1024/1024)        
+        ef_search = None
+        if vector_list is not None and len(vector_list):
+            target.state = IndexBuildState.testing
+            session.commit()
+            ef_search = _test_index(index, collection, vector_list, vids, hnsw_index,
+                                    shard = None if shard is None else shard.shard)
+            if shard is None:
+                index.hnswlib_ef_search = ef_search
+        # incremental updates skip testing, which would need the whole collection; they keep the previous ef_search
+        target.state = IndexBuildState.complete        
+        prune_vector_changes(session, collection.id)
+        session.commit()
+        if shard is not None:
+            _finish_sharded_index(session, index, ef_search)
+
+
+        
+def create_index(index, shard=None):
+    """
+    build the index (or the IndexShard of a sharded index), marking it failed on any exception.
+    returns True if the index build completed.
+    """
+    try:
+        _create_index(index, shard)
+        print("Complete Index:", index, shard)
+        return True
+    except Exception as e:
+        print("Exception:")
+        with Session(engine) as session:
+            print(e)
+            print(index)
+            index.completed_at = time()
+            index.state = IndexBuildState.failed
+            index.build_status = f"Index {index.id} failed to build.  Please contact support@jiggy.ai"
+            session.add(index)
+            if shard is not None:
+                shard.completed_at = time()
+                shard.state = IndexBuildState.failed
+                shard.build_status = f"Index {index.id} shard {shard.shard} failed to build."
+                session.add(shard)
+            session.commit()
+            return False
+    finally:
+        target = shard if shard is not None else index
+        _build_status_updated.pop((type(target).__name__, target.id), None)
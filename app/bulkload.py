@@ -0,0 +1,153 @@
+# Jiggy vector bulk loader
+# Copyright (C) 2022 William S. Kish
+
+"""
+Bulk load vectors into the vector table using COPY ... FROM STDIN (binary format) into a
+per-connection staging table, followed by a single INSERT ... ON CONFLICT merge on
+(collection_id, vector_id).
+
+The binary COPY stream is produced with a single numpy structured array so there is no per-row
+or per-element python work regardless of batch size.  Depending on the collection's vector storage
+the stream carries either a real[] vector or packed bytea vector_data per row.
+"""
+
+import io
+import numpy as np
+from time import time
+
+import vector_codec
+
+
+FLOAT4_OID = 700   # postgres type oid for real (float4)
+
+COPY_HEADER  = b'PGCOPY\n\xff\r\n\x00' + np.array([0, 0], dtype='>i4').tobytes()   # signature, flags, header extension length
+COPY_TRAILER = np.array([-1], dtype='>i2').tobytes()
+
+CREATE_STAGING = """
+CREATE TEMP TABLE IF NOT EXISTS vector_staging (
+    vector_id    bigint,
+    vector       real[],
+    vector_data  bytea
+) ON COMMIT DELETE ROWS
+"""
+
+MERGE_STAGING = """
+WITH merged AS (
+    INSERT INTO vector (collection_id, vector_id, vector, vector_data, created_at)
+    SELECT %(collection_id)s, vector_id, vector, vector_data, %(created_at)s FROM vector_staging
+    ON CONFLICT (collection_id, vector_id)
+    DO UPDATE SET vector = EXCLUDED.vector, vector_data = EXCLUDED.vector_data, created_at = EXCLUDED.created_at
+    RETURNING (xmax = 0) AS inserted
+)
+SELECT count(*) FILTER (WHERE inserted) FROM merged
+"""
+
+LOG_STAGING = """
+INSERT INTO vectorchange (collection_id, vector_id, op, created_at)
+SELECT %(collection_id)s, vector_id, 'insert', %(created_at)s FROM vector_staging
+"""
+
+
+def _copy_row_dtype(dimension):
+    """
+    the numpy dtype of one binary COPY tuple of (vector_id bigint, vector real[])
+    """
+    return np.dtype([('nfields',  '>i2'),
+                     ('id_len',   '>i4'),
+                     ('id',       '>i8'),
+                     ('vec_len',  '>i4'),
+                     ('ndim',     '>i4'),
+                     ('hasnull',  '>i4'),
+                     ('elemtype', '>i4'),
+                     ('dim',      '>i4'),
+                     ('lbound',   '>i4'),
+                     ('elems',    [('len', '>i4'), ('val', '>f4')], (dimension,))])
+
+
+def _copy_bytea_row_dtype(dimension, packed_dtype):
+    """
+    the numpy dtype of one binary COPY tuple of (vector_id bigint, vector_data bytea)
+    """
+    return np.dtype([('nfields',  '>i2'),
+                     ('id_len',   '>i4'),
+                     ('id',       '>i8'),
+                     ('data_len', '>i4'),
+                     ('data',     packed_dtype, (dimension,))])
+
+
+def copy_stream_bytea(vector_ids, vectors, storage):
+    """
+    return a file object containing the binary COPY representation of the vector_ids and
+    the vectors packed for the storage mode
+    """
+    count, dimension = vectors.shape
+    packed = vector_codec.pack_vectors(vectors, storage)
+    rows = np.empty(count, dtype=_copy_bytea_row_dtype(dimension, packed.dtype))
+    rows['nfields']  = 2
+    rows['id_len']   = 8
+    rows['id']       = vector_ids
+    rows['data_len'] = dimension * packed.dtype.itemsize
+    rows['data']     = packed
+    return io.BytesIO(COPY_HEADER + rows.tobytes() + COPY_TRAILER)
+
+
+def copy_stream(vector_ids, vectors):
+    """
+    return a file object containing the binary COPY representation of the vector_ids and vectors
+    """
+    count, dimension = vectors.shape
+    rows = np.empty(count, dtype=_copy_row_dtype(dimension))
+    rows['nfields']  = 2
+    rows['id_len']   = 8
+    rows['id']       = vector_ids
+    rows['vec_len']  = 20 + 8 * dimension   # array header plus (length, value) per element
+    rows['ndim']     = 1
+    rows['hasnull']  = 0
+    rows['elemtype'] = FLOAT4_OID
+    rows['dim']      = dimension
+    rows['lbound']   = 1
+    rows['elems']['len'] = 4
+    rows['elems']['val'] = vectors
+    return io.BytesIO(COPY_HEADER + rows.tobytes() + COPY_TRAILER)
+
+
+def dedup_last(vector_ids, vectors):
+    """
+    remove duplicate vector_ids from the batch, keeping the last occurrence of each vector_id
+    """
+    _, last = np.unique(vector_ids[::-1], return_index=True)
+    if len(last) == len(vector_ids):
+        return vector_ids, vectors
+    keep = np.sort(len(vector_ids) - 1 - last)
+    return vector_ids[keep], vectors[keep]
+
+
+def copy_vectors(session, collection, vector_ids, vectors, log_changes=True):
+    """
+    upsert the vectors into the collection within the session's current transaction,
+    stored according to the collection's vector_storage.
+    vector_ids is an int64 array of shape (n,) and vectors a float32 array of shape (n, dimension).
+    vector_ids must not contain duplicates (see dedup_last).
+    The upserted vector_ids are recorded in the vector change log if log_changes (see changelog).
+    returns the number of vectors that were new to the collection.
+    raises ValueError if the vectors can not be represented in the collection's vector storage.
+    The caller is responsible for committing the session.
+    """
+    if vector_codec.storage_dtype(collection.vector_storage) is None:
+        columns, stream = "(vector_id, vector)", copy_stream(vector_ids, vectors)
+    else:
+        columns, stream = "(vector_id, vector_data)", copy_stream_bytea(vector_ids, vectors, collection.vector_storage)
+    dbapi_connection = session.connection().connection
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute(CREATE_STAGING)
+        cursor.execute("TRUNCATE vector_staging")
+        cursor.copy_expert("COPY vector_staging %s FROM STDIN WITH (FORMAT binary)" % columns, stream)
+        params = {'collection_id': int(collection.id), 'created_at': time()}
+        cursor.execute(MERGE_STAGING, params)
+        created = cursor.fetchone()[0]
+        if log_changes:
+            cursor.execute(LOG_STAGING, params)
+        return created
+    finally:
+        cursor.close()
@@ -0,0 +1,65 @@
+# Jiggy vector change log
+# Copyright (C) 2022 William S. Kish
+
+"""
+The vectorchange table logs the vector_ids upserted and deleted in each collection since its indexes were
+requested, for incremental index builds (see build._update_base_index).
+
+Changes are only logged for collections that have an index, as an incremental build needs a previous index
+of the collection.  Writers check this while holding the collection row lock (SELECT ... FOR UPDATE), as does
+index creation, so a write either sees the new index or commits before the index is requested and is loaded
+by its build.  An incremental build reads the changes since its base index was requested, so entries are kept
+while any index of the collection may still need them, and pruned when indexes are built or replaced.
+"""
+
+from time import time
+from sqlmodel import select, delete, func
+from sqlalchemy import case
+
+from models import *
+
+
+CHANGE_LOG_MARGIN = 60   # seconds of change log overlap with the previous build, to cover in flight transactions
+
+
+def logs_changes(session, collection_id):
+    """
+    True if writes to the collection must be logged, i.e. the collection has an index.
+    the caller must hold the collection row lock.
+    """
+    return session.exec(select(Index.id).where(Index.collection_id == collection_id).limit(1)).first() is not None
+
+
+def vector_changes(session, collection_id, since):
+    """
+    return the lists of vector_ids inserted (or replaced) and deleted in the collection since the specified time,
+    according to the most recent change to each vector_id
+    """
+    statement = select(VectorChange.vector_id, VectorChange.op).where(VectorChange.collection_id == collection_id,
+                                                                     VectorChange.created_at > since)
+    statement = statement.order_by(VectorChange.vector_id, VectorChange.created_at.desc(), VectorChange.id.desc())
+    statement = statement.distinct(VectorChange.vector_id)
+    inserted = []
+    deleted = []
+    for vector_id, op in session.exec(statement):
+        if op == VectorChangeOp.insert:
+            inserted.append(vector_id)
+        else:
+            deleted.append(vector_id)
+    return inserted, deleted
+
+
+def prune_vector_changes(session, collection_id):
+    """
+    remove change log entries that no index of the collection can need: an index that is still to be built
+    incrementally needs the changes since its base index was requested, and any other index the changes since
+    it was requested (for a later incremental build from it).
+    """
+    needed_since = case((Index.state.in_([IndexBuildState.complete, IndexBuildState.failed]), Index.created_at),
+                        else_=func.coalesce(Index.base_created_at, Index.created_at))
+    statement = select(func.min(needed_since)).where(Index.collection_id == collection_id)
+    oldest = session.exec(statement).one()
+    if oldest is None:
+        oldest = time()
+    session.exec(delete(VectorChange).where(VectorChange.collection_id == collection_id,
+                                            VectorChange.created_at < float(oldest) - CHANGE_LOG_MARGIN))
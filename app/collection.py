@@ -49,7 +49,10 @@ def post_collections(token: str = Depends(token_auth_scheme),
             raise HTTPException(status_code=404, detail="User is not a member of the specified team.")
 
         statement = select(Collection).where(Collection.team_id == body.team_id, Collection.name == body.name)
-        if list(session.exec(statement)):
+        existing = session.exec(statement).first()
+        if existing and existing.deleting:
+            raise HTTPException(status_code=409, detail="A collection with this name is being deleted.  Please retry once the deletion completes.")
+        if existing:
             raise HTTPException(status_code=409, detail="Collection name already exists in the team.")
         
         collection = Collection(**body.dict(exclude_unset=True))
@@ -76,37 +79,37 @@ def get_collections_collection_id(token: str = Depends(token_auth_scheme),
         return collection
 
 
-
-from s3 import bucket
-
-
-@app.delete('/collections/{collection_id}')
+@app.delete('/collections/{collection_id}', status_code=202, response_model=Collection)
 def delete_collections_collection_id(token: str = Depends(token_auth_scheme),
-                                     collection_id: str = Path(...)):
+                                     collection_id: str = Path(...)) -> Collection:
     """
     Delete specified collection, including all associated vectors and index.
     This deletion is permanent and can not be undone.
+
+    The collection is removed in the background: it is marked deleting immediately and its progress is reported
+    in delete_status by GET /collections/{collection_id}, which returns 404 once the deletion has completed.
     """
     user_id, user_team_ids = verified_user_id_teams(token)    
     with Session(engine) as session:    
-        collection = session.get(Collection, collection_id)
+        collection = session.get(Collection, collection_id, with_for_update=True)
         if not collection or collection.team_id not in user_team_ids:
             raise HTTPException(status_code=404, detail="Collection not found")
-        # delete all vector data
-        statement = delete(Vector).where(Vector.collection_id == collection_id)
-        session.exec(statement)
-        # delete all index data
-        statement = select(Index).where(Index.collection_id == collection_id)
-        for index in session.exec(statement):
-            session.exec(delete(IndexTest).where(IndexTest.index_id == index.id))
-            bucket.delete(index.objkey)
-            session.delete(index)
-        # delete the collection
-        session.commit()        
-        session.delete(collection)
-        session.commit()
+        # a repeated delete requeues a deletion whose job failed, but does not duplicate one in progress
+        statement = select(Job).where(Job.kind == JobKind.collection_delete,
+                                      Job.collection_id == collection.id,
+                                      or_(Job.state == JobState.queued, Job.state == JobState.running))
+        if not session.exec(statement).first():
+            session.add(Job(kind = JobKind.collection_delete,
+                            state = JobState.queued,
+                            collection_id = collection.id))
+            collection.deleting = True
+            collection.delete_status = "Queued for deletion."
+            session.add(collection)
+            session.commit()
+            session.refresh(collection)
+        return collection
+
 
-        
 @app.get('/collections', response_model=CollectionsGetResponse)
 def get_collections(token: str = Depends(token_auth_scheme),
                     team_id: Optional[int] = Query(default=None, alias='team_id'),
@@ -114,6 +117,7 @@ def get_collections(token: str = Depends(token_auth_scheme),
     """
     Get all collections for the calling user's team,
     or optionally the collection that matches the specified name.
+    Collections that are being deleted are not listed.
     """
     user_id, user_team_ids = verified_user_id_teams(token)        
     with Session(engine) as session:
@@ -124,20 +128,20 @@ def get_collections(token: str = Depends(token_auth_scheme),
             # return all user collections
             results = []
             for tid in user_team_ids:
-                statement = select(Collection).where(Collection.team_id == tid)
+                statement = select(Collection).where(Collection.team_id == tid, Collection.deleting == False)
                 results.extend(session.exec(statement))
             return CollectionsGetResponse(items=results)
             
         if team_id is None and name is not None:
             # look for a name match in any of user's teams
-            statement = select(Collection).where(Collection.name == name)
+            statement = select(Collection).where(Collection.name == name, Collection.deleting == False)
             results = [c for c in session.exec(statement) if c.team_id in user_team_ids]
             return CollectionsGetResponse(items=results)
         
         if name is not None:
-            statement = select(Collection).where(Collection.team_id == team_id, Collection.name == name)
+            statement = select(Collection).where(Collection.team_id == team_id, Collection.name == name, Collection.deleting == False)
         else:
-            statement = select(Collection).where(Collection.team_id == team_id)
+            statement = select(Collection).where(Collection.team_id == team_id, Collection.deleting == False)
         results = list(session.exec(statement))
         return CollectionsGetResponse(items=results)
 
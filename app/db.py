@@ -0,0 +1,17 @@
+# Jiggy database engine
+# Copyright (C) 2022 William S. Kish
+
+"""
+The database engine, in a module of its own so that the worker and command line tools can use it
+without importing the API app and its endpoints.
+"""
+
+import os
+from sqlmodel import create_engine
+
+
+db_host = os.environ['JIGGY_POSTGRES_HOST']
+user = os.environ['JIGGY_POSTGRES_USER']
+passwd = os.environ['JIGGY_POSTGRES_PASS']
+DBURI = 'postgresql+psycopg2://%s:%s@%s:5432/jiggy' % (user, passwd, db_host)
+engine = create_engine(DBURI, pool_pre_ping=True, echo=False)
@@ -0,0 +1,127 @@
+# Jiggy index and collection deletion
+# Copyright (C) 2022 William S. Kish
+
+"""
+Deletion of indexes and collections, shared by the endpoints and the worker (see JobKind.collection_delete).
+"""
+
+from time import sleep
+from sqlmodel import Session, select, delete, update, func
+from sqlalchemy import text
+
+from s3 import bucket
+from pq_index import VECTORS_SUFFIX
+from zstd_codec import COMPRESSED_SUFFIX
+from db import engine
+from models import *
+
+
+DELETE_BATCH = 10000   # vectors deleted per transaction when deleting a collection
+BUILD_WAIT_SECONDS = 10   # poll interval while waiting for the index builds of a deleting collection to stop
+
+
+def library_objkeys(index, objkey):
+    """
+    the objects stored for the index (or index shard) objkey: ivfpq indexes also store the full vectors,
+    and indexes built with a compression_level also store a compressed artifact
+    """
+    objkeys = [objkey]
+    if index.target_library == IndexLibraries.ivfpq:
+        objkeys.append(objkey + VECTORS_SUFFIX)
+    if index.compression_level is not None:
+        objkeys.append(objkey + COMPRESSED_SUFFIX)
+    return objkeys
+
+
+def delete_index(session, index, delete_object=True):
+    """
+    delete the index, its shards, tests and jobs, and (optionally) its objects in the bucket
+    """
+    objkeys = []
+    for shard in session.exec(select(IndexShard).where(IndexShard.index_id == index.id)):
+        objkeys.extend(library_objkeys(index, shard.objkey))
+        session.delete(shard)
+    if index.shards == 1:
+        objkeys.extend(library_objkeys(index, index.objkey))
+    if delete_object:
+        bucket.delete_many(objkeys)
+    session.exec(delete(IndexTest).where(IndexTest.index_id == index.id))
+    session.exec(delete(Job).where(Job.index_id == index.id))
+    session.delete(index)
+
+
+def _delete_batches(session, collection, table, label):
+    """
+    delete the collection's rows of the table in transactions of DELETE_BATCH rows, so that deleting
+    a large collection does not hold locks on or bloat the table in a single long transaction
+    """
+    deleted = 0
+    while True:
+        result = session.execute(text(f"""
+            DELETE FROM {table} WHERE id IN (SELECT id FROM {table} WHERE collection_id = :collection_id LIMIT :batch)
+        """).bindparams(collection_id=collection.id, batch=DELETE_BATCH))
+        deleted += result.rowcount
+        if result.rowcount:
+            collection.delete_status = "Deletion in progress: %d %s deleted." % (deleted, label)
+            session.add(collection)
+        session.commit()
+        if result.rowcount < DELETE_BATCH:
+            return deleted
+
+
+def _stop_index_builds(session, collection):
+    """
+    fail the collection's queued index builds and wait for its running builds to stop, since a running build
+    may still upload objects.  builds of a deleting collection stop before uploading (see build._store_index).
+    """
+    while True:
+        session.exec(update(Job).where(Job.kind == JobKind.index_build,
+                                       Job.collection_id == collection.id,
+                                       Job.state == JobState.queued).values(state=JobState.failed))
+        statement = select(func.count()).select_from(Job).where(Job.kind == JobKind.index_build,
+                                                                Job.collection_id == collection.id,
+                                                                Job.state == JobState.running)
+        running = session.exec(statement).one()
+        if not running:
+            session.commit()
+            return
+        collection.delete_status = "Deletion waiting for %d index builds to stop." % running
+        session.add(collection)
+        session.commit()
+        sleep(BUILD_WAIT_SECONDS)
+
+
+def delete_collection(collection_id):
+    """
+    remove the deleting collection and all of its vectors, indexes and objects (see JobKind.collection_delete).
+    every step is idempotent, so an interrupted deletion is completed by rerunning it.
+    returns True if the collection was deleted.
+    """
+    with Session(engine) as session:
+        collection = session.get(Collection, collection_id)
+        if not collection or not collection.deleting:
+            print("collection", collection_id, "is not being deleted")
+            return False
+        _stop_index_builds(session, collection)
+        # the objects of all indexes and the test queries, in batched DeleteObjects calls
+        indexes = list(session.exec(select(Index).where(Index.collection_id == collection.id)))
+        objkeys = []
+        for index in indexes:
+            objkeys.extend(library_objkeys(index, index.objkey))
+            statement = select(IndexShard.objkey).where(IndexShard.index_id == index.id)
+            for shard_objkey in session.exec(statement):
+                objkeys.extend(library_objkeys(index, shard_objkey))
+        if collection.test_queries_objkey:
+            objkeys.append(collection.test_queries_objkey)
+        bucket.delete_many(objkeys)
+        for index in indexes:
+            delete_index(session, index, delete_object=False)
+        collection.delete_status = "Deletion in progress: %d index objects deleted." % len(objkeys)
+        session.add(collection)
+        session.commit()
+        vectors = _delete_batches(session, collection, 'vector', 'vectors')
+        _delete_batches(session, collection, 'vectorchange', 'vector changes')
+        session.delete(collection)
+        session.commit()
+        print("deleted collection %d: %d vectors, %d indexes, %d objects" % (collection_id, vectors, len(indexes), len(objkeys)))
+        return True
@@ -0,0 +1,182 @@
+# Jiggy node-local index file cache
+# Copyright (C) 2022 William S. Kish
+
+"""
+A content-addressed cache of index files on local disk, shared by all processes of a node.
+
+Files are named by the md5 of their content (recorded on the Index when it is built), so a cached file
+never goes stale and a rebuilt index is simply a new entry.  Downloads are serialized per entry with an
+fcntl lock so concurrent processes fetch an index once; entries are published by atomic rename.  When the
+cache exceeds JIGGY_FILE_CACHE_BYTES the least recently used files are removed; a file removed while
+memory mapped remains readable by the processes that mapped it.
+
+Entries are used within FileCache.open(), which holds a shared lock on the entry while the caller loads
+it; eviction skips entries that are locked, so a file is never removed between being fetched and loaded.
+
+Loading an index from the cache by memory mapping lets the processes of a node share one page-cache copy.
+"""
+
+import os
+import fcntl
+import hashlib
+import shutil
+import tempfile
+from time import time
+from contextlib import contextmanager
+
+import zstd_codec
+
+
+FILE_CACHE_DIR = os.environ.get('JIGGY_FILE_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'jiggy-index-cache'))
+FILE_CACHE_BYTES = int(os.environ.get('JIGGY_FILE_CACHE_BYTES', 20*1024**3))
+
+
+def file_md5(filename, chunk_bytes=16*1024*1024):
+    """
+    the md5 hex digest of the file, read in chunks
+    """
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_bytes), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+class _Lock:
+    """
+    an fcntl lock on a lock file, shared by the processes of the node: exclusive, or shared if shared is True
+    """
+    def __init__(self, filename, shared=False):
+        self.filename = filename
+        self.shared = shared
+
+    def __enter__(self):
+        self.f = open(self.filename, 'a')
+        fcntl.flock(self.f, fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *args):
+        fcntl.flock(self.f, fcntl.LOCK_UN)
+        self.f.close()
+
+
+class FileCache:
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(os.path.join(directory, 'locks'), exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def _lock_filename(self, key):
+        return os.path.join(self.directory, 'locks', key + '.lock')
+
+    def _lock(self, key, shared=False):
+        return _Lock(self._lock_filename(key), shared)
+
+    @contextmanager
+    def open(self, bucket, objkey, md5, suffix='', compressed=False):
+        """
+        yield the local path of the object with the md5, downloading it from the bucket if it is not cached.
+        the entry can not be evicted until the with block exits, so the caller should load (or memory map)
+        the file within it.
+        suffix selects a companion object stored alongside the object (e.g. ivfpq vectors), cached as md5+suffix.
+        if compressed, the object's smaller compressed artifact is downloaded and decompressed in parallel instead
+        (where zstandard is installed).
+        raises ValueError if the downloaded object does not match the md5.
+        """
+        key = md5 + suffix
+        path = self._path(key)
+        while True:
+            with self._lock(key, shared=True):
+                if os.path.exists(path):
+                    os.utime(path)   # most recently used
+                    yield path
+                    return
+            self._fetch(bucket, objkey, key, md5, suffix, compressed)
+            # the entry is evicted only if it is not in use, so make room for it before reacquiring it;
+            # a concurrent eviction between the two is retried by the loop
+            self.evict(keep=key)
+
+    def _fetch(self, bucket, objkey, key, md5, suffix, compressed):
+        path = self._path(key)
+        with self._lock(key):
+            if not os.path.exists(path):
+                t0 = time()
+                tmp = path + '.%d.tmp' % os.getpid()
+                try:
+                    if compressed and zstd_codec.zstandard is not None:
+                        try:
+                            bucket.download_file(objkey + suffix + zstd_codec.COMPRESSED_SUFFIX, tmp + zstd_codec.COMPRESSED_SUFFIX)
+                            zstd_codec.decompress_file(tmp + zstd_codec.COMPRESSED_SUFFIX, tmp, os.cpu_count())
+                        finally:
+                            if os.path.exists(tmp + zstd_codec.COMPRESSED_SUFFIX):
+                                os.unlink(tmp + zstd_codec.COMPRESSED_SUFFIX)
+                    else:
+                        bucket.download_file(objkey + suffix, tmp)
+                    if not suffix and file_md5(tmp) != md5:
+                        raise ValueError("%s does not match md5 %s" % (objkey, md5))
+                    os.rename(tmp, path)
+                finally:
+                    if os.path.exists(tmp):
+                        os.unlink(tmp)
+                print("file cache: fetched %s (%.1f MB) in %.1f seconds" % (objkey + suffix, os.stat(path).st_size/1024/1024, time()-t0))
+
+    def temp_filename(self):
+        """
+        a unique filename in the cache directory for a file to be added (ignored by eviction until added)
+        """
+        fd, filename = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        os.close(fd)
+        return filename
+
+    def add(self, filename, md5, suffix=''):
+        """
+        move a locally built file into the cache under its md5
+        """
+        path = self._path(md5 + suffix)
+        with self._lock(md5 + suffix):
+            if os.path.exists(path):
+                os.unlink(filename)
+            else:
+                shutil.move(filename, path)
+        self.evict(keep=md5 + suffix)
+        return path
+
+    def _try_remove(self, key):
+        """
+        remove the entry unless it is in use (locked) by any process.  returns True if it was removed.
+        """
+        with open(self._lock_filename(key), 'a') as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+            try:
+                os.unlink(self._path(key))
+            except FileNotFoundError:
+                pass
+            return True
+
+    def evict(self, keep=None):
+        """
+        remove the least recently used files until the cache fits its byte budget, except the keep entry
+        and entries in use.  the cache may exceed its budget while larger entries are in use.
+        """
+        with self._lock('evict'):
+            entries = []
+            for entry in os.scandir(self.directory):
+                if entry.is_file() and not entry.name.endswith(('.tmp', '.tmp' + zstd_codec.COMPRESSED_SUFFIX)):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.name))
+            total = sum(size for _, size, _ in entries)
+            for mtime, size, key in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                if key != keep and self._try_remove(key):
+                    total -= size
+                    print("file cache: evicted", key)
+
+
+file_cache = FileCache(FILE_CACHE_DIR, FILE_CACHE_BYTES)
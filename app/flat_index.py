@@ -0,0 +1,147 @@
+# Jiggy exact (flat) index
+# Copyright (C) 2022 William S. Kish
+
+"""
+Exact nearest neighbor search over a contiguous float32 matrix using blocked matrix products.
+
+This serves the 'flat' target library, which is chosen automatically (when no hnswlib parameters are requested)
+for collections smaller than FLAT_MAX_VECTORS where building, testing and downloading an HNSW graph costs more than an exhaustive scan,
+and computes the ground truth and recall for testing hnswlib and ivfpq indexes.
+
+A flat index artifact is the application/x-npy vector encoding (see vector_codec): an int64 vector_id array
+followed by the float32 vector matrix.  Vectors of cosine indexes are normalized when the artifact is built,
+so searching it is a single matrix product per block.
+"""
+
+import numpy as np
+
+import vector_codec
+
+
+FLAT_MAX_VECTORS = 50000   # collections smaller than this get a flat index unless a library or hnswlib parameters are requested
+
+FLAT_BLOCK = 16384   # vectors per block of the exhaustive knn matrix product
+
+
+def _block_distances(queries, block, space):
+    """
+    the hnswlib distances of the space between each of the queries and each vector of the block.
+    cosine queries must already be normalized.
+    """
+    dots = queries @ block.T
+    if space == 'l2':
+        return (block*block).sum(axis=1)[None, :] - 2*dots + (queries*queries).sum(axis=1)[:, None]
+    if space == 'cosine':
+        norms = np.linalg.norm(block, axis=1)
+        norms[norms == 0] = 1
+        dots /= norms[None, :]
+    return 1 - dots
+
+
+def exact_knn(vectors, queries, k, space):
+    """
+    exhaustive k nearest neighbors of the queries among the vectors in the distance of the hnswlib space.
+    distances are computed one block of vectors at a time with a matrix product, keeping a running
+    top k, so memory is bounded by the block size rather than the collection size.
+    returns (indices, distances) arrays of shape (len(queries), k), with indices into vectors, nearest first.
+    """
+    queries = np.asarray(queries, dtype=np.float32)
+    if space == 'cosine':
+        norms = np.linalg.norm(queries, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        queries = queries / norms
+    k = min(k, len(vectors))
+    best_i = np.zeros((len(queries), 0), dtype=np.int64)
+    best_d = np.zeros((len(queries), 0), dtype=np.float32)
+    for start in range(0, len(vectors), FLAT_BLOCK):
+        d = _block_distances(queries, vectors[start:start+FLAT_BLOCK], space)
+        if d.shape[1] > k:
+            part = np.argpartition(d, k-1, axis=1)[:, :k]
+        else:
+            part = np.broadcast_to(np.arange(d.shape[1]), d.shape)
+        cand_i = np.concatenate([best_i, part + start], axis=1)
+        cand_d = np.concatenate([best_d, np.take_along_axis(d, part, axis=1)], axis=1)
+        order = np.argsort(cand_d, axis=1, kind='stable')[:, :k]
+        best_i = np.take_along_axis(cand_i, order, axis=1)
+        best_d = np.take_along_axis(cand_d, order, axis=1)
+    return best_i, best_d
+
+
+def recall(labels, truth):
+    """
+    the fraction of the true nearest neighbors found, over all queries.
+    labels and truth are (queries, k) arrays of vector ids.
+    """
+    return float((labels[:, :, None] == truth[:, None, :]).any(axis=2).sum()) / truth.size
+
+
+def hold_out(labels, self_labels, k):
+    """
+    remove each query's own label from its k+1 results, or the last result if it was not found,
+    returning the (queries, k) labels of the remaining nearest neighbors.
+    """
+    keep = labels != self_labels[:, None]
+    keep[keep.all(axis=1), -1] = False
+    return labels[keep].reshape(len(labels), k)
+
+
+def _normalize(vectors):
+    """
+    normalize the rows of the float32 vectors in place
+    """
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    vectors /= norms
+    return vectors
+
+
+class FlatIndex:
+    """
+    an exact index with the query interface of hnswlib.Index
+    """
+    def __init__(self, space, vectors, vids, normalized=False):
+        self.space = space
+        self.vids = vids
+        self.vectors = vectors
+        if space == 'cosine' and not normalized:
+            _normalize(self.vectors)
+
+    @classmethod
+    def load_index(cls, space, filename, mmap=False):
+        """
+        load a flat index artifact, or memory map it so that the vectors are paged in from the file as needed
+        """
+        if mmap:
+            vids, vectors = vector_codec.decode_npy(np.memmap(filename, dtype=np.uint8, mode='r'), validate=False)
+        else:
+            with open(filename, 'rb') as f:
+                vids, vectors = vector_codec.decode_npy(f.read())
+        return cls(space, vectors, vids, normalized=True)
+
+    def save_index(self, filename):
+        # the encode_npy format, written sequentially without an in-memory copy (filename may be a pipe)
+        with open(filename, 'wb') as f:
+            np.save(f, np.ascontiguousarray(self.vids, dtype=vector_codec.ID_DTYPE))
+            np.save(f, np.ascontiguousarray(self.vectors, dtype=vector_codec.VECTOR_DTYPE))
+
+    def get_current_count(self):
+        return len(self.vids)
+
+    def set_ef(self, ef):
+        pass   # exact search has no accuracy/speed tradeoff
+
+    def set_num_threads(self, num_threads):
+        pass   # numpy uses the BLAS thread pool
+
+    def knn_query(self, queries, k=1):
+        """
+        return the (vector_ids, distances) arrays of shape (len(queries), k) of the k nearest neighbors of each query
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        space = self.space
+        if space == 'cosine':
+            # the vectors are normalized, so cosine distance is inner product distance against normalized queries
+            queries = _normalize(queries.copy())
+            space = 'ip'
+        indices, distances = exact_knn(self.vectors, queries, k, space)
+        return self.vids[indices], distances
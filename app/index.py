@@ -14,184 +14,49 @@ import random
 from time import time
 import os
 from auth import verified_user_id_teams
-from sqlmodel import Session, select, delete, or_
+from sqlmodel import Session, select, delete, func, or_
 from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy.orm.exc import MultipleResultsFound
-from threading import Thread
-import hnswlib
-import psutil
 from decimal import Decimal
-import numpy as np
-from optimizer import optimize_hnswlib_params
 from s3 import  create_presigned_url, bucket
-import hashlib
-import subprocess
+import numpy as np
+from index_cache import index_cache
+from flat_index import FLAT_MAX_VECTORS
+from pq_index import IVFPQ_MIN_VECTORS, VECTORS_SUFFIX
+from zstd_codec import COMPRESSED_SUFFIX
+from changelog import prune_vector_changes
+from deletion import delete_index, library_objkeys
 
 from main import app, engine, token_auth_scheme
 
 from models import *
-   
-CPU_COUNT = psutil.cpu_count()
-
-
-# Get CPU details
-try:
-    # MACOS get CPU
-    CPU_INFO = str(subprocess.check_output(["sysctl", "-n", "machdep.cpu.brand_string"]).rstrip())
-except:
-    # linux get CPU
-    o = str(subprocess.check_output(['cat', '/proc/cpuinfo']))
-    m = [x for x in o.split("\\n") if "model name" in x]
-    CPU_INFO = m[0].split(":")[-1].lstrip()
-    
-print("CPU_INFO", CPU_INFO)
-
-
-
-###
-##  Index
-###
-def _test_index(index_id, vector_list, vids, hnsw_index, start_ef):
-    print("test index")
-    DIM = len(vector_list[0])
-    NUMVECTOR=len(vector_list)
-
-    brute_force_index = hnswlib.BFIndex(space=hnsw_index.space, dim=DIM)
-    brute_force_index.init_index(max_elements=NUMVECTOR)
-
-    brute_force_index.add_items(vector_list, vids)
-
-    test_elements = 200
-    top_k = 10
-
-    # create test vectors
-    query_data = np.float32(np.random.random((test_elements, DIM)))
-
-    labels_bf, distances_bf = brute_force_index.knn_query(query_data, top_k)
-
-    correct = 0
-    total = 0
-
-    ef = start_ef
-    while True:
-        hnsw_index.set_ef(ef)
-        # Query the elements and measure recall:
-        labels_hnsw, distances_hnsw = hnsw_index.knn_query(query_data, top_k)
-
-        # recall calc:
-        for i in range(test_elements):
-            correct += len(set(labels_hnsw[i]) & set(labels_bf[i]))
-            total   += len(set(labels_hnsw[i]))
-        recall = float(correct) / total
 
-        t0 = time()
-        N = 20
-        for i in range(N):                
-            hnsw_index.knn_query([query_data[i]], top_k)
-        qps = N / (time()-t0)
 
-        print("HNSW Search @ EF=%4d:  RECALL: %4.1f %%    QPS: %.1f" % (ef, 100*recall, qps))
+SHARD_MAX_VECTORS = 1000000   # collections larger than this are sharded automatically
 
-        result = IndexTest(index_id   = index_id,
-                           test_count = N,
-                           test_k     = top_k,
-                           recall     = recall,
-                           qps        = qps,
-                           cpu_info   = CPU_INFO,
-                           hnswlib_ef = ef)
-
-        with Session(engine) as session:
-            session.add(result)
-            session.commit()
-        if recall > .99 or ef >= NUMVECTOR and ef > hnsw_index.ef_construction:
-            break
-        ef *= 2
-    print("Test Complete")
-
-    
-    
-def _create_index(index):
-    with Session(engine) as session:
-        print("create_index:", index)
-        session.add(index)
-        index.build_status = "Preparing data for indexing."
-        index.state = IndexBuildState.prep
-        session.commit()
-        collection = session.get(Collection, index.collection_id)
-        statement = select(Vector).where(Vector.collection_id == index.collection_id)
-        vectors = list(session.exec(statement))
-
-        index.state = IndexBuildState.indexing
-        index.count = len(vectors)
-        # autoselect index parameters using learned model if target_recall has been specified
-        if index.target_recall:
-            index.build_status = "Autoselecting index parameters."
-            session.commit()
-            opt = optimize_hnswlib_params(collection.dimension, index.count, index.target_recall)
-            index.completed_at = time() + opt['creation_seconds']
-            index.hnswlib_M = opt['index_M']
-            index.hnswlib_ef = opt['index_ef_construction']
-            index.hnswlib_ef_search = opt['test_ef']
-
-        if index.hnswlib_ef_search is None:
-            index.hnswlib_ef_search = index.hnswlib_ef
-
-        index.build_status = "Index build of %d (dimension %d) vectors in progress." % (index.count,
-                                                                                        collection.dimension)
-        session.commit()
-        
-        t0 = time()
-        hnsw_index = hnswlib.Index(space=index.metric, dim=collection.dimension)
-        hnsw_index.set_num_threads(int(CPU_COUNT/2))
-        
-        hnsw_index.init_index(max_elements=index.count,
-                              ef_construction= index.hnswlib_ef,
-                              M=index.hnswlib_M)
-
-        vector_list = [v.vector for v in vectors]
-        vids = [v.vector_id for v in vectors]
-        hnsw_index.add_items(vector_list, vids)
-
-        # XXX add progress percentage update
-
-        index.build_status = "Saving index."
-        index.state = IndexBuildState.saving
-        session.commit()
-        HNSW_INDEX_CREATE_TIME = time()-t0
-        filename = "index-%d.hnsf" % index.id
-        hnsw_index.save_index(filename)
-        print("saved index md5=", hashlib.md5(open(filename,'rb').read()).hexdigest())
-        
-        INDEX_SIZE_BYTES = os.stat(filename).st_size
-        index.completed_at = time()
-        index.build_status = "Index build of %d (dimension %d) vectors completed in %.1f seconds generating %.1f MB index." % (index.count,
-                                                                                                                               collection.dimension,
-                                                                                                                               HNSW_INDEX_CREATE_TIME,
-                                                                                                                               INDEX_SIZE_BYTES/1024/1024)        
-        bucket.upload_file(filename, index.objkey)
-        index.state = IndexBuildState.testing
-        session.commit()
-        _test_index(index.id, vector_list, vids, hnsw_index, index.hnswlib_ef_search//2)
-        index.state = IndexBuildState.complete        
-        session.commit()
 
+def shard_objkey(objkey, shard, shards):
+    return f"{objkey}.shard-{shard}-of-{shards}"
 
-        
-def create_index(index):
-    try:
-        _create_index(index)
-        print("Complete Index:", index)
-    except Exception as e:
-        print("Exception:")
-        with Session(engine) as session:
-            print(e)
-            print(index)
-            index.completed_at = time()
-            index.state = IndexBuildState.failed
-            index.build_status = f"Index {index.id} failed to build.  Please contact support@jiggy.ai"
-            session.add(index)
-            session.commit()
 
+def index_response(session, index):
+    """
+    the IndexResponse for the index, including download urls for the index or its shards
+    """
+    def compressed_url(objkey):
+        if index.compression_level is None:
+            return None
+        return create_presigned_url(objkey + COMPRESSED_SUFFIX)
+
+    if index.shards == 1:
+        return IndexResponse(**index.dict(exclude={'shards'}),
+                             url=create_presigned_url(index.objkey),
+                             compressed_url=compressed_url(index.objkey))
+    statement = select(IndexShard).where(IndexShard.index_id == index.id).order_by(IndexShard.shard)
+    shards = [IndexShardResponse(**shard.dict(),
+                                 url=create_presigned_url(shard.objkey),
+                                 compressed_url=compressed_url(shard.objkey)) for shard in session.exec(statement)]
+    return IndexResponse(**index.dict(exclude={'shards'}), shards=shards)
 
 
 @app.post('/collections/{collection_id}/index', response_model=IndexResponse)
@@ -205,40 +70,97 @@ def post_index(token: str = Depends(token_auth_scheme),
     
     with Session(engine) as session:
         
-        # validate collection_id and user access to collection_id        
-        collection = session.get(Collection, collection_id)
-        if not collection or collection.team_id not in user_team_ids:
+        # validate collection_id and user access to collection_id
+        # the collection row lock orders the new index with concurrent writes (see changelog)
+        collection = session.get(Collection, collection_id, with_for_update=True)
+        if not collection or collection.deleting or collection.team_id not in user_team_ids:
             raise HTTPException(status_code=404, detail="Collection not found")
 
         team = session.get(Team, collection.team_id)
 
+        # small collections get an exact flat index unless a library or hnswlib parameters were requested
+        library = body.target_library
+        if library is None:
+            hnswlib_params = body.target_recall is not None or body.hnswlib_M is not None or body.hnswlib_ef is not None
+            if collection.count < FLAT_MAX_VECTORS and not hnswlib_params:
+                library = IndexLibraries.flat
+            else:
+                library = IndexLibraries.hnswlib
+        if library == IndexLibraries.hnswlib and body.target_recall is None and (body.hnswlib_M is None or body.hnswlib_ef is None):
+            raise HTTPException(status_code=400,
+                                detail="An hnswlib index requires target_recall, or both hnswlib_M and hnswlib_ef.")
+
         # create the new index
-        index = Index(**body.dict(exclude_unset=True),
-                      state=IndexBuildState.prep,
-                      build_status="Init",
+        index = Index(**body.dict(exclude_unset=True, exclude={'target_library'}),
+                      target_library = library,
+                      state=IndexBuildState.queued,
+                      build_status="Queued for build.",
                       completed_at = 0,    # doesn't work if set directly to a float or Decimal?  workaround below
                       name   = f"{team.name}/{collection.name}:{body.tag}",
-                      objkey = f"{team.name}/{collection.name}-{body.tag}.{body.target_library}",
+                      objkey = f"{team.name}/{collection.name}-{body.tag}.{library}",
                       collection_id = collection_id)
 
         # estimate completed_at time
         completed_at = time() + 1000
         index.completed_at = completed_at
 
+        # partition the index into shards of at most SHARD_MAX_VECTORS unless the shard count was specified
+        index.shards = body.shards or max(1, -(-collection.count // SHARD_MAX_VECTORS))
+        if library == IndexLibraries.ivfpq:
+            if collection.count // index.shards < IVFPQ_MIN_VECTORS:
+                raise HTTPException(status_code=400, detail="An ivfpq index requires at least %d vectors per shard." % IVFPQ_MIN_VECTORS)
+            if body.pq_m and collection.dimension % body.pq_m:
+                raise HTTPException(status_code=400, detail="pq_m must divide the vector dimension %d." % collection.dimension)
+
         # clear out any existing index with the same name (similar to docker image tags) just prior to adding the new index
         statement = select(Index).where(Index.collection_id == collection_id, Index.tag == body.tag)
         for old_index in session.exec(statement):
-            session.exec(delete(IndexTest).where(IndexTest.index_id == old_index.id))
-            session.delete(old_index)
-            bucket.delete(old_index.objkey)
+            if (body.incremental and
+                index.shards == old_index.shards == 1 and
+                old_index.state == IndexBuildState.complete and
+                old_index.target_library == IndexLibraries.hnswlib == library and
+                old_index.metric == body.metric):
+                # build from the previous index object, which the new index build overwrites in place
+                index.base_created_at = old_index.created_at
+                index.base_md5 = old_index.md5
+                index.deleted_elements = old_index.deleted_elements
+                if old_index.compression_level is not None and index.compression_level is None:
+                    # the new build overwrites the index object in place but will not replace the compressed artifact
+                    bucket.delete(old_index.objkey + COMPRESSED_SUFFIX)
+                index.hnswlib_M = old_index.hnswlib_M
+                index.hnswlib_ef = old_index.hnswlib_ef
+                index.hnswlib_ef_search = old_index.hnswlib_ef_search
+                delete_index(session, old_index, delete_object=False)
+            else:
+                delete_index(session, old_index)
         
         session.add(index)
+        session.flush()
+        # changes older than the remaining indexes are no longer needed by any incremental build
+        prune_vector_changes(session, collection.id)
+        # queue the build (or the build of each shard) for the index build workers
+        if index.shards == 1:
+            session.add(Job(kind = JobKind.index_build,
+                            state = JobState.queued,
+                            index_id = index.id,
+                            collection_id = collection.id))
+        else:
+            for shard in range(index.shards):
+                session.add(IndexShard(index_id = index.id,
+                                       shard = shard,
+                                       state = IndexBuildState.queued,
+                                       objkey = shard_objkey(index.objkey, shard, index.shards)))
+                session.add(Job(kind = JobKind.index_build,
+                                state = JobState.queued,
+                                index_id = index.id,
+                                shard = shard,
+                                collection_id = collection.id))
+        statement = select(func.count()).select_from(Job).where(Job.state == JobState.queued, Job.kind == JobKind.index_build)
+        queued = session.exec(statement).one()
+        index.build_status = f"Queued for build: position {queued} of {queued}."
         session.commit()
         session.refresh(index)
-    # create the response before we start the build thread in case there is an Exception creating the reponse.
-    response = IndexResponse(**index.dict())
-    Thread(target=create_index, args=(index,)).start()
-    return response
+        return index_response(session, index)
 
     
 @app.get('/collections/{collection_id}/index', response_model=CollectionsIndexGetResponse)
@@ -254,13 +176,13 @@ def get_collection_index(token: str = Depends(token_auth_scheme),
     with Session(engine) as session:
         # validate collection_id and user access to collection_id
         collection = session.get(Collection, collection_id)
-        if not collection or collection.team_id not in user_team_ids:
+        if not collection or collection.deleting or collection.team_id not in user_team_ids:
             raise HTTPException(status_code=404, detail="Collection not found")        
         if tag:
             statement = select(Index).where(Index.collection_id == collection_id, Index.tag ==tag)
         else:
             statement = select(Index).where(Index.collection_id == collection_id)
-        results = [IndexResponse(**r.dict(), url=create_presigned_url(r.objkey) ) for r in session.exec(statement)]
+        results = [index_response(session, r) for r in session.exec(statement)]
         if not results:
             raise HTTPException(status_code=404, detail="No matching index found.")
         return CollectionsIndexGetResponse(items=results)
@@ -277,7 +199,7 @@ def get_collection_index_tests(token: str = Depends(token_auth_scheme),
     with Session(engine) as session:
         # validate collection_id and user access to collection_id
         collection = session.get(Collection, collection_id)
-        if not collection or collection.team_id not in user_team_ids:
+        if not collection or collection.deleting or collection.team_id not in user_team_ids:
             raise HTTPException(status_code=404, detail="Collection not found")        
         statement = select(IndexTest).where(IndexTest.index_id == index_id)
         results = list(session.exec(statement))
@@ -285,3 +207,63 @@ def get_collection_index_tests(token: str = Depends(token_auth_scheme),
 
 
     
+
+
+MAX_QUERY_VECTORS = 1000
+
+
+def index_objkeys(session, index):
+    """
+    the (object key, md5) of the index file, or of each shard of a sharded index
+    """
+    if index.shards == 1:
+        return [(index.objkey, index.md5)]
+    statement = select(IndexShard.objkey, IndexShard.md5).where(IndexShard.index_id == index.id).order_by(IndexShard.shard)
+    return [tuple(row) for row in session.exec(statement)]
+
+
+@app.post('/collections/{collection_id}/index/{tag}/query', response_model=IndexQueryResponse)
+def post_index_query(token: str = Depends(token_auth_scheme),
+                     collection_id: str = Path(...),
+                     tag: str = Path(...),
+                     body: IndexQueryRequest = ...) -> IndexQueryResponse:
+    """
+    Query Index
+
+    Return the k nearest neighbors of each of a batch of query vectors using the index with the specified tag.
+    The index is searched at its hnswlib_ef_search.  While a new build of the tag is in progress, queries are
+    answered by the previous build if this server has it loaded.
+    """
+    user_id, user_team_ids = verified_user_id_teams(token)
+    if not body.vectors:
+        raise HTTPException(status_code=400, detail="Query batch is empty.")
+    if len(body.vectors) > MAX_QUERY_VECTORS:
+        raise HTTPException(status_code=400, detail="Largest supported query batch is %d vectors." % MAX_QUERY_VECTORS)
+    with Session(engine) as session:
+        collection = session.get(Collection, collection_id)
+        if not collection or collection.deleting or collection.team_id not in user_team_ids:
+            raise HTTPException(status_code=404, detail="Collection not found")
+        if any(len(v) != collection.dimension for v in body.vectors):
+            raise HTTPException(status_code=400,
+                                detail="Query vector dimension mismatches collection dimension of %d." % collection.dimension)
+        index = session.exec(select(Index).where(Index.collection_id == collection_id, Index.tag == tag)).first()
+        if not index:
+            raise HTTPException(status_code=404, detail="No matching index found.")
+        key = (collection.id, tag)
+        dimension = collection.dimension
+        objkeys = None
+        if index.state == IndexBuildState.complete:
+            objkeys = index_objkeys(session, index)
+        else:
+            cached = index_cache.peek(key)
+            if cached is None:
+                raise HTTPException(status_code=409, detail="Index is not built yet: %s" % index.build_status)
+    if objkeys is not None:
+        # loaded after the session is closed, so a long download does not hold a database connection
+        cached = index_cache.get(key, index, dimension, objkeys)
+    vector_ids, distances = cached.knn_query(np.asarray(body.vectors, dtype=np.float32), body.k)
+    # an ivfpq index may find fewer than k neighbors of a query; its missing neighbors have infinite distance
+    found = np.isfinite(distances)
+    return IndexQueryResponse(index_id = cached.index_id,
+                              vector_ids = [row[f].tolist() for row, f in zip(vector_ids, found)],
+                              distances = [row[f].tolist() for row, f in zip(distances, found)])
@@ -0,0 +1,167 @@
+# Jiggy in-memory index cache
+# Copyright (C) 2022 William S. Kish
+
+"""
+A process-level LRU cache of built indexes loaded from the bucket for server-side queries.
+Index files are fetched through the node-local file cache (see file_cache), so the processes of a node
+download each index once.
+
+The cache is bounded by the total size of the loaded index files (JIGGY_INDEX_CACHE_BYTES).  Entries are
+keyed by (collection_id, tag) and remember the build they were loaded from, so a newer completed build of
+the tag replaces the cached one on its next query.  Sharded indexes are cached as one entry holding all of
+their shards; queries search every shard and merge the results by distance.
+"""
+
+import os
+import tempfile
+import threading
+from contextlib import ExitStack, nullcontext
+from collections import OrderedDict
+import numpy as np
+import hnswlib
+
+from s3 import bucket
+from file_cache import file_cache
+from flat_index import FlatIndex
+from pq_index import IVFPQIndex, VECTORS_SUFFIX
+from models import *
+
+
+INDEX_CACHE_BYTES = int(os.environ.get('JIGGY_INDEX_CACHE_BYTES', 2*1024**3))
+
+
+class CachedIndex:
+    """
+    a loaded hnswlib, flat or ivfpq index (all shards of a sharded index) ready for queries
+    """
+    def __init__(self, index, dimension, objkeys):
+        self.index_id = index.id
+        self.created_at = index.created_at
+        self.count = index.count
+        self.dimension = dimension
+        self.nbytes = 0
+        self.shards = []
+        self.live_counts = []   # the searchable (not marked deleted) elements of each shard
+        with tempfile.TemporaryDirectory() as tmpdir:
+            def fetch(i, objkey, md5, suffix=''):
+                """
+                a context manager yielding the local filename of the object, which is valid within it
+                """
+                # indexes built before md5s were recorded bypass the node-local file cache
+                if md5 is not None:
+                    # only the index itself has a compressed artifact
+                    compressed = index.compression_level is not None and not suffix
+                    return file_cache.open(bucket, objkey, md5, suffix, compressed)
+                filename = os.path.join(tmpdir, "index-%d%s" % (i, suffix))
+                bucket.download_file(objkey + suffix, filename)
+                return nullcontext(filename)
+
+            for i, (objkey, md5) in enumerate(objkeys):
+                # the cached files are loaded while they are held, so they can not be evicted in the meantime
+                with ExitStack() as held:
+                    filename = held.enter_context(fetch(i, objkey, md5))
+                    self.nbytes += os.stat(filename).st_size
+                    if index.target_library == IndexLibraries.flat:
+                        # memory mapped, so the processes of the node share one page cache copy of the cached file
+                        shard = FlatIndex.load_index(index.metric, filename, mmap=True)
+                    elif index.target_library == IndexLibraries.ivfpq:
+                        # the full vectors used for re-ranking are memory mapped rather than counted against the cache
+                        vectors_filename = held.enter_context(fetch(i, objkey, md5, VECTORS_SUFFIX))
+                        shard = IVFPQIndex.load_index(index.metric, filename, vectors_filename)
+                        shard.set_ef(index.ivf_nprobe or 1)
+                    else:
+                        # hnswlib reads the file into its own memory
+                        shard = hnswlib.Index(space=index.metric, dim=dimension)
+                        shard.load_index(filename)
+                        shard.set_ef(index.hnswlib_ef_search or index.hnswlib_ef)
+                self.shards.append(shard)
+                live = shard.get_current_count()
+                if index.shards == 1:
+                    # elements marked deleted by incremental updates are counted by hnswlib but never returned
+                    live = min(live - (index.deleted_elements or 0), index.count)
+                self.live_counts.append(max(live, 0))
+
+    def knn_query(self, queries, k):
+        """
+        return the (vector_ids, distances) arrays of shape (len(queries), k) of the k nearest neighbors
+        of each query across all shards, nearest first.  k is limited to the number of vectors in the index,
+        and fewer than k may be returned by an index with many elements marked deleted.
+        """
+        k = min(k, self.count)
+        labels, distances = [], []
+        for shard, live in zip(self.shards, self.live_counts):
+            shard_k = min(k, live)
+            while shard_k:
+                try:
+                    shard_labels, shard_distances = shard.knn_query(queries, shard_k)
+                    break
+                except RuntimeError:
+                    # hnswlib found fewer than shard_k live neighbors of some query (its search
+                    # skips elements marked deleted); return as many as it can find for every query
+                    shard_k //= 2
+            if shard_k:
+                labels.append(shard_labels.astype(np.int64))
+                distances.append(shard_distances)
+        if not labels:
+            return np.zeros((len(queries), 0), dtype=np.int64), np.zeros((len(queries), 0), dtype=np.float32)
+        labels = np.concatenate(labels, axis=1)
+        distances = np.concatenate(distances, axis=1)
+        if len(self.shards) > 1:
+            order = np.argsort(distances, axis=1, kind='stable')[:, :k]
+            labels = np.take_along_axis(labels, order, axis=1)
+            distances = np.take_along_axis(distances, order, axis=1)
+        return labels, distances
+
+
+class IndexCache:
+    """
+    LRU cache of CachedIndex keyed by (collection_id, tag), bounded by total index bytes
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.load_locks = {}   # key -> lock held while the key's index is loading, so it is only downloaded once
+
+    def peek(self, key):
+        """
+        return the cached entry for the key, whatever build it was loaded from, or None
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def get(self, key, index, dimension, objkeys):
+        """
+        return the cached entry for the key, loading it (via the node-local file cache) if it is missing
+        or was loaded from a different build than the specified completed index
+        """
+        entry = self.peek(key)
+        if entry is not None and entry.index_id == index.id:
+            return entry
+        with self.lock:
+            load_lock = self.load_locks.setdefault(key, threading.Lock())
+        with load_lock:
+            entry = self.peek(key)
+            if entry is not None and entry.index_id == index.id:
+                return entry
+            entry = CachedIndex(index, dimension, objkeys)
+            print("index cache: loaded index %d (%.1f MB)" % (index.id, entry.nbytes/1024/1024))
+            with self.lock:
+                old = self.entries.pop(key, None)
+                if old is not None:
+                    self.nbytes -= old.nbytes
+                self.entries[key] = entry
+                self.nbytes += entry.nbytes
+                # evict least recently used entries, but always keep the entry just loaded
+                while self.nbytes > self.max_bytes and len(self.entries) > 1:
+                    evicted_key, evicted = self.entries.popitem(last=False)
+                    self.nbytes -= evicted.nbytes
+                    print("index cache: evicted index %d" % evicted.index_id)
+            return entry
+
+
+index_cache = IndexCache(INDEX_CACHE_BYTES)
@@ -0,0 +1,290 @@
+# Jiggy database migrations
+# Copyright (C) 2022 William S. Kish
+
+"""
+SQLModel.metadata.create_all() creates missing tables but does not alter existing ones.
+This script applies the schema changes needed by existing deployments.  Every step is idempotent,
+so it is safe to run against a database at any version:
+
+    python migrate.py
+
+It also converts the vectors of an existing collection to a different vector storage mode
+(array, float32 or float16) in bounded batches while the collection remains online:
+
+    python migrate.py convert COLLECTION_ID float32
+"""
+
+import sys
+from sqlalchemy import text
+from sqlmodel import Session, select
+
+from db import engine
+from models import *
+import vector_codec
+
+
+CONVERT_BATCH = 10000
+
+
+def add_columns(connection, table, columns):
+    """
+    add the (name, sql type) columns to the table if they do not already exist
+    """
+    for name, sqltype in columns:
+        connection.execute(text('ALTER TABLE "%s" ADD COLUMN IF NOT EXISTS %s %s' % (table, name, sqltype)))
+
+
+def dedup_vectors(connection):
+    """
+    remove duplicate (collection_id, vector_id) rows, keeping the most recently inserted row.
+    """
+    result = connection.execute(text("""
+        DELETE FROM vector a USING vector b
+        WHERE a.collection_id = b.collection_id AND a.vector_id = b.vector_id AND a.id < b.id
+    """))
+    print("removed %d duplicate vectors" % result.rowcount)
+
+
+def create_vector_unique_index(connection):
+    """
+    create the unique (collection_id, vector_id) index required by the bulk loader merge
+    """
+    # a failed concurrent build leaves an invalid index behind that IF NOT EXISTS would skip over
+    connection.execute(text("""
+        DO $$ BEGIN
+            IF EXISTS (SELECT 1 FROM pg_index WHERE indexrelid = to_regclass('ix_vector_collection_id_vector_id') AND NOT indisvalid) THEN
+                DROP INDEX ix_vector_collection_id_vector_id;
+            END IF;
+        END $$
+    """))
+    connection.execute(text("""
+        CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS ix_vector_collection_id_vector_id
+        ON vector (collection_id, vector_id)
+    """))
+
+
+def add_vector_storage(connection):
+    """
+    add the packed bytea vector column and the per-collection vector storage mode.
+    existing collections keep their real[] array storage until they are converted.
+    """
+    connection.execute(text("""
+        DO $$ BEGIN
+            CREATE TYPE vectorstorage AS ENUM ('array', 'float32', 'float16');
+        EXCEPTION WHEN duplicate_object THEN null;
+        END $$
+    """))
+    connection.execute(text("ALTER TABLE collection ADD COLUMN IF NOT EXISTS vector_storage vectorstorage DEFAULT 'array'"))
+    connection.execute(text("ALTER TABLE vector ADD COLUMN IF NOT EXISTS vector_data bytea"))
+    # packed floats are incompressible; skip the pglz compression attempt when they are toasted
+    connection.execute(text("ALTER TABLE vector ALTER COLUMN vector_data SET STORAGE EXTERNAL"))
+
+
+def add_queued_index_state(connection):
+    """
+    index builds are queued for the build workers before they start
+    """
+    connection.execute(text("ALTER TYPE indexbuildstate ADD VALUE IF NOT EXISTS 'queued' BEFORE 'prep'"))
+
+
+def add_incremental_index(connection):
+    """
+    incremental index builds record the previous index they were built from
+    """
+    add_columns(connection, 'index', [('incremental', 'boolean NOT NULL DEFAULT false'),
+                                      ('base_created_at', 'numeric(14, 3)')])
+
+
+def add_index_shards(connection):
+    """
+    indexes may be partitioned into shards built by separate jobs
+    """
+    add_columns(connection, 'index', [('shards', 'integer NOT NULL DEFAULT 1')])
+    add_columns(connection, 'indextest', [('shard', 'integer')])
+    add_columns(connection, 'job', [('shard', 'integer')])
+
+
+def add_test_queries(connection):
+    """
+    collections may have an uploaded query set for index testing
+    """
+    add_columns(connection, 'collection', [('test_queries_objkey', 'varchar')])
+
+
+def add_index_test_latency(connection):
+    """
+    index tests record query latency percentiles and multithreaded batch throughput
+    """
+    add_columns(connection, 'indextest', [('latency_p50', 'float'),
+                                          ('latency_p95', 'float'),
+                                          ('latency_p99', 'float'),
+                                          ('batch_qps', 'json')])
+
+
+def add_index_budgets(connection):
+    """
+    indexes record the optimizer budgets they were requested with and the optimizer's predictions
+    """
+    add_columns(connection, 'index', [('max_latency_seconds', 'float'),
+                                      ('max_index_bytes', 'bigint'),
+                                      ('max_build_seconds', 'float'),
+                                      ('predicted_recall', 'float'),
+                                      ('predicted_latency_seconds', 'float'),
+                                      ('predicted_index_bytes', 'bigint'),
+                                      ('predicted_build_seconds', 'float')])
+
+
+def add_index_build_measurements(connection):
+    """
+    indexes and index shards record their measured size and build time, for optimizer retraining
+    """
+    for table in ['index', 'indexshard']:
+        add_columns(connection, table, [('index_bytes', 'bigint'),
+                                        ('build_seconds', 'float')])
+
+
+def add_flat_index_library(connection):
+    """
+    flat (exact search) indexes
+    """
+    connection.execute(text("ALTER TYPE indexlibraries ADD VALUE IF NOT EXISTS 'flat'"))
+
+
+def add_ivfpq_index_library(connection):
+    """
+    product quantized faiss IVF-PQ indexes
+    """
+    connection.execute(text("ALTER TYPE indexlibraries ADD VALUE IF NOT EXISTS 'ivfpq'"))
+    add_columns(connection, 'index', [('pq_m', 'integer'),
+                                      ('ivf_nlist', 'integer'),
+                                      ('ivf_nprobe', 'integer')])
+
+
+def add_index_md5(connection):
+    """
+    indexes and index shards record the md5 of their objects, which keys the node-local index file cache
+    """
+    add_columns(connection, 'index', [('md5', 'varchar'),
+                                      ('base_md5', 'varchar')])
+    add_columns(connection, 'indexshard', [('md5', 'varchar')])
+
+
+def add_index_compression(connection):
+    """
+    indexes may also be stored as zstd compressed artifacts
+    """
+    add_columns(connection, 'index', [('compression_level', 'integer'),
+                                      ('compressed_bytes', 'bigint')])
+    add_columns(connection, 'indexshard', [('compressed_bytes', 'bigint')])
+
+
+def add_collection_delete_job(connection):
+    """
+    collections are deleted asynchronously by collection_delete jobs
+    """
+    connection.execute(text("ALTER TYPE jobkind ADD VALUE IF NOT EXISTS 'collection_delete'"))
+    add_columns(connection, 'collection', [('deleting', 'boolean NOT NULL DEFAULT false'),
+                                           ('delete_status', 'varchar')])
+
+
+def add_index_deleted_elements(connection):
+    """
+    hnswlib indexes record their elements marked deleted by incremental updates
+    """
+    add_columns(connection, 'index', [('deleted_elements', 'integer')])
+
+
+def add_bigint_vector_ids(connection):
+    """
+    vector_ids are bigint, the int64 ids of the binary ingest formats.
+    converting an existing integer column rewrites the table under an exclusive lock.
+    """
+    for table in ['vector', 'vectorchange']:
+        data_type = connection.execute(text("""
+            SELECT data_type FROM information_schema.columns WHERE table_name = :table AND column_name = 'vector_id'
+        """).bindparams(table=table)).scalar()
+        if data_type == 'integer':
+            connection.execute(text('ALTER TABLE "%s" ALTER COLUMN vector_id TYPE bigint' % table))
+
+
+MIGRATIONS = [dedup_vectors,
+              create_vector_unique_index,
+              add_vector_storage,
+              add_queued_index_state,
+              add_incremental_index,
+              add_index_shards,
+              add_test_queries,
+              add_index_test_latency,
+              add_index_budgets,
+              add_index_build_measurements,
+              add_flat_index_library,
+              add_ivfpq_index_library,
+              add_index_md5,
+              add_index_compression,
+              add_collection_delete_job,
+              add_index_deleted_elements,
+              add_bigint_vector_ids]
+
+
+def migrate():
+    # new tables are created with all of their columns
+    SQLModel.metadata.create_all(engine)
+    # CREATE INDEX CONCURRENTLY can not run inside a transaction block
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        for migration in MIGRATIONS:
+            print("migrate:", migration.__name__)
+            migration(connection)
+
+
+def convert_collection(collection_id, storage):
+    """
+    convert all vectors of the collection to the specified vector storage mode.
+    The collection's vector_storage is switched first so that new writes use the new mode
+    while existing rows are converted in batches; readers handle both representations.
+    """
+    storage = VectorStorage(storage)
+    with Session(engine) as session:
+        collection = session.get(Collection, collection_id)
+        if not collection:
+            raise ValueError("Collection %s not found" % collection_id)
+        collection.vector_storage = storage
+        session.add(collection)
+        session.commit()
+        dimension = collection.dimension
+        packed_dtype = vector_codec.storage_dtype(storage)
+        last_id = 0
+        converted = 0
+        while True:
+            statement = select(Vector.id, Vector.created_at, Vector.vector, Vector.vector_data)
+            statement = statement.where(Vector.collection_id == collection_id, Vector.id > last_id)
+            statement = statement.order_by(Vector.id).limit(CONVERT_BATCH)
+            rows = session.exec(statement).all()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            updates = []
+            for id, created_at, vector, vector_data in rows:
+                if packed_dtype is None:
+                    if vector_data is None:
+                        continue
+                    new_vector, new_data = vector_codec.unpack_vector(vector, vector_data, dimension).tolist(), None
+                else:
+                    if vector_data is not None and len(vector_data) == dimension * packed_dtype.itemsize:
+                        continue
+                    new_vector = None
+                    new_data = vector_codec.pack_vector(vector_codec.unpack_vector(vector, vector_data, dimension), storage)
+                updates.append({'id': id, 'created_at': created_at, 'vector': new_vector, 'vector_data': new_data})
+            if updates:
+                # a vector replaced concurrently gets a new created_at and is left alone
+                session.execute(text("UPDATE vector SET vector = :vector, vector_data = :vector_data "
+                                     "WHERE id = :id AND created_at = :created_at"), updates)
+                session.commit()
+            converted += len(updates)
+            print("converted %d vectors" % converted)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 4 and sys.argv[1] == 'convert':
+        convert_collection(int(sys.argv[2]), sys.argv[3])
+    else:
+        migrate()
@@ -1,6 +1,7 @@
 from typing import Optional, List
 
-from sqlmodel import Field, SQLModel, Column, ARRAY, Float, Enum
+from sqlmodel import Field, SQLModel, Column, ARRAY, Float, Enum, LargeBinary, BigInteger, JSON
+from sqlalchemy import Index as DbIndex
 from pydantic import EmailStr, BaseModel, ValidationError, validator
 from array import array
 from pydantic import condecimal
@@ -30,6 +31,18 @@ def _is_valid_namestr(checkstr, display):
 ##  Collection
 ###
 
+class VectorStorage(str, enum.Enum):
+    """
+    How the vectors of a collection are stored in the database.
+    'array' stores a real[] per vector.
+    'float32' and 'float16' store packed little-endian bytea, which avoids building python float lists
+    on read; float16 halves the storage size at reduced precision.
+    """
+    array   = 'array'
+    float32 = 'float32'
+    float16 = 'float16'
+
+
 class Collection(SQLModel, table=True):
     
     id: int = Field(default=None,
@@ -43,6 +56,12 @@ class Collection(SQLModel, table=True):
     count: int             = Field(default=0, description="The number of vectors in the collection")
     created_at: timestamp = Field(default_factory=time, description='The epoch timestamp when the collection was created.')
     updated_at: timestamp = Field(default_factory=time, description='The epoch timestamp when the collection was updated.')
+    vector_storage: VectorStorage = Field(default=VectorStorage.float32,
+                                          sa_column=Column(Enum(VectorStorage)),
+                                          description="How the collection's vectors are stored in the database.")
+    test_queries_objkey: Optional[str] = Field(default=None, description="The object store key of the uploaded query set used to test the collection's indexes, if any.")
+    deleting: bool = Field(default=False, description="True once the collection has been deleted, while its vectors and indexes are being removed.  The collection is gone once this completes.")
+    delete_status: Optional[str] = Field(default=None, description="Informational status message for the deletion of the collection.")
 
     @validator('name')
     def _name(cls, v):
@@ -53,6 +72,7 @@ class CollectionPostRequest(BaseModel):
     
     name:   str = Field(description="The Collection's unique name within the team context.")
     team_id: Optional[int]  = Field(default=None, description="The team that this collection is associated with. If unspecified will use the users default team.")
+    vector_storage: VectorStorage = Field(default=VectorStorage.float32, description="How the collection's vectors are stored: 'float32' (default), 'float16' or 'array'.")
     @validator('name')
     def _name(cls, v):
         _is_valid_namestr(v, 'name')
@@ -72,6 +92,9 @@ class CollectionsGetResponse(BaseModel):
 
     
 class Vector(SQLModel, table=True):
+    # vector_id is unique within a collection; the bulk loader merges on this index with INSERT ... ON CONFLICT
+    __table_args__ = (DbIndex('ix_vector_collection_id_vector_id', 'collection_id', 'vector_id', unique=True),)
+
     id: int = Field(default=None,
                     primary_key=True,
                     description='Unique database identifier for a given vector. This is not the user-supplied identifier')
@@ -82,13 +105,54 @@ class Vector(SQLModel, table=True):
 
     created_at: timestamp = Field(default_factory=time, description='The epoch timestamp when the vector was created.')
     
-    vector: List[float] = Field(sa_column=Column(ARRAY(Float(24))), description='The user-supplied vector element.')
-    vector_id:  int     = Field(index=True, description='The user-supplied id for this vector element.')
+    vector: Optional[List[float]] = Field(default=None, sa_column=Column(ARRAY(Float(24))), description='The user-supplied vector element, for collections with array vector storage.')
+    vector_data: Optional[bytes]  = Field(default=None, sa_column=Column(LargeBinary), description='The user-supplied vector element packed as little-endian float32 or float16, for collections with packed vector storage.')
+    vector_id:  int     = Field(sa_column=Column(BigInteger, index=True), description='The user-supplied id for this vector element.')
+
+
+class VectorChangeOp(str, enum.Enum):
+    insert = 'insert'
+    delete = 'delete'
+
+
+class VectorChange(SQLModel, table=True):
+    """
+    Log of vector inserts (including replacements) and deletes per collection,
+    used to compute the delta for incremental index builds.
+    """
+    __table_args__ = (DbIndex('ix_vectorchange_collection_id_created_at', 'collection_id', 'created_at'),)
+
+    id: int = Field(default=None, primary_key=True, description='Unique database identifier for this change.')
+    collection_id: int = Field(description='The collection that the changed vector belongs to.')
+    vector_id:     int = Field(sa_column=Column(BigInteger), description='The user-supplied id of the changed vector.')
+    op: VectorChangeOp = Field(sa_column=Column(Enum(VectorChangeOp)), description='The change made to the vector.')
+    created_at: timestamp = Field(default_factory=time, description='The epoch timestamp of the change.')
 
 
 class  VectorPostRequest(BaseModel):
     vector: List[float] = Field(description='The user-supplied vector element.')
 
+
+class VectorBatchItem(BaseModel):
+    vector_id:  int     = Field(description='The user-supplied id for this vector element.')
+    vector: List[float] = Field(description='The user-supplied vector element.')
+
+
+class VectorBatchPostRequest(BaseModel):
+    items: List[VectorBatchItem] = Field(description='The vectors to create or replace.  A vector_id that already exists in the collection is replaced.')
+
+
+class TestQueriesResponse(BaseModel):
+    collection_id: int = Field(description="The collection the test queries were uploaded to.")
+    count: int = Field(description="The number of query vectors in the uploaded test query set.")
+
+
+class VectorBatchResponse(BaseModel):
+    collection_id: int = Field(description='The collection that the vectors were added to.')
+    count:         int = Field(description='The number of vectors in the batch that were created or replaced.')
+    created:       int = Field(description='The number of vectors in the batch that were new to the collection.')
+    collection_count: int = Field(description='The number of vectors in the collection after the batch was applied.')
+
     
 class VectorResponse(BaseModel):
     collection_id: int = Field(description='The collection that this vector belongs to.')
@@ -106,9 +170,13 @@ class VectorResponse(BaseModel):
 class IndexLibraries(str, enum.Enum):
     """
     The library used to create the index.
-    Currently only 'hnswlib' is supported.
+    'hnswlib' builds an approximate HNSW graph index.
+    'flat' stores the vectors for exact exhaustive search, which is faster to build and search for small collections.
+    'ivfpq' builds a compact product quantized faiss IVF-PQ index with exact re-ranking, for memory-bound deployments.
     """
     hnswlib = 'hnswlib'
+    flat    = 'flat'
+    ivfpq   = 'ivfpq'
 
 
 class DistanceMetric(str, enum.Enum):
@@ -120,6 +188,7 @@ class DistanceMetric(str, enum.Enum):
     l2     = 'l2'
 
 class IndexBuildState(str, enum.Enum):
+    queued   = "queued for build"
     prep     = "preparing data"
     indexing = "indexing vectors"
     saving   = "saving index"
@@ -145,7 +214,20 @@ class Index(SQLModel, table=True):
     hnswlib_M:  Optional[int]   = Field(default=None, ge=2, description="The M value passed to hnswlib when creating the index.")
     hnswlib_ef: Optional[int]   = Field(default=None, ge=10, description="The ef_construction value passed to hnswlib when creating the index.")
     hnswlib_ef_search: Optional[int] = Field(default=None, ge=10, description="The recommended ef value to use at search time.")
+    pq_m: Optional[int] = Field(default=None, description="The product quantization code size in bytes per vector of an ivfpq index.")
+    ivf_nlist: Optional[int] = Field(default=None, description="The number of inverted lists of an ivfpq index.")
+    ivf_nprobe: Optional[int] = Field(default=None, description="The recommended number of inverted lists to probe at search time for an ivfpq index.")
     target_recall: Optional[float] = Field(default=None, ge=0.5, le=1, description="The desired recall value to target for index parameter optimization.")
+    max_latency_seconds: Optional[float] = Field(default=None, description="The query latency budget for index parameter optimization.")
+    max_index_bytes: Optional[int] = Field(default=None, sa_column=Column(BigInteger), description="The index size budget for index parameter optimization.")
+    max_build_seconds: Optional[float] = Field(default=None, description="The build time budget for index parameter optimization.")
+    predicted_recall: Optional[float] = Field(default=None, description="The recall predicted by the optimizer for the selected parameters.")
+    predicted_latency_seconds: Optional[float] = Field(default=None, description="The query latency predicted by the optimizer for the selected parameters.")
+    predicted_index_bytes: Optional[int] = Field(default=None, sa_column=Column(BigInteger), description="The index size predicted by the optimizer for the selected parameters (per shard for sharded indexes).")
+    predicted_build_seconds: Optional[float] = Field(default=None, description="The build time predicted by the optimizer for the selected parameters (per shard for sharded indexes).")
+    incremental: bool = Field(default=False, description="True if this index was requested as an incremental update of the previous index with the same tag.")
+    base_created_at: Optional[timestamp] = Field(default=None, description="The created_at of the previous index this index is incrementally built from, if any.")
+    base_md5: Optional[str] = Field(default=None, description="The md5 of the previous index object this index is incrementally built from, if known.")
     
     count: int = Field(default=0, description="The number of vectors included in the index.  The number of vectors in the collection at the time of index build.")
 
@@ -153,26 +235,74 @@ class Index(SQLModel, table=True):
     state: IndexBuildState = Field(sa_column=Column(Enum(IndexBuildState)))
     completed_at: timestamp = Field(description='The epoch timestamp when the index build was completed.')
     build_status: str     = Field(description='Informational status message for the index build.')
-    # TODO: add index size in bytes and index shasum
     objkey: str = Field(description='The index key name in object store')        
+    md5: Optional[str] = Field(default=None, description='The md5 hex digest of the index object.  None for sharded indexes, see IndexShard.')
+    compression_level: Optional[int] = Field(default=None, description='The zstd level of the compressed index artifact stored alongside the index, or None if the index is stored uncompressed only.')
+    compressed_bytes: Optional[int] = Field(default=None, sa_column=Column(BigInteger), description='The size of the compressed index artifact in bytes (the total of all shards for sharded indexes; see the shards for the size of each).')
+    index_bytes: Optional[int] = Field(default=None, sa_column=Column(BigInteger), description='The size of the built index in bytes (the total of all shards for sharded indexes; see the shards for the size of each).')
+    build_seconds: Optional[float] = Field(default=None, description='The measured time to build the index, excluding loading and saving.')
+    shards: int = Field(default=1, description='The number of shards the index is partitioned into.  Sharded indexes are stored as one object per shard (see IndexShard).')
+    deleted_elements: Optional[int] = Field(default=None, description='The number of hnswlib graph elements marked deleted by incremental updates, which still occupy the index.')
     
     @validator('tag')
     def _tag(cls, v):
         _is_valid_namestr(v, 'tag')
         return v
 
+
+class IndexShard(SQLModel, table=True):
+    """
+    One partition of a sharded index.  Vectors are assigned to shards by a hash of their vector_id
+    and each shard is built independently as a separate index object.
+    """
+    id: int = Field(default=None,
+                    primary_key=True,
+                    description='Unique database identifier for a given index shard')
+    index_id: int = Field(index=True, description='The sharded index this shard belongs to.')
+    shard:    int = Field(description='The shard number, from 0 to Index.shards-1.')
+    count:    int = Field(default=0, description='The number of vectors included in this shard.')
+    state: IndexBuildState = Field(sa_column=Column(Enum(IndexBuildState)))
+    completed_at: timestamp = Field(default=0, description='The epoch timestamp when the shard build was completed.')
+    build_status: str     = Field(default='', description='Informational status message for the shard build.')
+    objkey: str = Field(description='The shard index key name in object store')
+    md5: Optional[str] = Field(default=None, description='The md5 hex digest of the shard index object.')
+    compressed_bytes: Optional[int] = Field(default=None, sa_column=Column(BigInteger), description='The size of the compressed shard index artifact in bytes.')
+    index_bytes: Optional[int] = Field(default=None, sa_column=Column(BigInteger), description='The size of the built shard index in bytes.')
+    build_seconds: Optional[float] = Field(default=None, description='The measured time to build the shard index, excluding loading and saving.')
+
+
+class IndexShardResponse(BaseModel):
+    shard: int = Field(description='The shard number, from 0 to shards-1.')
+    count: int = Field(description='The number of vectors included in this shard.')
+    state: IndexBuildState = Field(description = "The current build status.")
+    url: Optional[str] = Field(default=None, description='The url the shard index can be downloaded from. The url is valid for a limited time.')
+    md5: Optional[str] = Field(default=None, description='The md5 hex digest of the shard index object, for verifying downloads.')
+    index_bytes: Optional[int] = Field(default=None, description='The size of the shard index in bytes.')
+    compressed_bytes: Optional[int] = Field(default=None, description='The size of the compressed shard index artifact in bytes, if any.')
+    compressed_url: Optional[str] = Field(default=None, description='The url the zstd compressed shard index can be downloaded from, if the index was built with a compression_level. The url is valid for a limited time.')
+
     
 class IndexRequest(BaseModel):
     tag: str = Field(default='latest', description="User tag for this Index.  Uniquely identifies an index in the context of a collection.")
-    target_library:    IndexLibraries = Field(default=IndexLibraries.hnswlib, description="The library use to create the index")
+    target_library:    Optional[IndexLibraries] = Field(default=None, description="The library use to create the index.  If unspecified, 'hnswlib' is used, except that 'flat' is used for collections smaller than 50000 vectors if none of target_recall, hnswlib_M and hnswlib_ef are specified.")
     metric:     Optional[str] = Field(default='cosine', description='The distance metric ("space" in hnswlib): "cosine", "ip", or "l2"')
     hnswlib_M:  Optional[int]  = Field(default=None, description="The M value passed to hnswlib when creating the index.")
     hnswlib_ef: Optional[int]  = Field(default=None, description="The ef_construction value passed to hnswlib when creating the index")
+    pq_m: Optional[int] = Field(default=None, ge=1, description="The product quantization code size in bytes per vector for an ivfpq index.  Must divide the vector dimension.  If unspecified it is sized by max_index_bytes, or for 16x compression of the vectors.")
     target_recall: Optional[float] = Field(default=None, description="The desired recall value to target for index parameter optimization.")
+    max_latency_seconds: Optional[float] = Field(default=None, gt=0, description="Optional single query latency budget for index parameter optimization.  Requires target_recall.")
+    max_index_bytes: Optional[int] = Field(default=None, gt=0, description="Optional index size budget (per shard for sharded indexes) for index parameter optimization.  Requires target_recall.")
+    max_build_seconds: Optional[float] = Field(default=None, gt=0, description="Optional build time budget (per shard for sharded indexes) for index parameter optimization.  Requires target_recall.")
+    incremental: bool = Field(default=False, description="Update the previous completed index with the same tag with the vectors changed since it was built, rather than building from scratch.  The previous index parameters are kept.  Falls back to a full build if there is no usable previous index.")
+    shards: Optional[int] = Field(default=None, ge=1, le=256, description="The number of shards to partition the index into, each built in parallel.  If unspecified, collections are sharded automatically by size.")
+    compression_level: Optional[int] = Field(default=None, ge=1, le=22, description="If specified, a zstd compressed artifact of the index is also stored at this zstd level, for smaller downloads.  It is compressed in independent frames with a seek table (the zstd seekable format), so it can be decompressed by any zstd tool or in parallel.")
 
     @validator('target_recall')
     def _target_recall(cls, value, values):
         if value is None:
+            # flat indexes have no parameters; an automatically selected library is checked once it is known
+            if values.get('target_library') != IndexLibraries.hnswlib:
+                return None
             if values['hnswlib_M'] is None or values['hnswlib_ef'] is None:
                 raise ValueError('If target_recall is non specified then both hnswlib_M and hnswlib_ef must be specified')
             return None
@@ -181,6 +311,12 @@ class IndexRequest(BaseModel):
         if values['hnswlib_M'] is not None or values['hnswlib_ef'] is not None:
             raise ValueError('If target_recall is specified then both hnswlib_M and hnswlib_ef must be None (unspecified)')
         return value
+
+    @validator('max_latency_seconds', 'max_index_bytes', 'max_build_seconds')
+    def _budget(cls, value, values, field):
+        if value is not None and values.get('target_recall') is None:
+            raise ValueError(f'{field.name} requires target_recall to be specified')
+        return value
     
     @validator('tag')
     def _tag(cls, v):
@@ -198,13 +334,41 @@ class IndexResponse(BaseModel):
     hnswlib_M:  Optional[int] = Field(default=None, description="The M value passed to hnswlib when creating the index.")
     hnswlib_ef: Optional[int]  = Field(default=None, description="The ef_construction value passed to hnswlib when creating the index.")
     hnswlib_ef_search: Optional[int] = Field(default=None, ge=10, description="The recommended ef value to use at search time.")
+    pq_m: Optional[int] = Field(default=None, description="The product quantization code size in bytes per vector of an ivfpq index.")
+    ivf_nlist: Optional[int] = Field(default=None, description="The number of inverted lists of an ivfpq index.")
+    ivf_nprobe: Optional[int] = Field(default=None, description="The recommended number of inverted lists to probe at search time for an ivfpq index.")
     target_recall: Optional[float] = Field(default=None, ge=0.5, le=1, description="The desired recall value to target for index parameter optimization.")    
+    max_latency_seconds: Optional[float] = Field(default=None, description="The query latency budget for index parameter optimization.")
+    max_index_bytes: Optional[int] = Field(default=None, description="The index size budget for index parameter optimization.")
+    max_build_seconds: Optional[float] = Field(default=None, description="The build time budget for index parameter optimization.")
+    predicted_recall: Optional[float] = Field(default=None, description="The recall predicted by the optimizer for the selected parameters.")
+    predicted_latency_seconds: Optional[float] = Field(default=None, description="The query latency predicted by the optimizer for the selected parameters.")
+    predicted_index_bytes: Optional[int] = Field(default=None, description="The index size predicted by the optimizer for the selected parameters (per shard for sharded indexes).")
+    predicted_build_seconds: Optional[float] = Field(default=None, description="The build time predicted by the optimizer for the selected parameters (per shard for sharded indexes).")
+    incremental: bool = Field(default=False, description="True if this index was requested as an incremental update of the previous index with the same tag.")
     count: int = Field(description="The number of vectors included in the index.  The number of vectors in the collection at the time of index build.")
     created_at: float = Field(description='The epoch timestamp when the index was requested to be created.')
     state: IndexBuildState = Field(description = "The current build status.")
     completed_at: float = Field(description='The epoch timestamp when the index build was completed.')
     build_status: str     = Field(description='Informational status message for the index build.')
-    url: Optional[str] = Field(default=None, description='The url the index can be downloaded from. The url is valid for a limited time.')
+    url: Optional[str] = Field(default=None, description='The url the index can be downloaded from. The url is valid for a limited time.  None for sharded indexes, see shards.')
+    md5: Optional[str] = Field(default=None, description='The md5 hex digest of the index object, for verifying downloads.  None for sharded indexes, see shards.')
+    index_bytes: Optional[int] = Field(default=None, description='The size of the index in bytes (the total of all shards for sharded indexes; see the shards for the size of each).')
+    compression_level: Optional[int] = Field(default=None, description='The zstd level of the compressed index artifact, or None if there is none.')
+    compressed_bytes: Optional[int] = Field(default=None, description='The size of the compressed index artifact in bytes (the total of all shards for sharded indexes; see the shards for the size of each).')
+    compressed_url: Optional[str] = Field(default=None, description='The url the zstd compressed index can be downloaded from, if the index was built with a compression_level. The url is valid for a limited time.  None for sharded indexes, see shards.')
+    shards: List[IndexShardResponse] = Field(default=[], description='The shards of a sharded index, each downloaded and searched separately with results merged by distance.')
+
+
+class IndexQueryRequest(BaseModel):
+    vectors: List[List[float]] = Field(description="The batch of query vectors.")
+    k: int = Field(default=10, ge=1, le=1000, description="The number of nearest neighbors to return for each query vector.")
+
+
+class IndexQueryResponse(BaseModel):
+    index_id: int = Field(description="The index build that answered the query.")
+    vector_ids: List[List[int]] = Field(description="The vector_ids of the k nearest neighbors of each query vector, nearest first.  Fewer than k are returned for a query if the index finds fewer neighbors.")
+    distances: List[List[float]] = Field(description="The distances of the k nearest neighbors of each query vector, in the index metric.")
 
 
 class CollectionsIndexGetResponse(BaseModel):
@@ -222,13 +386,20 @@ class IndexTest(SQLModel, table=True):
     index_id:             int = Field(foreign_key="index.id",
                                       index=True,
                                       description='The index under test.')
-    test_count:           int = Field(description="The number of vectors in the test sample.")
+    test_count:           int = Field(description="The number of query vectors in the test sample.")
     test_k:               int = Field(description="The number of nearest neighbors (k) to query for each test vector.")
-    recall:             float = Field(description="The recall of the index based on a comparison to exhaustive KNN.")
+    recall:             float = Field(description="The recall of the index at hnswlib_ef based on a comparison to exhaustive KNN.")
     qps:                float = Field(description="The estimated queries per second of the index for vector search with batchsize of 1 (a single vector at a time).")
     cpu_info:             str = Field(description="The CPU that executed the test.")
     created_at:     timestamp = Field(default_factory=time, description='The epoch timestamp when the test was completed.')
-    hnswlib_ef: Optional[int] = Field(default=None, description="The ef value passed to hnsw_index.set_ef() for this test.")
+    hnswlib_ef: Optional[int] = Field(default=None, description="The ef value passed to hnsw_index.set_ef() for this test (the nprobe for ivfpq indexes).")
+    shard: Optional[int] = Field(default=None, description="The shard under test, for sharded indexes.")
+    latency_p50: Optional[float] = Field(default=None, description="The median latency in seconds of a single vector query.")
+    latency_p95: Optional[float] = Field(default=None, description="The 95th percentile latency in seconds of a single vector query.")
+    latency_p99: Optional[float] = Field(default=None, description="The 99th percentile latency in seconds of a single vector query.")
+    batch_qps: Optional[dict] = Field(default=None,
+                                      sa_column=Column(JSON),
+                                      description="The queries per second of batched queries keyed by the number of query threads, up to the threads of an index build.  Measured at the selected ef_search only.")
     
 
 class IndexTestResponse(BaseModel):
@@ -237,6 +408,50 @@ class IndexTestResponse(BaseModel):
 
 
     
+###
+##  Job
+###
+
+class JobKind(str, enum.Enum):
+    """
+    The kind of background work a job performs.
+    """
+    index_build = 'index_build'
+    collection_delete = 'collection_delete'
+
+
+class JobState(str, enum.Enum):
+    queued   = 'queued'
+    running  = 'running'
+    complete = 'complete'
+    failed   = 'failed'
+
+
+class Job(SQLModel, table=True):
+    """
+    A unit of background work executed by the worker processes (see worker.py).
+    Workers claim queued jobs with SELECT ... FOR UPDATE SKIP LOCKED and heartbeat while running;
+    a running job whose heartbeat has gone stale is reclaimed by another worker.
+    """
+    id: int = Field(default=None,
+                    primary_key=True,
+                    description='Unique identifier for this job.')
+    kind:  JobKind  = Field(sa_column=Column(Enum(JobKind)), description='The kind of work this job performs.')
+    state: JobState = Field(sa_column=Column(Enum(JobState), index=True), description='The current job state.')
+    index_id:      Optional[int] = Field(default=None, index=True, description='The index to build for index_build jobs.')
+    shard:         Optional[int] = Field(default=None, description='The shard of a sharded index to build for index_build jobs.')
+    collection_id: Optional[int] = Field(default=None, index=True, description='The collection this job operates on.')
+    attempts: int = Field(default=0, description='The number of times a worker has started this job.')
+    worker: Optional[str] = Field(default=None, description='The host:pid of the worker that most recently claimed this job.')
+    node:   Optional[str] = Field(default=None, index=True, description='The node of the worker that most recently claimed this job.')
+    memory_bytes: Optional[int] = Field(default=None, sa_column=Column(BigInteger), description='The estimated peak memory of the job, used for node memory admission.')
+    created_at:   timestamp = Field(default_factory=time, description='The epoch timestamp when the job was queued.')
+    started_at:   Optional[timestamp] = Field(default=None, description='The epoch timestamp when the job was most recently claimed.')
+    heartbeat_at: Optional[timestamp] = Field(default=None, description='The epoch timestamp of the most recent heartbeat from the running worker.')
+    completed_at: Optional[timestamp] = Field(default=None, description='The epoch timestamp when the job completed or failed.')
+
+
+
 ###
 ##  Work in Progress
 ###
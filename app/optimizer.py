@@ -1,35 +1,35 @@
+# Jiggy hnswlib parameter optimizer
+# Copyright (C) 2022 William S. Kish
+
+"""
+Predict hnswlib recall, build time, latency and index size from the index parameters, and select
+parameters for a target recall.  The models are trained offline by train_optimizer.py and loaded
+lazily from the model artifact on first use, so importing this module is cheap.
+"""
+
+import os
+import re
 import json
+import hashlib
+import tempfile
+import threading
 import numpy as np
-from sklearn import datasets, linear_model
-from sklearn.ensemble import RandomForestRegressor
-from sklearn.metrics import mean_squared_error, r2_score
-from random import shuffle, sample
 from math import log
 from time import time
 
-data = json.load(open('results.json'))
-shuffle(data)
-print(len(data))
-
-def vector(d):
-    return [d['vector_dimension'], d['index_elements'], d['index_ef_construction'], d['index_M'], d['test_ef']]
 
+MODEL_VERSION = 1
+MODEL_FILE = os.environ.get('JIGGY_OPTIMIZER_MODEL',
+                            os.path.join(os.path.dirname(os.path.abspath(__file__)), 'optimizer_model.joblib'))
 
-# deduplicate datapoints
-vset = {}
+# the model inputs, in order; see dict_to_X
+FEATURES = ['vector_dimension', 'index_elements', 'index_ef_construction', 'index_M', 'test_ef',
+            'memusage', 'dimension*index_elements', 'dimension*log(index_elements)']
+SCHEMA_HASH = hashlib.sha256(json.dumps({'version': MODEL_VERSION, 'features': FEATURES}).encode()).hexdigest()[:16]
 
-filtered = 0
-ddata = []
-for d in data:
-    v = vector(d)
-    if tuple(v) not in vset:
-        ddata.append(d)
-    else:
-        filtered += 1
-    vset[tuple(v)] = d
 
-data = ddata
-print(len(data), filtered)
+def vector(d):
+    return [d['vector_dimension'], d['index_elements'], d['index_ef_construction'], d['index_M'], d['test_ef']]
 
 
 def dict_to_X(d):
@@ -41,58 +41,87 @@ def dict_to_X(d):
     v.append(d['vector_dimension'] *  log(d['index_elements']))
     return np.array(v)
 
-X = np.array([dict_to_X(d) for d in data])
-
-Y_index_bytes           = np.array([d['index_bytes'] for d in data])
-Y_recall                = np.array([d['recall'] for d in data])
-Y_index_create_seconds  = np.array([d['index_create_seconds'] for d in data])
-Y_latency               = np.array([d['single_query_latency_seconds'] for d in data])
-
-
-s_ix = int(.98*len(data))    # split index
 
-def REGRESSION(X, Y, X_test, Y_test):
-    regr = linear_model.LinearRegression()
-    regr.fit(X, Y)
-    y_pred = regr.predict(X_test)
-    #print("Coefficients: \n", regr.coef_)
-    print("ERROR  %.2f" % mean_squared_error(y_pred, Y_test)**0.5)
-    return regr
+_model = None
+_model_lock = threading.Lock()
 
-print("INDEX BYTES REGRESSION")
-# index bytes
-index_byte_rgr = REGRESSION(X[:s_ix], Y_index_bytes[:s_ix], X[s_ix:], Y_index_bytes[s_ix:])
+CLASS_MODEL_KEY = "optimizer/%s.joblib"   # bucket key of the retrained model promoted for a cpu class
+CLASS_MODEL_TTL = 3600                    # seconds before checking the bucket for a newly promoted cpu class model
 
-print("\nRANDOM FORREST\n")
+_class_models = {}   # cpu class -> (time checked, model artifact or None)
 
-def RFR(X, Y, X_test, Y_test):
-    rfr = RandomForestRegressor()
-    rfr.fit(X, Y)
-    score = rfr.score(X, Y)
-    print("R-squared:", score)
-    y_pred = rfr.predict(X_test)
-    print("ERROR  %.3f" % mean_squared_error(y_pred, Y_test)**0.5)
-    return rfr
-
-
-#print("INDEX BYTES RFR")
-# index bytes
-#rfr(X[:s_ix], Y_index_bytes[:s_ix], X[s_ix:], Y_index_bytes[s_ix:])
-
-print()
-print("RECALL RFR")
-recall_rfr = RFR(X[:s_ix], Y_recall[:s_ix], X[s_ix:], Y_recall[s_ix:])
 
+def cpu_class(cpu_info):
+    """
+    reduce a cpu model name to a class shared by the cpus that should perform alike,
+    e.g. 'Intel(R) Xeon(R) Platinum 8375C CPU @ 2.90GHz' -> 'intel-xeon-platinum-8375c'
+    """
+    name = re.sub(r'\(r\)|\(tm\)|\bcpu\b|@.*$|\d+-core processor', '', cpu_info.lower())
+    return re.sub(r'[^a-z0-9]+', '-', name).strip('-') or 'unknown'
 
-print()
-print("RECALL INDEX CREATE SECONDS RFR")
-creation_seconds_rfr = RFR(X[:s_ix], Y_index_create_seconds[:s_ix], X[s_ix:], Y_index_create_seconds[s_ix:])
 
-print()
-print("RECALL latency RFR")
-latency_seconds_rfr = RFR(X[:s_ix], Y_latency[:s_ix], X[s_ix:], Y_latency[s_ix:])
+def _check_schema(model, source):
+    if model.get('schema_hash') != SCHEMA_HASH:
+        raise RuntimeError("Optimizer model %s has schema %s, expected %s; rerun train_optimizer.py" % (source,
+                                                                                                        model.get('schema_hash'),
+                                                                                                        SCHEMA_HASH))
+    return model
 
 
+def _load_class_model(cls):
+    """
+    download the model promoted for the cpu class, returning None if there is none
+    """
+    import joblib
+    from s3 import bucket
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, "model.joblib")
+        try:
+            bucket.download_file(CLASS_MODEL_KEY % cls, filename)
+        except Exception:
+            return None
+        model = joblib.load(filename)
+    if model.get('schema_hash') != SCHEMA_HASH:
+        print("ignoring optimizer model for %s with schema %s" % (cls, model.get('schema_hash')))
+        return None
+    print("loaded optimizer model for %s (%d datapoints)" % (cls, model['datapoints']))
+    return model
+
+
+def load_model(cpu_info=None):
+    """
+    return the optimizer model artifact, loading it on first use.
+    if cpu_info is specified, the model retrained from production index tests for its cpu class is
+    preferred when one has been promoted (see retrain_optimizer.py).
+    if there is no artifact the models are trained from results.json instead (slow).
+    raises RuntimeError if the artifact was trained against a different feature schema.
+    """
+    global _model
+    with _model_lock:
+        if cpu_info is not None:
+            cls = cpu_class(cpu_info)
+            checked, model = _class_models.get(cls, (0, None))
+            if time() - checked > CLASS_MODEL_TTL:
+                try:
+                    model = _load_class_model(cls) or model
+                except Exception as e:
+                    print("unable to load optimizer model for %s: %s" % (cls, e))
+                _class_models[cls] = (time(), model)
+            if model is not None:
+                return model
+        if _model is None:
+            t0 = time()
+            if os.path.exists(MODEL_FILE):
+                import joblib
+                model = _check_schema(joblib.load(MODEL_FILE), MODEL_FILE)
+            else:
+                print("optimizer model %s not found, training from results.json" % MODEL_FILE)
+                import train_optimizer
+                results = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results.json')
+                model = train_optimizer.train(json.load(open(results)))
+            print("loaded optimizer model (%d datapoints) in %.2f seconds" % (model['datapoints'], time()-t0))
+            _model = model
+    return _model
 
 
 def predict_hnswlib(input_dict):
@@ -109,56 +138,168 @@ def predict_hnswlib(input_dict):
       latency_seconds (float) search latency in seconds
       index_bytes (int) index size in bytes
     """
+    model = load_model()
     X = dict_to_X(input_dict)
     results = {}
-    results['recall'] = recall_rfr.predict([X])[0]
-    results['creation_seconds'] = int(creation_seconds_rfr.predict([X])[0])
-    results['latency_seconds'] = latency_seconds_rfr.predict([X])[0]
-    results['index_bytes'] = int(index_byte_rgr.predict([X])[0])
+    results['recall'] = model['recall'].predict([X])[0]
+    results['creation_seconds'] = int(model['creation_seconds'].predict([X])[0])
+    results['latency_seconds'] = model['latency_seconds'].predict([X])[0]
+    results['index_bytes'] = int(model['index_bytes'].predict([X])[0])
     return results
 
 
 
 
 
+def estimate_index_bytes(vector_dimension,
+                         index_elements,
+                         index_M,
+                         index_ef_construction=200,
+                         test_ef=100):
+    """
+    predict the hnswlib index size in bytes using the index bytes regression model,
+    bounded below by the size of the raw vectors and links
+    """
+    x = {'vector_dimension': vector_dimension,
+         'index_elements': index_elements,
+         'index_M': index_M,
+         'index_ef_construction': index_ef_construction,
+         'test_ef': test_ef}
+    predicted = int(load_model()['index_bytes'].predict([dict_to_X(x)])[0])
+    return max(predicted, (4*vector_dimension + 8*index_M) * index_elements)
+
+
+
 M = [16, 32, 48, 64, 96, 128, 256, 512]
 EF_CONSTRUCTION = [100, 200, 500, 1000, 2000]
 EF_TEST         = [50, 100, 200, 500, 1000, 2000, 5000]
 
+# every (index_M, index_ef_construction, test_ef) combination considered by the optimizer
+GRID = np.array([(m, efc, ef) for m in M for efc in EF_CONSTRUCTION for ef in EF_TEST], dtype=np.float64)
+
+
+def predict_grid(vector_dimension, index_elements, cpu_info=None):
+    """
+    predict recall, creation_seconds, latency_seconds and index_bytes for every point of the parameter GRID
+    with one batched predict per model, using the model for the cpu_info if specified.
+    returns a dict of arrays aligned with GRID.
+    """
+    model = load_model(cpu_info)
+    m, efc, ef = GRID[:, 0], GRID[:, 1], GRID[:, 2]
+    d = np.full(len(GRID), vector_dimension, dtype=np.float64)
+    n = np.full(len(GRID), index_elements, dtype=np.float64)
+    # columns as in dict_to_X
+    X = np.column_stack([d, n, efc, m, ef, (4*d + 8*m) * n, d * n, d * np.log(n)])
+    return {'recall':           model['recall'].predict(X),
+            'creation_seconds': model['creation_seconds'].predict(X),
+            'latency_seconds':  model['latency_seconds'].predict(X),
+            'index_bytes':      model['index_bytes'].predict(X)}
+
+
+def _grid_result(vector_dimension, index_elements, predictions, i):
+    """
+    the parameters and predictions of GRID point i in the form returned by predict_hnswlib
+    """
+    return {'vector_dimension':      vector_dimension,
+            'index_elements':        index_elements,
+            'index_M':               int(GRID[i, 0]),
+            'index_ef_construction': int(GRID[i, 1]),
+            'test_ef':               int(GRID[i, 2]),
+            'recall':                float(predictions['recall'][i]),
+            'creation_seconds':      int(predictions['creation_seconds'][i]),
+            'latency_seconds':       float(predictions['latency_seconds'][i]),
+            'index_bytes':           int(predictions['index_bytes'][i])}
+
+
+def pareto_front(predictions, candidates):
+    """
+    return the candidate GRID indices that are not dominated by another candidate, i.e. no other candidate
+    has at least the recall and at most the latency, index bytes and build time, and is strictly better in one
+    """
+    costs = np.column_stack([-predictions['recall'],
+                             predictions['latency_seconds'],
+                             predictions['index_bytes'],
+                             predictions['creation_seconds']])[candidates]
+    no_worse = (costs[:, None, :] <= costs[None, :, :]).all(axis=2)   # [i, j]: i is no worse than j
+    better = (costs[:, None, :] < costs[None, :, :]).any(axis=2)
+    dominated = (no_worse & better).any(axis=0)
+    return candidates[~dominated]
+
 
 def optimize_hnswlib_params(vector_dimension,
                             index_elements,
-                            min_recall):
-    best_recall = 0
-    best = None
-    options = []
-    t0 = time()
-    seen = set()
-    while ((time() - t0) < 10) and (len(options) < 50):  # run for max 10 seconds or 50 options
-        
-        x = {'vector_dimension': vector_dimension,
-             'index_elements': index_elements,
-             'index_M': sample(M,1)[0],
-             'index_ef_construction': sample(EF_CONSTRUCTION, 1)[0],
-             'test_ef': sample(EF_TEST, 1)[0]}
-        if (x['index_M'],x['index_ef_construction'],x['test_ef']) in seen:
-            continue
-        seen.add((x['index_M'],x['index_ef_construction'],x['test_ef']))
-        p = predict_hnswlib(x)
-        if p['recall'] > best_recall:
-            best  = (x, p)
-            best_recall = p['recall']
-        if p['recall'] > min_recall:
-            options.append((x,p))            
-
-    options.sort(key=lambda t:t[1]['recall'])
-    if len(options):
-        print("optimize_hnswlib_params:")
-        print(options[0])        
-        x, p = options[0]        
+                            min_recall,
+                            max_latency_seconds=None,
+                            max_index_bytes=None,
+                            max_build_seconds=None,
+                            cpu_info=None):
+    """
+    select parameters from the Pareto front of predicted (recall, latency, index bytes, build time) that meet
+    min_recall and the optional budgets, preferring the lowest predicted query latency, then build time.
+    The budgets are hard limits while recall is traded away if needed: if no parameters within the budgets
+    reach min_recall, the parameters within the budgets with the highest predicted recall are returned,
+    and if no parameters fit the budgets, those with the highest predicted recall overall.
+    Predictions use the model for the cpu_info (the cpu the index will be built and tested on) if specified.
+    returns the selected parameters and their predictions as a dict.
+    """
+    index_elements = max(index_elements, 1)
+    predictions = predict_grid(vector_dimension, index_elements, cpu_info)
+    within = np.ones(len(GRID), dtype=bool)
+    if max_latency_seconds is not None:
+        within &= predictions['latency_seconds'] <= max_latency_seconds
+    if max_index_bytes is not None:
+        within &= predictions['index_bytes'] <= max_index_bytes
+    if max_build_seconds is not None:
+        within &= predictions['creation_seconds'] <= max_build_seconds
+    feasible = np.flatnonzero(within & (predictions['recall'] >= min_recall))
+    if len(feasible):
+        front = pareto_front(predictions, feasible)
+        # lexsort sorts by the last key first
+        order = np.lexsort((predictions['index_bytes'][front],
+                            predictions['creation_seconds'][front],
+                            predictions['latency_seconds'][front]))
+        best = front[order[0]]
+    elif within.any():
+        print("optimize_hnswlib_params: no parameters within budget reach recall", min_recall)
+        best = int(np.flatnonzero(within)[np.argmax(predictions['recall'][within])])
     else:
-        x, p = best
-    x.update(p)
-    return x
+        print("optimize_hnswlib_params: no parameters within budget")
+        best = int(np.argmax(predictions['recall']))
+    result = _grid_result(vector_dimension, index_elements, predictions, best)
+    print("optimize_hnswlib_params:", result)
+    return result
 
 
+PQ_M = [4, 8, 12, 16, 24, 32, 48, 64, 96, 128, 192, 256, 384, 512]   # candidate IVF-PQ code sizes in bytes per vector
+PQ_DEFAULT_COMPRESSION = 16   # default ratio of float32 vector bytes to code bytes
+
+
+def ivfpq_index_bytes(vector_dimension, index_elements, pq_m, nlist):
+    """
+    the size of an IVF-PQ index: a code and an id per vector, the coarse centroids and the PQ codebooks
+    """
+    return (pq_m + 8) * index_elements + 4 * vector_dimension * (nlist + 256)
+
+
+def ivfpq_params(vector_dimension,
+                 index_elements,
+                 max_index_bytes=None,
+                 pq_m=None):
+    """
+    size an IVF-PQ index: the number of inverted lists grows with the square root of the index elements,
+    and the code size is pq_m if specified, otherwise the largest code that fits max_index_bytes if specified,
+    otherwise the code closest to PQ_DEFAULT_COMPRESSION.  Codes must divide the vector dimension.
+    returns a dict of pq_m, nlist and the predicted index_bytes.
+    """
+    index_elements = max(index_elements, 1)
+    nlist = int(min(max(4 * index_elements**0.5, 1), max(index_elements // 39, 1)))
+    if pq_m is None:
+        candidates = [m for m in PQ_M if vector_dimension % m == 0] or [1]
+        default = vector_dimension * 4 / PQ_DEFAULT_COMPRESSION
+        pq_m = min(candidates, key=lambda m: abs(m - default))
+        if max_index_bytes is not None:
+            fits = [m for m in candidates if ivfpq_index_bytes(vector_dimension, index_elements, m, nlist) <= max_index_bytes]
+            pq_m = max(fits) if fits else min(candidates)
+    return {'pq_m': pq_m,
+            'nlist': nlist,
+            'index_bytes': ivfpq_index_bytes(vector_dimension, index_elements, pq_m, nlist)}
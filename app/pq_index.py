@@ -0,0 +1,123 @@
+# Jiggy product quantized (IVF-PQ) index
+# Copyright (C) 2022 William S. Kish
+
+"""
+Compact approximate nearest neighbor search for memory-bound deployments, using a faiss IVF-PQ index.
+
+Each vector is stored in the index as a pq_m byte product quantization code in one of ivf_nlist inverted
+lists, instead of 4*dimension bytes of float32 plus graph links.  A query scans the ivf_nprobe nearest lists,
+takes the RERANK_FACTOR*k best candidates by approximate distance and re-ranks them by exact distance
+against the full vectors.  The full vectors are kept in a separate flat index artifact (see flat_index)
+that is memory mapped, so only the pages of the candidates are read.
+
+faiss is an optional dependency (faiss-cpu); IVF-PQ indexes can only be built and served where it is installed.
+"""
+
+import numpy as np
+
+try:
+    import faiss
+except ImportError:
+    faiss = None
+
+from flat_index import FlatIndex, _normalize
+
+
+IVFPQ_MIN_VECTORS = 10000      # smallest collection (or shard) an IVF-PQ index is built for
+RERANK_FACTOR = 4              # approximate candidates re-ranked exactly per requested neighbor
+TRAIN_VECTORS_PER_LIST = 64    # training sample size per inverted list
+RERANK_BATCH = 64              # queries re-ranked at a time, bounding the gathered candidate vectors
+VECTORS_SUFFIX = '.vectors'    # object key suffix of the full vector artifact used for re-ranking
+MISSING_LABEL = -1             # label of a missing neighbor, whose distance is inf
+
+
+def _faiss_metric(space):
+    # cosine vectors are normalized, so cosine ranks as inner product
+    return faiss.METRIC_L2 if space == 'l2' else faiss.METRIC_INNER_PRODUCT
+
+
+def _require_faiss():
+    if faiss is None:
+        raise RuntimeError("IVF-PQ indexes require faiss (pip install faiss-cpu).")
+
+
+class IVFPQIndex:
+    """
+    an IVF-PQ index with exact re-ranking, with the query interface of hnswlib.Index.
+    set_ef sets the number of inverted lists probed per query (ivf_nprobe).
+    """
+    def __init__(self, space, index, flat):
+        self.space = space
+        self.index = index
+        self.flat = flat     # the full vectors, normalized for cosine, in the row order of the faiss ids
+
+    @classmethod
+    def build(cls, space, flat, nlist, pq_m, num_threads=1):
+        """
+        train and populate an IVF-PQ index of the flat index's vectors
+        """
+        _require_faiss()
+        faiss.omp_set_num_threads(num_threads)
+        dimension = flat.vectors.shape[1]
+        quantizer = faiss.IndexFlat(dimension, _faiss_metric(space))
+        index = faiss.IndexIVFPQ(quantizer, dimension, nlist, pq_m, 8, _faiss_metric(space))
+        sample = min(len(flat.vectors), max(nlist * TRAIN_VECTORS_PER_LIST, 256 * 39))
+        rows = np.sort(np.random.choice(len(flat.vectors), sample, replace=False))
+        index.train(np.ascontiguousarray(flat.vectors[rows]))
+        # faiss ids are rows of the flat vectors so candidates can be re-ranked and mapped to vector_ids
+        for start in range(0, len(flat.vectors), 100000):
+            chunk = np.ascontiguousarray(flat.vectors[start:start+100000])
+            index.add_with_ids(chunk, np.arange(start, start+len(chunk), dtype=np.int64))
+        return cls(space, index, flat)
+
+    @classmethod
+    def load_index(cls, space, filename, vectors_filename):
+        _require_faiss()
+        return cls(space, faiss.read_index(filename), FlatIndex.load_index(space, vectors_filename, mmap=True))
+
+    def save_index(self, filename, vectors_filename=None):
+        """
+        save the faiss index, and the full vectors unless vectors_filename is None (see FlatIndex.save_index)
+        """
+        faiss.write_index(self.index, filename)
+        if vectors_filename is not None:
+            self.flat.save_index(vectors_filename)
+
+    def get_current_count(self):
+        return self.index.ntotal
+
+    def set_ef(self, nprobe):
+        self.index.nprobe = int(nprobe)
+
+    def set_num_threads(self, num_threads):
+        faiss.omp_set_num_threads(num_threads)
+
+    def knn_query(self, queries, k=1):
+        """
+        return the (vector_ids, distances) arrays of shape (len(queries), k) of the k nearest neighbors of each query.
+        distances are exact, in the hnswlib distance of the space.  if the probed lists hold fewer than k candidates
+        for a query, its missing neighbors are last, with label MISSING_LABEL and distance inf.
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        if self.space == 'cosine':
+            queries = _normalize(queries.copy())
+        k = min(k, self.index.ntotal)
+        _, rows = self.index.search(queries, min(RERANK_FACTOR * k, self.index.ntotal))
+        labels = np.empty((len(queries), k), dtype=np.int64)
+        distances = np.empty((len(queries), k), dtype=np.float32)
+        for start in range(0, len(queries), RERANK_BATCH):
+            batch_rows = rows[start:start+RERANK_BATCH]
+            missing = batch_rows < 0    # fewer candidates than requested in the probed lists
+            batch_rows = np.where(missing, 0, batch_rows)
+            candidates = self.flat.vectors[batch_rows.ravel()].reshape(batch_rows.shape + (-1,))
+            batch_queries = queries[start:start+RERANK_BATCH]
+            if self.space == 'l2':
+                d = ((candidates - batch_queries[:, None, :])**2).sum(axis=2)
+            else:
+                d = 1 - np.einsum('qcd,qd->qc', candidates, batch_queries)
+            d[missing] = np.inf
+            order = np.argsort(d, axis=1, kind='stable')[:, :k]
+            labels[start:start+RERANK_BATCH] = np.where(np.take_along_axis(missing, order, axis=1), MISSING_LABEL,
+                                                        self.flat.vids[np.take_along_axis(batch_rows, order, axis=1)])
+            distances[start:start+RERANK_BATCH] = np.take_along_axis(d, order, axis=1)
+        return labels, distances
@@ -0,0 +1,151 @@
+# Jiggy optimizer retraining from production index tests
+# Copyright (C) 2022 William S. Kish
+
+"""
+Retrain the optimizer models from the index tests measured by production index builds, per cpu class:
+
+    python retrain_optimizer.py [--cpu-class CLASS] [--dry-run]
+
+Run periodically (e.g. from cron).  Each completed full index build records its size and build time,
+and its tests record recall and latency at several ef values.  Those rows are joined into the
+results.json schema and grouped by the cpu class of the node that ran them.  For each class with enough
+rows a model is trained on results.json plus the class rows, excluding a holdout of the class rows.
+The new model is promoted to the bucket, where the optimizer picks it up for builds on that cpu class,
+only if it predicts the holdout better than the model currently in use for the class.
+"""
+
+import os
+import json
+import random
+import argparse
+import tempfile
+from collections import defaultdict
+import joblib
+from sqlmodel import Session, select
+
+from db import engine
+from models import *
+from s3 import bucket
+import optimizer
+import train_optimizer
+
+
+RETRAIN_MIN_ROWS = 50      # production rows needed before a cpu class gets its own model
+HOLDOUT_FRACTION = 0.2
+
+
+def production_results(session):
+    """
+    return {cpu class: [result dicts]} in the results.json schema from the tests of completed full index builds.
+    Tests recorded before latency percentiles were measured are skipped; their recall was averaged across ef values.
+    The single query latency is the mean (1/qps), the statistic benchmarked in results.json.
+    Each row also carries the index_id of its build, so the holdout can be split by build.
+    """
+    statement = select(IndexTest, Index, Collection, IndexShard)
+    statement = statement.join(Index, Index.id == IndexTest.index_id)
+    statement = statement.join(Collection, Collection.id == Index.collection_id)
+    statement = statement.outerjoin(IndexShard, (IndexShard.index_id == IndexTest.index_id) & (IndexShard.shard == IndexTest.shard))
+    statement = statement.where(Index.state == IndexBuildState.complete,
+                                Index.base_created_at == None,
+                                Index.target_library == IndexLibraries.hnswlib,
+                                IndexTest.latency_p50 != None)
+    results = defaultdict(list)
+    for test, index, collection, shard in session.exec(statement):
+        built = shard if test.shard is not None else index
+        if built is None or not built.index_bytes or built.build_seconds is None or not built.count or not test.qps:
+            continue
+        results[optimizer.cpu_class(test.cpu_info)].append({'index_id':                     index.id,
+                                                            'vector_dimension':             collection.dimension,
+                                                            'index_elements':               built.count,
+                                                            'index_ef_construction':        index.hnswlib_ef,
+                                                            'index_M':                      index.hnswlib_M,
+                                                            'test_ef':                      test.hnswlib_ef,
+                                                            'recall':                       test.recall,
+                                                            'index_create_seconds':         built.build_seconds,
+                                                            'single_query_latency_seconds': 1 / test.qps,
+                                                            'index_bytes':                  built.index_bytes})
+    return results
+
+
+def relative_error(new_error, current_error):
+    """
+    the mean over the predictors of the new model's holdout error relative to the current model's
+    """
+    return sum(new_error[k] / max(current_error[k], 1e-12) for k in new_error) / len(new_error)
+
+
+def split_holdout(rows):
+    """
+    return (holdout, train) rows, holding out whole index builds so no build's tests are in both
+    """
+    builds = defaultdict(list)
+    for row in rows:
+        builds[row['index_id']].append(row)
+    builds = list(builds.values())
+    random.shuffle(builds)
+    n_holdout = max(1, int(HOLDOUT_FRACTION * len(rows)))
+    holdout, train_rows = [], []
+    for i, build in enumerate(builds):
+        # the last build always trains, so a class with a single build has no holdout
+        if len(holdout) < n_holdout and i < len(builds) - 1:
+            holdout.extend(build)
+        else:
+            train_rows.extend(build)
+    return holdout, train_rows
+
+
+def retrain(cls, rows, base_data, dry_run=False):
+    """
+    train a model for the cpu class and promote it if it beats the current model on a holdout of the class rows
+    """
+    holdout, train_rows = split_holdout(rows)
+    if not holdout:
+        print("%s: %d rows from one index build, need more builds to retrain" % (cls, len(rows)))
+        return False
+
+    current = optimizer._load_class_model(cls) or optimizer.load_model()
+    # production rows come first so they win deduplication against benchmark rows with the same parameters
+    model = train_optimizer.train(train_rows + base_data)
+    model['cpu_class'] = cls
+    model['production_datapoints'] = len(train_rows)
+
+    current_error = train_optimizer.evaluate(current, holdout)
+    new_error = train_optimizer.evaluate(model, holdout)
+    model['holdout_error'] = new_error
+    print("%s: %d rows, holdout error current %s new %s" % (cls, len(rows), current_error, new_error))
+    # recall is what the optimizer selects on, so it must improve; the other predictors must not get worse overall
+    if new_error['recall'] >= current_error['recall'] or relative_error(new_error, current_error) >= 1:
+        print("%s: keeping current model" % cls)
+        return False
+    if dry_run:
+        print("%s: would promote new model" % cls)
+        return False
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, "model.joblib")
+        joblib.dump(model, filename, compress=3)
+        bucket.upload_file(filename, optimizer.CLASS_MODEL_KEY % cls)
+    print("%s: promoted new model" % cls)
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Retrain the Jiggy optimizer models from production index tests")
+    parser.add_argument('--cpu-class', default=None, help='only retrain the model for this cpu class')
+    parser.add_argument('--results', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results.json'),
+                        help='benchmark results included in every training set')
+    parser.add_argument('--dry-run', action='store_true', help='evaluate without promoting')
+    args = parser.parse_args()
+    base_data = json.load(open(args.results))
+    with Session(engine) as session:
+        results = production_results(session)
+    for cls, rows in sorted(results.items()):
+        if args.cpu_class and cls != args.cpu_class:
+            continue
+        if len(rows) < RETRAIN_MIN_ROWS:
+            print("%s: %d rows, need %d to retrain" % (cls, len(rows), RETRAIN_MIN_ROWS))
+            continue
+        retrain(cls, rows, base_data, args.dry_run)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,8 @@
+import os
+import threading
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 from botocore.exceptions import ClientError
 from typing import Union, Dict
 from . import exceptions
@@ -12,7 +16,14 @@ class Bucket:
     _AWS_ACCESS_KEY_ID = None
     _AWS_SECRET_ACCESS_KEY = None
     _ENDPOINT_URL = None
-    
+    _CLIENT_CONFIG = None
+    _TRANSFER_CONFIG = None
+
+    # ONE CLIENT PER PROCESS, SHARED BY ALL BUCKETS AND THREADS. BOTO3 CLIENTS ARE THREAD SAFE BUT THEIR CREATION IS NOT
+    _CLIENT = None
+    _CLIENT_PID = None
+    _CLIENT_LOCK = threading.Lock()
+
     def __init__(self, bucket_name: str):
 
         # ENSURE THE PACKAGE HAS BEEN CONFIGURED WITH THE APPROPRIATE ACCESS KEYS
@@ -22,29 +33,48 @@ class Bucket:
         self.bucket_name = bucket_name
 
     @classmethod
-    def prepare(cls, aws_access_key_id: str, aws_secret_access_key: str, aws_session_token=None, endpoint_url=None):
+    def prepare(cls, aws_access_key_id: str, aws_secret_access_key: str, aws_session_token=None, endpoint_url=None,
+                max_pool_connections: int = 32, max_attempts: int = 5,
+                multipart_chunksize: int = 16*1024*1024, max_concurrency: int = 8):
+        """
+        CONFIGURE THE CREDENTIALS AND CONNECTION SETTINGS SHARED BY ALL BUCKETS
+
+        :param max_pool_connections: THE SIZE OF THE HTTP KEEP-ALIVE CONNECTION POOL OF THE SHARED CLIENT
+        :param max_attempts: THE NUMBER OF ATTEMPTS (WITH BACKOFF) OF A REQUEST BEFORE IT FAILS
+        :param multipart_chunksize: THE PART SIZE OF MULTIPART UPLOADS AND RANGED DOWNLOADS
+        :param max_concurrency: THE NUMBER OF PARTS TRANSFERRED IN PARALLEL BY upload_file AND download_file
+        """
         cls._AWS_ACCESS_KEY_ID = aws_access_key_id
         cls._AWS_SECRET_ACCESS_KEY = aws_secret_access_key
         cls._AWS_SESSION_TOKEN = aws_session_token
         cls._ENDPOINT_URL = endpoint_url
+        cls._CLIENT_CONFIG = Config(max_pool_connections=max_pool_connections,
+                                    retries={'max_attempts': max_attempts, 'mode': 'standard'})
+        cls._TRANSFER_CONFIG = TransferConfig(multipart_threshold=multipart_chunksize,
+                                              multipart_chunksize=multipart_chunksize,
+                                              max_concurrency=max_concurrency)
+        with cls._CLIENT_LOCK:
+            cls._CLIENT = None
 
     @staticmethod
-    def _get_boto3_resource():
+    def client():
         """
-        GET AND CONFIGURE THE BOTO3 S3 API RESOURCE. THIS IS A "PRIVATE" METHOD
+        GET THE SHARED BOTO3 S3 CLIENT, CREATING IT ON FIRST USE IN THIS PROCESS
         """
-        # CREATE A "SESSION" WITH BOTO3
-
-        _session = boto3.Session(
-            aws_access_key_id=Bucket._AWS_ACCESS_KEY_ID,
-            aws_secret_access_key=Bucket._AWS_SECRET_ACCESS_KEY,
-            aws_session_token=Bucket._AWS_SESSION_TOKEN
-        )
-
-        # CREATE S3 RESOURCE
-        resource = _session.resource('s3', endpoint_url=Bucket._ENDPOINT_URL)
-
-        return resource
+        # A CLIENT INHERITED ACROSS A FORK WOULD SHARE ITS CONNECTIONS WITH THE PARENT, SO EACH PROCESS CREATES ITS OWN
+        client = Bucket._CLIENT
+        if client is not None and Bucket._CLIENT_PID == os.getpid():
+            return client
+        with Bucket._CLIENT_LOCK:
+            if Bucket._CLIENT is None or Bucket._CLIENT_PID != os.getpid():
+                _session = boto3.Session(
+                    aws_access_key_id=Bucket._AWS_ACCESS_KEY_ID,
+                    aws_secret_access_key=Bucket._AWS_SECRET_ACCESS_KEY,
+                    aws_session_token=Bucket._AWS_SESSION_TOKEN
+                )
+                Bucket._CLIENT = _session.client('s3', endpoint_url=Bucket._ENDPOINT_URL, config=Bucket._CLIENT_CONFIG)
+                Bucket._CLIENT_PID = os.getpid()
+            return Bucket._CLIENT
 
     def _handle_boto3_client_error(self, e: ClientError, key=None):
         """
@@ -77,15 +107,11 @@ class Bucket:
             LEFT UP TO MIDDLEWARE TO DETERMINE AND (2) A DICT CONTAINING METADATA ON WHEN THE OBJECT WAS STORED
         """
 
-        # GET S3 resource
-        resource = Bucket._get_boto3_resource()
-        s3_bucket = resource.Object(self.bucket_name, key)
-
         try:
             if response_content_type:
-                response = s3_bucket.get(ResponseContentType=response_content_type)
+                response = Bucket.client().get_object(Bucket=self.bucket_name, Key=key, ResponseContentType=response_content_type)
             else:
-                response = s3_bucket.get()
+                response = Bucket.client().get_object(Bucket=self.bucket_name, Key=key)
 
             data = response.get('Body').read()  # THE OBJECT DATA STORED
             metadata: Dict = response.get('Metadata')  # METADATA STORED WITH THE OBJECT
@@ -107,21 +133,19 @@ class Bucket:
         :return: A DICT CONTAINING THE RESPONSE FROM S3. IF AN EXCEPTION IS NOT THROWN, ASSUME PUT OPERATION WAS SUCCESSFUL.
         """
 
-        # GET RESOURCE
-        resource = Bucket._get_boto3_resource()
-        s3_bucket = resource.Object(self.bucket_name, key)
-
         # PUT IT
         try:
             if content_type:
-                response = s3_bucket.put(
+                response = Bucket.client().put_object(
+                    Bucket=self.bucket_name,
                     Body=data,
                     ContentType=content_type,
                     Key=key,
                     Metadata=metadata
                 )
             else:
-                response = s3_bucket.put(
+                response = Bucket.client().put_object(
+                    Bucket=self.bucket_name,
                     Body=data,
                     Key=key,
                     Metadata=metadata
@@ -139,18 +163,42 @@ class Bucket:
         :param key: A STRING THAT IS THE OBJECT'S KEY IDENTIFIER IN S3
         :return: THE RESPONSE FROM S3. IF NO EXCEPTION WAS THROWN, ASSUME DELETE OPERATION WAS SUCCESSFUL
         """
-        # GET S3 RESOURCE
-        resource = Bucket._get_boto3_resource()
-        s3_bucket = resource.Object(self.bucket_name, key)
-
         try:
-            response = s3_bucket.delete()
+            response = Bucket.client().delete_object(Bucket=self.bucket_name, Key=key)
             return response
 
         # BOTO RAISES ONLY ONE ERROR TYPE THAT THEN MUST BE PROCESSES TO GET THE CODE
         except ClientError as e:
             self._handle_boto3_client_error(e, key=key)
 
+    def delete_many(self, keys, batch_size: int = 1000) -> int:
+        """
+        DELETE THE SPECIFIED OBJECTS FROM THE BUCKET WITH BATCHED DeleteObjects CALLS OF UP TO batch_size (MAX 1000) KEYS.
+            KEYS THAT DO NOT EXIST ARE IGNORED, AS WITH delete
+
+        :param keys: AN ITERABLE OF THE KEYS OF THE OBJECTS TO DELETE
+        :param batch_size: THE NUMBER OF KEYS PER DeleteObjects CALL
+        :return: THE NUMBER OF KEYS DELETED. RAISES A BucketException IF ANY KEY COULD NOT BE DELETED
+        """
+        keys = list(keys)
+        for start in range(0, len(keys), batch_size):
+            batch = keys[start:start+batch_size]
+            try:
+                response = Bucket.client().delete_objects(Bucket=self.bucket_name,
+                                                          Delete={'Objects': [{'Key': key} for key in batch], 'Quiet': True})
+
+            # BOTO RAISES ONLY ONE ERROR TYPE THAT THEN MUST BE PROCESSES TO GET THE CODE
+            except ClientError as e:
+                self._handle_boto3_client_error(e)
+
+            # PER-KEY FAILURES ARE REPORTED IN THE RESPONSE RATHER THAN RAISED
+            errors = response.get('Errors', [])
+            if errors:
+                raise exceptions.BucketException(f"Failed to delete {len(errors)} objects from bucket {self.bucket_name}: "
+                                                 f"{errors[0].get('Key')}: {errors[0].get('Code')} {errors[0].get('Message')}",
+                                                 self.bucket_name)
+        return len(keys)
+
     def upload_file(self, local_filepath: str, key: str) -> Dict:
         """
         UPLOAD A LOCAL FILE TO THE BUCKET. TRANSPARENTLY MANAGES MULTIPART UPLOADS.
@@ -161,12 +209,26 @@ class Bucket:
             COMPLETED SUCCESSFULLY
         """
 
-        # GET S3 RESOURCE
-        resource = Bucket._get_boto3_resource()
-        s3_bucket = resource.Object(self.bucket_name, key)
+        try:
+            response = Bucket.client().upload_file(local_filepath, self.bucket_name, key, Config=Bucket._TRANSFER_CONFIG)
+            return response
 
+            # BOTO RAISES ONLY ONE ERROR TYPE THAT THEN MUST BE PROCESSES TO GET THE CODE
+        except ClientError as e:
+            self._handle_boto3_client_error(e, key=key)
+
+    def upload_fileobj(self, fileobj, key: str) -> Dict:
+        """
+        UPLOAD THE CONTENTS OF A READABLE FILE-LIKE OBJECT TO THE BUCKET, READING IT SEQUENTIALLY. STREAMS WITH A
+            MULTIPART UPLOAD, SO THE OBJECT NEED NOT FIT IN MEMORY OR ON DISK, AND THE SOURCE NEED NOT BE SEEKABLE.
+
+        :param fileobj: THE FILE-LIKE OBJECT TO READ THE DATA FROM (E.G. THE READ END OF A PIPE)
+        :param key: THE KEY TO STORE THE DATA UNDER IN THE BUCKET
+        :return: A DICT CONTAINING THE RESPONSE FROM S3. IF NO EXCEPTION IS THROWN, ASSUME OPERATION
+            COMPLETED SUCCESSFULLY
+        """
         try:
-            response = s3_bucket.upload_file(local_filepath)
+            response = Bucket.client().upload_fileobj(fileobj, self.bucket_name, key, Config=Bucket._TRANSFER_CONFIG)
             return response
 
             # BOTO RAISES ONLY ONE ERROR TYPE THAT THEN MUST BE PROCESSES TO GET THE CODE
@@ -182,12 +244,8 @@ class Bucket:
         :return: A DICT CONTAINING THE RESPONSE FROM S3. IF NO EXCEPTION IS THROWN, ASSUME OPERATION
             COMPLETED SUCCESSFULLY
         """
-        # GET S3 RESOURCE
-        resource = Bucket._get_boto3_resource()
-        s3_bucket = resource.Object(self.bucket_name, key)
-
         try:
-            response = s3_bucket.download_file(local_filepath)
+            response = Bucket.client().download_file(self.bucket_name, key, local_filepath, Config=Bucket._TRANSFER_CONFIG)
             return response
 
             # BOTO RAISES ONLY ONE ERROR TYPE THAT THEN MUST BE PROCESSES TO GET THE CODE
@@ -0,0 +1,119 @@
+# Jiggy hnswlib parameter optimizer training
+# Copyright (C) 2022 William S. Kish
+
+"""
+Train the optimizer's hnswlib models offline and save them as a versioned artifact:
+
+    python train_optimizer.py [--results results.json] [--output optimizer_model.joblib]
+
+The artifact records the hash of the optimizer's feature schema.  optimizer.py refuses an artifact
+trained against a different schema, so changing the features requires retraining.
+"""
+
+import json
+import argparse
+from random import shuffle
+from time import time
+import numpy as np
+import joblib
+from sklearn import linear_model
+from sklearn.ensemble import RandomForestRegressor
+from sklearn.metrics import mean_squared_error
+
+from optimizer import vector, dict_to_X, SCHEMA_HASH, MODEL_VERSION, MODEL_FILE
+
+
+def dedup(data):
+    """
+    deduplicate datapoints with the same parameters, keeping the first occurrence
+    """
+    vset = set()
+    ddata = []
+    for d in data:
+        v = tuple(vector(d))
+        if v not in vset:
+            ddata.append(d)
+        vset.add(v)
+    print(len(ddata), "datapoints,", len(data)-len(ddata), "duplicates filtered")
+    return ddata
+
+
+def REGRESSION(X, Y, X_test, Y_test):
+    regr = linear_model.LinearRegression()
+    regr.fit(X, Y)
+    y_pred = regr.predict(X_test)
+    print("ERROR  %.2f" % mean_squared_error(y_pred, Y_test)**0.5)
+    return regr
+
+
+def RFR(X, Y, X_test, Y_test):
+    rfr = RandomForestRegressor()
+    rfr.fit(X, Y)
+    score = rfr.score(X, Y)
+    print("R-squared:", score)
+    y_pred = rfr.predict(X_test)
+    print("ERROR  %.3f" % mean_squared_error(y_pred, Y_test)**0.5)
+    return rfr
+
+
+def train(data):
+    """
+    train the optimizer models on the benchmark result dicts, returning the model artifact
+    """
+    data = dedup(data)
+    shuffle(data)
+    X = np.array([dict_to_X(d) for d in data])
+
+    Y_index_bytes           = np.array([d['index_bytes'] for d in data])
+    Y_recall                = np.array([d['recall'] for d in data])
+    Y_index_create_seconds  = np.array([d['index_create_seconds'] for d in data])
+    Y_latency               = np.array([d['single_query_latency_seconds'] for d in data])
+
+    s_ix = int(.98*len(data))    # split index
+
+    print("INDEX BYTES REGRESSION")
+    index_bytes = REGRESSION(X[:s_ix], Y_index_bytes[:s_ix], X[s_ix:], Y_index_bytes[s_ix:])
+    print("\nRECALL RFR")
+    recall = RFR(X[:s_ix], Y_recall[:s_ix], X[s_ix:], Y_recall[s_ix:])
+    print("\nINDEX CREATE SECONDS RFR")
+    creation_seconds = RFR(X[:s_ix], Y_index_create_seconds[:s_ix], X[s_ix:], Y_index_create_seconds[s_ix:])
+    print("\nLATENCY RFR")
+    latency_seconds = RFR(X[:s_ix], Y_latency[:s_ix], X[s_ix:], Y_latency[s_ix:])
+
+    return {'version':          MODEL_VERSION,
+            'schema_hash':      SCHEMA_HASH,
+            'trained_at':       time(),
+            'datapoints':       len(data),
+            'index_bytes':      index_bytes,
+            'recall':           recall,
+            'creation_seconds': creation_seconds,
+            'latency_seconds':  latency_seconds}
+
+
+TARGETS = {'recall':           'recall',
+           'creation_seconds': 'index_create_seconds',
+           'latency_seconds':  'single_query_latency_seconds',
+           'index_bytes':      'index_bytes'}   # model name -> results.json field
+
+
+def evaluate(model, data):
+    """
+    return the root mean squared error of each of the model's predictors on the result dicts
+    """
+    X = np.array([dict_to_X(d) for d in data])
+    return {name: float(mean_squared_error(model[name].predict(X), [d[field] for d in data])**0.5)
+            for name, field in TARGETS.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Train the Jiggy hnswlib parameter optimizer models")
+    parser.add_argument('--results', default='results.json', help='hnswlib benchmark results to train on')
+    parser.add_argument('--output', default=MODEL_FILE, help='model artifact to write')
+    args = parser.parse_args()
+    artifact = train(json.load(open(args.results)))
+    joblib.dump(artifact, args.output, compress=3)
+    print("wrote", args.output, "schema", SCHEMA_HASH)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,7 +5,8 @@
 from __future__ import annotations
 from typing import List, Optional
 from pydantic import conint
-from fastapi import FastAPI, Path, Query, HTTPException, UploadFile, File, Depends
+from fastapi import FastAPI, Path, Query, HTTPException, UploadFile, File, Depends, Request
+from starlette.concurrency import run_in_threadpool
 from fastapi.security import HTTPBearer 
 from fastapi.routing import APIRouter
 from fastapi.responses import Response
@@ -13,22 +14,38 @@ import string
 import random
 from time import time
 import os
+import tempfile
 from auth import verified_user_id
 from sqlmodel import Session, select, or_
 from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy.orm.exc import MultipleResultsFound
+from sqlalchemy.exc import IntegrityError
+import numpy as np
 
 
 from main import app, engine, token_auth_scheme
 from auth import verified_user_id_teams
 
 from models import *
+import vector_codec
+import bulkload
+import changelog
+from s3 import bucket
 
     
 ###
 ### Vectors
 ###
 
+MAX_COLLECTION_VECTORS = 100000000   # largest supported collection; indexes of large collections are sharded
+MAX_DIMENSION = 12288
+MAX_BATCH_VECTORS = 10000
+MAX_BINARY_BATCH_VECTORS = 100000
+MAX_TEST_QUERIES = 10000
+MAX_BINARY_BODY_BYTES = 256*1024**2                                # largest binary vector batch body
+MAX_TEST_QUERIES_BODY_BYTES = 4096 + 4*MAX_TEST_QUERIES*MAX_DIMENSION   # largest test query set, with an npy header
+
+
 @app.post('/collections/{collection_id}/vectors/{vector_id}', response_model=VectorResponse)
 def post_vectors(token: str = Depends(token_auth_scheme),
                  collection_id: str = Path(...),
@@ -39,37 +56,252 @@ def post_vectors(token: str = Depends(token_auth_scheme),
     """
     user_id, user_team_ids = verified_user_id_teams(token)        
     with Session(engine) as session:
-        collection = session.get(Collection, collection_id)
-        if not collection or collection.team_id not in user_team_ids:
+        collection = session.get(Collection, collection_id, with_for_update=True)
+        if not collection or collection.deleting or collection.team_id not in user_team_ids:
             raise HTTPException(status_code=404, detail="Collection not found")
-        if collection.count >= 1000000:
+        if collection.count >= MAX_COLLECTION_VECTORS:
             raise HTTPException(status_code=400,
-                                detail="Largest supported collection size is currently 1M vectors during alpha test phase.")
+                                detail="Largest supported collection size is currently %d vectors." % MAX_COLLECTION_VECTORS)
 
         statement = select(Vector).where(Vector.vector_id == vector_id, Vector.collection_id == collection_id)
         vector = session.exec(statement).first()
         if vector:
             session.delete(vector)   # replace the existing vector with the same key
+            session.flush()          # delete before insert to satisfy the unique (collection_id, vector_id) index
             collection.count = Collection.count - 1
-        if collection.dimension == 0:
-            # update dimension to the actual length of the vector
-            collection.dimension = len(body.vector)
-            if collection.dimension > 12288:
-                raise HTTPException(status_code=400, detail="Largest supported dimension is currently 12288")
-            
-        elif collection.dimension != len(body.vector):
-            raise HTTPException(status_code=400,
-                                detail="Vector dimension %d mismatches existing collection dimension of %d." % (len(body.vector), collection.dimension))
+        _set_collection_dimension(collection, len(body.vector))
         vector = Vector(vector_id = vector_id,
-                        collection_id = collection_id,
-                        vector = body.vector)
+                        collection_id = collection_id)
+        if vector_codec.storage_dtype(collection.vector_storage) is None:
+            vector.vector = body.vector
+        else:
+            try:
+                vector.vector_data = vector_codec.pack_vector(body.vector, collection.vector_storage)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
         collection.count = Collection.count + 1        
         collection.updated_at = time()
         session.add(collection)
         session.add(vector)
-        session.commit()
+        if changelog.logs_changes(session, collection.id):
+            session.add(VectorChange(collection_id=collection.id, vector_id=vector_id, op=VectorChangeOp.insert))
+        try:
+            session.commit()
+        except IntegrityError:
+            # writers are serialized by the collection row lock, so this is a write that bypassed it
+            session.rollback()
+            raise HTTPException(status_code=409, detail="Vector %s was written concurrently.  Please retry." % vector_id)
         session.refresh(vector)
-        return vector
+        return _vector_response(vector, collection.dimension)
+
+
+def _vector_response(vector, dimension):
+    """
+    return the VectorResponse for a Vector row regardless of the collection's vector storage
+    """
+    return VectorResponse(collection_id = vector.collection_id,
+                          created_at = vector.created_at,
+                          vector = vector_codec.unpack_vector(vector.vector, vector.vector_data, dimension).tolist(),
+                          vector_id = vector.vector_id)
+
+
+def _set_collection_dimension(collection, dimension):
+    """
+    validate the dimension of incoming vectors against the collection dimension,
+    setting the collection dimension if this is the first vector in the collection.
+    raises HTTPException if the dimension is invalid.
+    """
+    if collection.dimension == 0:
+        if dimension > MAX_DIMENSION:
+            raise HTTPException(status_code=400, detail="Largest supported dimension is currently %d" % MAX_DIMENSION)
+        collection.dimension = dimension
+    elif collection.dimension != dimension:
+        raise HTTPException(status_code=400,
+                            detail="Vector dimension %d mismatches existing collection dimension of %d." % (dimension, collection.dimension))
+
+
+def _upsert_vectors(session, collection, vector_ids, vectors):
+    """
+    bulk load the vectors into the collection in the current session transaction,
+    replacing any existing vectors with the same vector_id.
+    The caller is responsible for validating the vector dimension and committing the session.
+    returns the number of vectors that were new to the collection.
+    """
+    try:
+        vector_ids = np.asarray(vector_ids, dtype=np.int64)
+    except OverflowError:
+        raise HTTPException(status_code=400, detail="vector_id must be a 64 bit signed integer.")
+    vectors = np.asarray(vectors, dtype=np.float32)
+    # the last occurrence of a vector_id in the batch wins
+    vector_ids, vectors = bulkload.dedup_last(vector_ids, vectors)
+    try:
+        created = bulkload.copy_vectors(session, collection, vector_ids, vectors,
+                                        changelog.logs_changes(session, collection.id))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    collection.count = Collection.count + created
+    collection.updated_at = time()
+    session.add(collection)
+    return created
+
+
+@app.post('/collections/{collection_id}/vectors', response_model=VectorBatchResponse)
+def post_vectors_batch(token: str = Depends(token_auth_scheme),
+                       collection_id: str = Path(...),
+                       body: VectorBatchPostRequest = ...) -> VectorBatchResponse:
+    """
+    Create or Replace a Batch of Vectors
+    """
+    user_id, user_team_ids = verified_user_id_teams(token)
+    if not body.items:
+        raise HTTPException(status_code=400, detail="Vector batch is empty.")
+    if len(body.items) > MAX_BATCH_VECTORS:
+        raise HTTPException(status_code=400, detail="Largest supported batch is %d vectors." % MAX_BATCH_VECTORS)
+    dimensions = {len(item.vector) for item in body.items}
+    if len(dimensions) != 1:
+        raise HTTPException(status_code=400, detail="All vectors in a batch must have the same dimension.")
+    with Session(engine) as session:
+        collection = session.get(Collection, collection_id, with_for_update=True)
+        if not collection or collection.deleting or collection.team_id not in user_team_ids:
+            raise HTTPException(status_code=404, detail="Collection not found")
+        if collection.count + len(body.items) > MAX_COLLECTION_VECTORS:
+            raise HTTPException(status_code=400,
+                                detail="Largest supported collection size is currently %d vectors." % MAX_COLLECTION_VECTORS)
+        _set_collection_dimension(collection, dimensions.pop())
+        created = _upsert_vectors(session,
+                                  collection,
+                                  [item.vector_id for item in body.items],
+                                  [item.vector for item in body.items])
+        session.commit()
+        session.refresh(collection)
+        return VectorBatchResponse(collection_id = collection.id,
+                                   count = len({item.vector_id for item in body.items}),
+                                   created = created,
+                                   collection_count = collection.count)
+
+
+async def _read_body(request, max_bytes):
+    """
+    read the request body, raising 413 if it is larger than max_bytes before reading more than that
+    """
+    length = request.headers.get('content-length')
+    if length is not None and length.isdigit() and int(length) > max_bytes:
+        raise HTTPException(status_code=413, detail="Request body is larger than the %d byte limit." % max_bytes)
+    buf = bytearray()
+    async for chunk in request.stream():
+        buf += chunk
+        if len(buf) > max_bytes:
+            raise HTTPException(status_code=413, detail="Request body is larger than the %d byte limit." % max_bytes)
+    return bytes(buf)
+
+
+def _post_vectors_binary(user_team_ids, collection_id, content_type, dimension, buf):
+    """
+    decode and store a binary vector batch.  runs in the threadpool since it blocks on the database.
+    """
+    with Session(engine) as session:
+        collection = session.get(Collection, collection_id, with_for_update=True)
+        if not collection or collection.deleting or collection.team_id not in user_team_ids:
+            raise HTTPException(status_code=404, detail="Collection not found")
+        try:
+            if content_type == vector_codec.NPY_MEDIA_TYPE:
+                vector_ids, vectors = vector_codec.decode_npy(buf)
+            elif content_type == vector_codec.RAW_MEDIA_TYPE:
+                vector_ids, vectors = vector_codec.decode_raw(buf, dimension or collection.dimension)
+            else:
+                raise HTTPException(status_code=415,
+                                    detail="Content-Type must be %s or %s" % (vector_codec.NPY_MEDIA_TYPE, vector_codec.RAW_MEDIA_TYPE))
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        if not len(vector_ids):
+            raise HTTPException(status_code=400, detail="Vector batch is empty.")
+        if len(vector_ids) > MAX_BINARY_BATCH_VECTORS:
+            raise HTTPException(status_code=400, detail="Largest supported binary batch is %d vectors." % MAX_BINARY_BATCH_VECTORS)
+        if collection.count + len(vector_ids) > MAX_COLLECTION_VECTORS:
+            raise HTTPException(status_code=400,
+                                detail="Largest supported collection size is currently %d vectors." % MAX_COLLECTION_VECTORS)
+        _set_collection_dimension(collection, vectors.shape[1])
+        created = _upsert_vectors(session, collection, vector_ids, vectors)
+        session.commit()
+        session.refresh(collection)
+        return VectorBatchResponse(collection_id = collection.id,
+                                   count = len(np.unique(vector_ids)),
+                                   created = created,
+                                   collection_count = collection.count)
+
+
+@app.post('/collections/{collection_id}/binary-vectors', response_model=VectorBatchResponse)
+async def post_vectors_binary(request: Request,
+                              token: str = Depends(token_auth_scheme),
+                              collection_id: str = Path(...),
+                              dimension: Optional[int] = Query(default=None, description="The vector dimension of an application/octet-stream body. Defaults to the collection dimension.")) -> VectorBatchResponse:
+    """
+    Create or Replace a Batch of Vectors from a binary body.
+
+    Content-Type application/x-npy: an int64 vector_id array followed by a float32 (n, dimension) vector array, both in .npy format.
+
+    Content-Type application/octet-stream: n little-endian int64 vector_ids followed by n*dimension little-endian float32 elements.
+
+    The body is limited to 256 MB; larger uploads should be split into several batches.
+    """
+    content_type = request.headers.get('content-type', '').split(';')[0].strip()
+    # authenticate and check the body size before reading the body
+    user_id, user_team_ids = await run_in_threadpool(verified_user_id_teams, token)
+    buf = await _read_body(request, MAX_BINARY_BODY_BYTES)
+    return await run_in_threadpool(_post_vectors_binary, user_team_ids, collection_id, content_type, dimension, buf)
+
+
+def _put_test_queries(user_team_ids, collection_id, content_type, buf):
+    """
+    decode and store the collection's test query set.  runs in the threadpool since it blocks on the database and bucket.
+    """
+    with Session(engine) as session:
+        # the collection row lock excludes a concurrent delete of the collection
+        collection = session.get(Collection, collection_id, with_for_update=True)
+        if not collection or collection.deleting or collection.team_id not in user_team_ids:
+            raise HTTPException(status_code=404, detail="Collection not found")
+        if not collection.dimension:
+            raise HTTPException(status_code=400, detail="Add vectors to the collection before uploading test queries.")
+        if content_type not in (vector_codec.NPY_MEDIA_TYPE, vector_codec.RAW_MEDIA_TYPE):
+            raise HTTPException(status_code=415,
+                                detail="Content-Type must be %s or %s" % (vector_codec.NPY_MEDIA_TYPE, vector_codec.RAW_MEDIA_TYPE))
+        try:
+            queries = vector_codec.decode_queries(buf, content_type, collection.dimension)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        if not len(queries):
+            raise HTTPException(status_code=400, detail="Test query set is empty.")
+        if len(queries) > MAX_TEST_QUERIES:
+            raise HTTPException(status_code=400, detail="Largest supported test query set is %d vectors." % MAX_TEST_QUERIES)
+        objkey = f"test-queries/{collection.id}.npy"
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, "queries.npy")
+            np.save(filename, queries)
+            bucket.upload_file(filename, objkey)
+        collection.test_queries_objkey = objkey
+        session.add(collection)
+        session.commit()
+        return TestQueriesResponse(collection_id=collection.id, count=len(queries))
+
+
+@app.put('/collections/{collection_id}/test-queries', response_model=TestQueriesResponse)
+async def put_test_queries(request: Request,
+                           token: str = Depends(token_auth_scheme),
+                           collection_id: str = Path(...)) -> TestQueriesResponse:
+    """
+    Upload Test Queries
+
+    Replace the set of query vectors used to measure the recall of the collection's indexes.
+    Without a test query set, indexes are tested with queries sampled from the collection.
+
+    Content-Type application/x-npy: a float32 (n, dimension) array in .npy format.
+
+    Content-Type application/octet-stream: n*dimension little-endian float32 elements.
+    """
+    content_type = request.headers.get('content-type', '').split(';')[0].strip()
+    user_id, user_team_ids = await run_in_threadpool(verified_user_id_teams, token)
+    buf = await _read_body(request, MAX_TEST_QUERIES_BODY_BYTES)
+    return await run_in_threadpool(_put_test_queries, user_team_ids, collection_id, content_type, buf)
 
 
 @app.delete('/collections/{collection_id}/vectors/{vector_id}')
@@ -81,14 +313,16 @@ def delete_vectors(token: str = Depends(token_auth_scheme),
     """
     user_id, user_team_ids = verified_user_id_teams(token)    
     with Session(engine) as session:
-        collection = session.get(Collection, collection_id)
-        if not collection or collection.team_id not in user_team_ids:
+        collection = session.get(Collection, collection_id, with_for_update=True)
+        if not collection or collection.deleting or collection.team_id not in user_team_ids:
             raise HTTPException(status_code=404, detail="Collection not found")
         statement = select(Vector).where(Vector.vector_id == vector_id, Vector.collection_id == collection_id)
         vector = session.exec(statement).first()
         if not vector:
             raise HTTPException(status_code=404, detail="Vector not found")
         session.delete(vector)
+        if changelog.logs_changes(session, collection.id):
+            session.add(VectorChange(collection_id=collection.id, vector_id=vector_id, op=VectorChangeOp.delete))
         collection.count = Collection.count - 1
         collection.updated_at = time()
         session.add(collection)
@@ -106,11 +340,11 @@ def get_vectors(token: str = Depends(token_auth_scheme),
     user_id, user_team_ids = verified_user_id_teams(token)
     with Session(engine) as session:
         collection = session.get(Collection, collection_id)
-        if not collection or collection.team_id not in user_team_ids:
+        if not collection or collection.deleting or collection.team_id not in user_team_ids:
             raise HTTPException(status_code=404, detail="Collection not found")
         statement = select(Vector).where(Vector.vector_id == vector_id, Vector.collection_id == collection_id)
         vector = session.exec(statement).first()
         if not vector:
             raise HTTPException(status_code=404, detail="Vector not found")
-        return VectorResponse(**vector.dict())
+        return _vector_response(vector, collection.dimension)
 
@@ -0,0 +1,202 @@
+# Jiggy binary vector encoding
+# Copyright (C) 2022 William S. Kish
+
+"""
+Binary encodings for batches of vectors.
+
+Two formats are supported:
+
+application/x-npy:          an int64 vector_id array of shape (n,) in .npy format immediately followed by
+                            a float32 vector array of shape (n, dimension) in .npy format.
+
+application/octet-stream:   n little-endian int64 vector_ids immediately followed by n * dimension
+                            little-endian float32 vector elements (row major).  The dimension is supplied
+                            out of band.
+
+Decoding is zero-copy: the returned arrays are views into the supplied buffer whenever the encoded
+dtypes are already int64 and float32.
+
+This module also packs and unpacks the per-vector bytea representation used by collections
+with float32 or float16 vector storage.
+"""
+
+import io
+import numpy as np
+
+
+NPY_MEDIA_TYPE = 'application/x-npy'
+RAW_MEDIA_TYPE = 'application/octet-stream'
+
+ID_DTYPE     = np.dtype('<i8')
+VECTOR_DTYPE = np.dtype('<f4')
+
+# packed little-endian bytea dtype for each vector storage mode; 'array' vectors are stored as real[]
+STORAGE_DTYPES = {'float32': np.dtype('<f4'),
+                  'float16': np.dtype('<f2')}
+
+FLOAT16_MAX = float(np.finfo(np.float16).max)
+
+
+def _read_npy(buf, offset):
+    """
+    read a single .npy array from buf starting at offset without copying the array data.
+    returns the array and the offset of the first byte following the array.
+    """
+    # only the header is copied, not the array data
+    view = memoryview(buf).cast('B')
+    if len(view) < offset + 10:
+        raise ValueError("Truncated npy header.")
+    length_bytes = 2 if view[offset+6] == 1 else 4
+    header_length = int.from_bytes(view[offset+8:offset+8+length_bytes], 'little')
+    f = io.BytesIO(view[offset:offset+8+length_bytes+header_length])
+    version = np.lib.format.read_magic(f)
+    if version == (1, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+    elif version in ((2, 0), (3, 0)):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+    else:
+        raise ValueError("Unsupported npy version %s" % str(version))
+    if fortran_order:
+        raise ValueError("Fortran ordered npy arrays are not supported.")
+    if dtype.hasobject:
+        raise ValueError("Object npy arrays are not supported.")
+    count = int(np.prod(shape))
+    start = offset + f.tell()
+    if len(buf) < start + count * dtype.itemsize:
+        raise ValueError("Truncated npy array.")
+    array = np.frombuffer(buf, dtype=dtype, count=count, offset=start).reshape(shape)
+    return array, start + count * dtype.itemsize
+
+
+def _validate(vector_ids, vectors):
+    """
+    validate the shapes of the decoded arrays and convert them to int64 ids and float32 vectors.
+    """
+    if vector_ids.ndim != 1:
+        raise ValueError("vector_id array must be 1 dimensional.")
+    if vectors.ndim != 2:
+        raise ValueError("vector array must be 2 dimensional.")
+    if len(vector_ids) != len(vectors):
+        raise ValueError("vector_id array length %d mismatches vector array length %d." % (len(vector_ids), len(vectors)))
+    if vector_ids.dtype.kind not in 'iu':
+        raise ValueError("vector_id array must be an integer array.")
+    if vectors.dtype.kind != 'f':
+        raise ValueError("vector array must be a floating point array.")
+    if vector_ids.dtype != ID_DTYPE:
+        vector_ids = vector_ids.astype(ID_DTYPE)
+    if vectors.dtype != VECTOR_DTYPE:
+        vectors = vectors.astype(VECTOR_DTYPE)
+    if not np.isfinite(vectors).all():
+        raise ValueError("vectors must not contain NaN or infinite elements.")
+    return vector_ids, vectors
+
+
+def decode_npy(buf, validate=True):
+    """
+    decode an application/x-npy body into a (vector_ids, vectors) tuple of numpy arrays.
+    validate=False skips the dtype conversion and element checks, for trusted buffers such as
+    memory mapped index files that should not be read in full.
+    raises ValueError if the body is malformed.
+    """
+    vector_ids, offset = _read_npy(buf, 0)
+    vectors, offset = _read_npy(buf, offset)
+    if offset != len(buf):
+        raise ValueError("Unexpected trailing data after npy arrays.")
+    if not validate:
+        return vector_ids, vectors
+    return _validate(vector_ids, vectors)
+
+
+def decode_raw(buf, dimension):
+    """
+    decode an application/octet-stream body of the specified vector dimension
+    into a (vector_ids, vectors) tuple of numpy arrays.
+    raises ValueError if the body is malformed.
+    """
+    if dimension <= 0:
+        raise ValueError("A positive vector dimension is required to decode raw vectors.")
+    row_bytes = ID_DTYPE.itemsize + dimension * VECTOR_DTYPE.itemsize
+    if len(buf) % row_bytes:
+        raise ValueError("Body length %d is not a multiple of the %d byte (vector_id, vector) size for dimension %d." % (len(buf), row_bytes, dimension))
+    count = len(buf) // row_bytes
+    vector_ids = np.frombuffer(buf, dtype=ID_DTYPE, count=count)
+    vectors = np.frombuffer(buf, dtype=VECTOR_DTYPE, count=count*dimension, offset=count*ID_DTYPE.itemsize)
+    return _validate(vector_ids, vectors.reshape(count, dimension))
+
+
+def decode_queries(buf, content_type, dimension):
+    """
+    decode a query vector set: a single float32 (n, dimension) array in .npy format (application/x-npy),
+    or n*dimension little-endian float32 elements (application/octet-stream).
+    raises ValueError if the body is malformed or mismatches the dimension.
+    """
+    if content_type == NPY_MEDIA_TYPE:
+        queries, offset = _read_npy(buf, 0)
+        if offset != len(buf):
+            raise ValueError("Unexpected trailing data after npy array.")
+    else:
+        if len(buf) % (dimension * VECTOR_DTYPE.itemsize):
+            raise ValueError("Body length %d is not a multiple of the vector size for dimension %d." % (len(buf), dimension))
+        queries = np.frombuffer(buf, dtype=VECTOR_DTYPE).reshape(-1, dimension)
+    if queries.ndim != 2 or queries.shape[1] != dimension:
+        raise ValueError("Query array shape %s mismatches collection dimension %d." % (str(queries.shape), dimension))
+    _, queries = _validate(np.arange(len(queries)), queries)
+    return queries
+
+
+def encode_npy(vector_ids, vectors):
+    """
+    encode the vector_ids and vectors as an application/x-npy body
+    """
+    f = io.BytesIO()
+    np.save(f, np.ascontiguousarray(vector_ids, dtype=ID_DTYPE))
+    np.save(f, np.ascontiguousarray(vectors, dtype=VECTOR_DTYPE))
+    return f.getvalue()
+
+
+def encode_raw(vector_ids, vectors):
+    """
+    encode the vector_ids and vectors as an application/octet-stream body
+    """
+    return (np.ascontiguousarray(vector_ids, dtype=ID_DTYPE).tobytes() +
+            np.ascontiguousarray(vectors, dtype=VECTOR_DTYPE).tobytes())
+
+
+def storage_dtype(storage):
+    """
+    return the packed dtype for the vector storage mode, or None for real[] array storage
+    """
+    return STORAGE_DTYPES.get(getattr(storage, 'value', storage))
+
+
+def pack_vectors(vectors, storage):
+    """
+    convert a float32 (n, dimension) array to the packed dtype of the storage mode.
+    raises ValueError if the vectors can not be represented in the storage dtype.
+    """
+    dtype = storage_dtype(storage)
+    if dtype is None:
+        raise ValueError("Vector storage %s is not a packed storage mode." % storage)
+    if dtype == STORAGE_DTYPES['float16'] and len(vectors) and np.abs(vectors).max() > FLOAT16_MAX:
+        raise ValueError("Vector elements exceed the float16 range of the collection vector storage.")
+    return np.ascontiguousarray(vectors, dtype=dtype)
+
+
+def pack_vector(vector, storage):
+    """
+    pack a single vector into bytea for the storage mode
+    """
+    return pack_vectors(np.asarray([vector], dtype=VECTOR_DTYPE), storage).tobytes()
+
+
+def unpack_vector(vector, vector_data, dimension):
+    """
+    return the float32 (or float16 view) array for a vector row, given the row's real[] vector and bytea vector_data.
+    The packed dtype is inferred from the bytea length so rows of a collection that is being migrated between
+    storage modes can be read at any time.
+    """
+    if vector_data is None:
+        return np.asarray(vector, dtype=VECTOR_DTYPE)
+    if len(vector_data) == dimension * 2:
+        return np.frombuffer(vector_data, dtype=STORAGE_DTYPES['float16'])
+    return np.frombuffer(vector_data, dtype=STORAGE_DTYPES['float32'])
@@ -0,0 +1,277 @@
+# Jiggy background job worker
+# Copyright (C) 2022 William S. Kish
+
+"""
+Background job worker, run separately from the API so that index builds do not compete with
+request handling and survive API restarts:
+
+    python worker.py [--processes N]
+
+Each worker process claims one queued job at a time from the job table using
+SELECT ... FOR UPDATE SKIP LOCKED, so any number of processes on any number of nodes can
+share the queue.  A running job heartbeats periodically; a job whose heartbeat is older than
+JOB_ORPHAN_SECONDS (e.g. its worker crashed or the node was restarted) is reclaimed and rerun.
+
+Jobs are admitted to a node only while the sum of their estimated peak memory fits the node
+memory budget (JIGGY_NODE_MEMORY_BYTES, default 80% of physical memory).  The workers of a node
+serialize admission with a postgres advisory lock on the node name.  The oldest job is admitted
+first; while it does not fit the node waits rather than starting younger jobs ahead of it.
+"""
+
+import os
+import socket
+import argparse
+import multiprocessing
+import psutil
+from threading import Thread, Event
+from time import time, sleep
+from sqlmodel import Session, select, update, func, or_, and_
+from sqlalchemy import text
+
+from db import engine
+from models import *
+
+
+JOB_POLL_SECONDS      = 2     # idle wait between queue polls
+JOB_HEARTBEAT_SECONDS = 15    # running job heartbeat interval
+JOB_ORPHAN_SECONDS    = 120   # a running job without a heartbeat for this long is reclaimed
+JOB_MAX_ATTEMPTS      = 3     # jobs are abandoned after this many claims
+
+WORKER_NAME = "%s:%d" % (socket.gethostname(), os.getpid())
+NODE_NAME = os.environ.get('JIGGY_NODE_NAME', socket.gethostname())
+NODE_MEMORY_BYTES = int(os.environ.get('JIGGY_NODE_MEMORY_BYTES', 0.8 * psutil.virtual_memory().total))
+
+def estimate_index_build_bytes(session, job):
+    """
+    estimate the peak memory of an index build: the float32 vectors loaded for the build
+    (also used in place for exhaustive knn testing) and the hnswlib graph size predicted by
+    the optimizer's index size model.  A shard job builds 1/shards of the collection.
+    The parameters of a target_recall index are selected here, so the build uses the parameters
+    its memory was estimated for.
+    """
+    from optimizer import estimate_index_bytes, M
+    index = session.get(Index, job.index_id)
+    collection = session.get(Collection, job.collection_id)
+    if not index or not collection:
+        return 0
+    count = collection.count // index.shards
+    raw_bytes = 4 * collection.dimension * count
+    if index.target_library in (IndexLibraries.flat, IndexLibraries.ivfpq):
+        return 2 * raw_bytes   # the loaded vectors and their encoded copy; ivfpq codes are small in comparison
+    if index.target_recall and index.hnswlib_M is None:
+        import build
+        # the shards of an index share its parameters, selected by whichever of their jobs is estimated first
+        session.refresh(index, with_for_update=True)
+        if index.hnswlib_M is None:
+            try:
+                opt = build._optimize_index(index, collection, count)
+                index.completed_at = time() + opt['creation_seconds']
+                session.add(index)
+            except Exception as e:
+                # leave the selection to the build, and assume the largest graph it could select
+                print("index %d parameter selection failed: %s" % (index.id, e))
+    index_bytes = estimate_index_bytes(collection.dimension,
+                                       count,
+                                       index.hnswlib_M or max(M),
+                                       index.hnswlib_ef or 200)
+    return raw_bytes + index_bytes
+
+
+JOB_MEMORY_ESTIMATORS = {JobKind.index_build: estimate_index_build_bytes}
+
+
+def update_queue_positions(session):
+    """
+    record each queued index build's position in the queue in its build_status.
+    a sharded index is positioned by its first queued shard job.
+    """
+    session.execute(text("""
+        UPDATE "index" SET build_status = 'Queued for build: position ' || q.position || ' of ' || q.total || '.'
+        FROM (SELECT index_id,
+                     row_number() OVER (ORDER BY min(id)) AS position,
+                     count(*) OVER () AS total
+              FROM job WHERE state = 'queued' AND kind = 'index_build'
+              GROUP BY index_id) q
+        WHERE "index".id = q.index_id AND "index".state = 'queued'
+    """))
+
+
+def _fail_job(session, job, reason):
+    job.state = JobState.failed
+    job.completed_at = time()
+    session.add(job)
+    if job.index_id is not None:
+        index = session.get(Index, job.index_id)
+        if index:
+            index.state = IndexBuildState.failed
+            index.completed_at = time()
+            index.build_status = f"Index {index.id} failed to build ({reason}).  Please contact support@jiggy.ai"
+            session.add(index)
+    elif job.kind == JobKind.collection_delete:
+        _collection_delete_failed(session, job.collection_id, reason)
+
+
+def _collection_delete_failed(session, collection_id, reason):
+    session.exec(update(Collection).where(Collection.id == collection_id).values(
+        delete_status=f"Deletion failed ({reason}).  Delete the collection again to retry."))
+
+
+def node_memory_in_use(session):
+    """
+    the estimated memory of the jobs running on this node
+    """
+    statement = select(func.coalesce(func.sum(Job.memory_bytes), 0)).where(Job.state == JobState.running,
+                                                                           Job.node == NODE_NAME,
+                                                                           Job.heartbeat_at >= time() - JOB_ORPHAN_SECONDS)
+    return int(session.exec(statement).one())
+
+
+def claim_job():
+    """
+    claim the oldest queued or orphaned job if it fits in this node's memory budget,
+    returning it (detached) or None if there is no work that can be admitted
+    """
+    with Session(engine) as session:
+        while True:
+            # serialize admission among the workers of this node
+            session.execute(text("SELECT pg_advisory_xact_lock(hashtext(:node))").bindparams(node=NODE_NAME))
+            statement = select(Job).where(or_(Job.state == JobState.queued,
+                                              and_(Job.state == JobState.running,
+                                                   Job.heartbeat_at < time() - JOB_ORPHAN_SECONDS)))
+            statement = statement.order_by(Job.id).limit(1).with_for_update(skip_locked=True)
+            job = session.exec(statement).first()
+            if not job:
+                session.rollback()
+                return None
+            if job.attempts >= JOB_MAX_ATTEMPTS:
+                print("abandon job", job.id, "after", job.attempts, "attempts")
+                _fail_job(session, job, "too many attempts")
+                session.commit()
+                continue
+            if job.memory_bytes is None:
+                estimator = JOB_MEMORY_ESTIMATORS.get(job.kind)
+                job.memory_bytes = estimator(session, job) if estimator else 0
+            in_use = node_memory_in_use(session)
+            # a job larger than the whole budget is admitted only to an otherwise idle node
+            if in_use and in_use + job.memory_bytes > NODE_MEMORY_BYTES:
+                session.commit()   # keep the estimate; the job stays queued until memory frees up
+                return None
+            now = time()
+            job.state = JobState.running
+            job.worker = WORKER_NAME
+            job.node = NODE_NAME
+            job.attempts += 1
+            job.started_at = now
+            job.heartbeat_at = now
+            session.add(job)
+            update_queue_positions(session)
+            session.commit()
+            session.refresh(job)
+            print("admitted job %d (%.1f GB) with %.1f of %.1f GB in use" % (job.id,
+                                                                           job.memory_bytes/1e9,
+                                                                           in_use/1e9,
+                                                                           NODE_MEMORY_BYTES/1e9))
+            return job
+
+
+def _heartbeat(job_id, done):
+    while not done.wait(JOB_HEARTBEAT_SECONDS):
+        try:
+            with Session(engine) as session:
+                session.exec(update(Job).where(Job.id == job_id, Job.worker == WORKER_NAME).values(heartbeat_at=time()))
+                session.commit()
+        except Exception as e:
+            print("heartbeat failed:", e)
+
+
+def run_index_build(job):
+    import build
+    with Session(engine) as session:
+        index = session.get(Index, job.index_id)
+        shard = None
+        if job.shard is not None:
+            shard = session.exec(select(IndexShard).where(IndexShard.index_id == job.index_id,
+                                                          IndexShard.shard == job.shard)).first()
+    if not index or (job.shard is not None and not shard):
+        print("index", job.index_id, "shard", job.shard, "no longer exists")
+        return False
+    return build.create_index(index, shard)
+
+
+def run_collection_delete(job):
+    import deletion
+    try:
+        return deletion.delete_collection(job.collection_id)
+    except Exception as e:
+        with Session(engine) as session:
+            _collection_delete_failed(session, job.collection_id, e)
+            session.commit()
+        raise
+
+
+JOB_RUNNERS = {JobKind.index_build:       run_index_build,
+               JobKind.collection_delete: run_collection_delete}
+
+
+def run_job(job):
+    """
+    run the claimed job, heartbeating until it finishes, and record the outcome
+    """
+    print("run job", job.id, job.kind, "attempt", job.attempts)
+    done = Event()
+    Thread(target=_heartbeat, args=(job.id, done), daemon=True).start()
+    try:
+        success = JOB_RUNNERS[job.kind](job)
+    except Exception as e:
+        print("job", job.id, "exception:", e)
+        success = False
+    finally:
+        done.set()
+    with Session(engine) as session:
+        state = JobState.complete if success else JobState.failed
+        session.exec(update(Job).where(Job.id == job.id, Job.worker == WORKER_NAME).values(state=state, completed_at=time()))
+        session.commit()
+    print("job", job.id, state)
+
+
+def worker_loop():
+    global WORKER_NAME
+    WORKER_NAME = "%s:%d" % (socket.gethostname(), os.getpid())
+    print("worker", WORKER_NAME, "started")
+    while True:
+        try:
+            job = claim_job()
+        except Exception as e:
+            print("claim failed:", e)
+            job = None
+        if job:
+            run_job(job)
+        else:
+            sleep(JOB_POLL_SECONDS)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Jiggy background job worker")
+    parser.add_argument('--processes', type=int, default=int(os.environ.get('JIGGY_WORKER_PROCESSES', 1)),
+                        help='number of worker processes to run on this node')
+    args = parser.parse_args()
+    if 'JIGGY_BUILD_THREADS' not in os.environ:
+        # share the cores between the concurrent builds on this node
+        os.environ['JIGGY_BUILD_THREADS'] = str(max(1, multiprocessing.cpu_count() // args.processes))
+    # spawn rather than fork so that each process creates its own database and s3 connections
+    ctx = multiprocessing.get_context('spawn')
+    processes = {}
+    while True:
+        for slot in range(args.processes):
+            p = processes.get(slot)
+            if p is None or not p.is_alive():
+                if p is not None:
+                    print("worker process", p.pid, "exited with", p.exitcode, "; restarting")
+                p = ctx.Process(target=worker_loop, daemon=True)
+                p.start()
+                processes[slot] = p
+        sleep(JOB_POLL_SECONDS)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+# Jiggy compressed index artifacts
+# Copyright (C) 2022 William S. Kish
+
+"""
+Indexes built with a compression_level are also stored zstd compressed, at the index objkey + COMPRESSED_SUFFIX,
+for smaller downloads.
+
+The file is compressed as independent zstd frames of FRAME_BYTES uncompressed bytes each, followed by a seek table
+in the zstd seekable format:
+
+    https://github.com/facebook/zstd/blob/dev/contrib/seekable_format/zstd_seekable_compression_format.md
+
+so the artifact decompresses with any zstd decoder (zstd -d), or frame by frame in parallel using the seek table
+(see decompress_file).  Frames are compressed in parallel as well.
+
+zstandard is an optional dependency; compressed artifacts can only be built and read where it is installed.
+"""
+
+import os
+import struct
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+COMPRESSED_SUFFIX = '.zst'        # object key suffix of the compressed artifact of an index
+FRAME_BYTES = 4*1024*1024         # uncompressed bytes per independent frame
+SKIPPABLE_MAGIC = 0x184D2A5E      # zstd skippable frame holding the seek table
+SEEKABLE_MAGIC = 0x8F92EAB1       # seek table footer magic
+FOOTER = struct.Struct('<IBI')    # number of frames, seek table descriptor, seekable magic
+ENTRY = struct.Struct('<II')      # compressed size, decompressed size of each frame
+
+
+def _require_zstandard():
+    if zstandard is None:
+        raise RuntimeError("Compressed indexes require zstandard (pip install zstandard).")
+
+
+def _seek_table(entries):
+    """
+    the seek table skippable frame for the (compressed size, decompressed size) of each frame
+    """
+    table = b''.join(ENTRY.pack(c, d) for c, d in entries) + FOOTER.pack(len(entries), 0, SEEKABLE_MAGIC)
+    return struct.pack('<II', SKIPPABLE_MAGIC, len(table)) + table
+
+
+class CompressedReader:
+    """
+    a readable, non-seekable stream of the compressed artifact of a file (e.g. for Bucket.upload_fileobj).
+    frames are compressed by a pool of threads, at most 2*threads frames ahead of the reader.
+    """
+    def __init__(self, filename, level, threads=1):
+        _require_zstandard()
+        self.fd = os.open(filename, os.O_RDONLY)
+        self.level = level
+        self.offsets = iter(range(0, os.fstat(self.fd).st_size, FRAME_BYTES))
+        self.pool = ThreadPoolExecutor(threads)
+        self.window = 2 * threads
+        self.pending = deque()
+        self.entries = []
+        self.buf = bytearray()
+        self.done = False
+        self.nbytes = 0
+        self._submit()
+
+    def _compress(self, offset):
+        data = os.pread(self.fd, FRAME_BYTES, offset)
+        return zstandard.ZstdCompressor(level=self.level).compress(data), len(data)
+
+    def _submit(self):
+        while len(self.pending) < self.window:
+            offset = next(self.offsets, None)
+            if offset is None:
+                break
+            self.pending.append(self.pool.submit(self._compress, offset))
+
+    def _next(self):
+        if self.pending:
+            frame, n = self.pending.popleft().result()
+            self.entries.append((len(frame), n))
+            self.buf += frame
+            self._submit()
+        else:
+            self.buf += _seek_table(self.entries)
+            self.done = True
+
+    def seekable(self):
+        return False
+
+    def read(self, size=-1):
+        while not self.done and (size < 0 or len(self.buf) < size):
+            self._next()
+        if size < 0 or size >= len(self.buf):
+            data, self.buf = bytes(self.buf), bytearray()
+        else:
+            data = bytes(self.buf[:size])
+            del self.buf[:size]
+        self.nbytes += len(data)
+        return data
+
+    def close(self):
+        self.pool.shutdown(wait=True)
+        os.close(self.fd)
+
+
+def read_seek_table(fd):
+    """
+    return the (compressed offset, compressed size, decompressed offset, decompressed size) of each frame
+    of the compressed artifact open as fd
+    """
+    size = os.fstat(fd).st_size
+    frames, descriptor, magic = FOOTER.unpack(os.pread(fd, FOOTER.size, size - FOOTER.size))
+    if magic != SEEKABLE_MAGIC:
+        raise ValueError("not a zstd seekable format file")
+    entry_size = ENTRY.size + (4 if descriptor & 0x80 else 0)   # entries may carry a checksum
+    table = os.pread(fd, frames * entry_size, size - FOOTER.size - frames * entry_size)
+    result = []
+    c_offset = d_offset = 0
+    for i in range(frames):
+        c, d = ENTRY.unpack_from(table, i * entry_size)
+        result.append((c_offset, c, d_offset, d))
+        c_offset += c
+        d_offset += d
+    return result
+
+
+def decompress_file(src, dst, threads=1):
+    """
+    decompress the compressed artifact src to the file dst, decompressing frames in parallel
+    """
+    _require_zstandard()
+    sfd = os.open(src, os.O_RDONLY)
+    dfd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        frames = read_seek_table(sfd)
+        os.ftruncate(dfd, sum(d for _, _, _, d in frames))
+
+        def decompress(frame):
+            c_offset, c, d_offset, d = frame
+            data = zstandard.ZstdDecompressor().decompress(os.pread(sfd, c, c_offset), max_output_size=d)
+            if len(data) != d:
+                raise ValueError("zstd frame at %d decompressed to %d bytes, expected %d" % (c_offset, len(data), d))
+            os.pwrite(dfd, data, d_offset)
+
+        with ThreadPoolExecutor(threads) as pool:
+            for _ in pool.map(decompress, frames):
+                pass
+    finally:
+        os.close(sfd)
+        os.close(dfd)
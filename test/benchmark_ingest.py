@@ -0,0 +1,87 @@
+# compare the per-worker CPU cost of ingesting a vector batch from JSON vs the binary ingest formats
+# run from the app directory (or with app on PYTHONPATH) so models and vector_codec can be imported
+#
+#   python benchmark_ingest.py                        # decode only: request body to vector_ids and vectors
+#   python benchmark_ingest.py --collection-id ID     # also end to end: decode and _upsert_vectors into the database
+#
+# The end to end timing needs the JIGGY_POSTGRES_* environment of the API and an existing collection owned
+# by the benchmark user (empty, or of the benchmarked dimension).  Each round is rolled back, so the collection
+# is left unchanged.
+
+import json
+import argparse
+import numpy as np
+from time import perf_counter
+
+from models import VectorBatchPostRequest, Collection
+import vector_codec
+
+
+BATCH = 1000
+ROUNDS = 5
+
+
+def json_decode(body):
+    req = VectorBatchPostRequest(**json.loads(body))
+    return [item.vector_id for item in req.items], [item.vector for item in req.items]
+
+
+def bench(name, fn, body):
+    fn(body)   # warm up
+    t0 = perf_counter()
+    for i in range(ROUNDS):
+        fn(body)
+    dt = (perf_counter() - t0) / ROUNDS
+    print("%-40s %8.1f ms/batch   %10.0f vectors/s   %7.1f MB body" % (name, 1000*dt, BATCH/dt, len(body)/1e6))
+    return dt
+
+
+def end_to_end(collection_id, decode):
+    """
+    return a function that decodes a body and upserts it into the collection as the batch endpoints do,
+    in a transaction that is rolled back
+    """
+    from sqlmodel import Session
+    from db import engine
+    import vector
+
+    def ingest(body):
+        with Session(engine) as session:
+            collection = session.get(Collection, collection_id, with_for_update=True)
+            vector_ids, vectors = decode(body)
+            vector._set_collection_dimension(collection, len(vectors[0]))
+            vector._upsert_vectors(session, collection, vector_ids, vectors)
+            session.flush()
+            session.rollback()
+    return ingest
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark vector batch ingest from JSON and binary bodies")
+    parser.add_argument('--collection-id', type=int, default=None,
+                        help='also time decode and database upsert end to end into this collection (rolled back)')
+    parser.add_argument('--dimensions', type=int, nargs='+', default=[128, 768, 1536, 4096])
+    args = parser.parse_args()
+
+    for dim in args.dimensions:
+        vector_ids = np.arange(BATCH)
+        vectors = np.random.random((BATCH, dim)).astype(np.float32)
+
+        json_body = json.dumps({'items': [{'vector_id': int(i), 'vector': v.tolist()} for i, v in zip(vector_ids, vectors)]})
+        npy_body = vector_codec.encode_npy(vector_ids, vectors)
+        raw_body = vector_codec.encode_raw(vector_ids, vectors)
+        decoders = [("json + pydantic", json_decode, json_body),
+                    ("application/x-npy", vector_codec.decode_npy, npy_body),
+                    ("application/octet-stream", lambda b: vector_codec.decode_raw(b, dim), raw_body)]
+
+        print("\ndimension %d, batch of %d vectors" % (dim, BATCH))
+        t_json, t_npy, t_raw = [bench(name + " decode", fn, body) for name, fn, body in decoders]
+        print("binary decode speedup: npy %.0fx  raw %.0fx" % (t_json/t_npy, t_json/t_raw))
+        if args.collection_id is not None:
+            t_json, t_npy, t_raw = [bench(name + " end to end", end_to_end(args.collection_id, fn), body)
+                                    for name, fn, body in decoders]
+            print("binary end to end speedup: npy %.1fx  raw %.1fx" % (t_json/t_npy, t_json/t_raw))
+
+
+if __name__ == "__main__":
+    main()
@@ -68,7 +68,10 @@ def hnsf_recall_perf(data,                     #  list of elements vectors for i
                      test_k=10,                #  test k size
                      distance_metric='cosine', #  cosine, l2, ip
                      num_threads=10):
-
+    """
+    build an index of the data and measure it at each test ef.
+    returns a list of result dicts (one per test ef) in the results.json schema.
+    """
     index_elements = len(data)
     vector_dimension = len(data[0])
     
@@ -107,11 +110,12 @@ def hnsf_recall_perf(data,                     #  list of elements vectors for i
     HNSW_INDEX_CREATE_TIME = time()-t0
     print("HNSF index built in %.1f seconds (%d ips)" % (HNSW_INDEX_CREATE_TIME, index_elements/HNSW_INDEX_CREATE_TIME))
 
-    fn = "random_%d_%s_%d_%d_%d.hnsf" % (vector_dimension,
-                                         distance_metric,
-                                         index_elements,
-                                         index_M,
-                                         index_ef_construction)
+    fn = "random_%d_%s_%d_%d_%d_%d.hnsf" % (vector_dimension,
+                                            distance_metric,
+                                            index_elements,
+                                            index_M,
+                                            index_ef_construction,
+                                            os.getpid())
     t0 = time()
     hnsw_index.save_index(fn)
     HNSW_INDEX_SAVE_TIME = time()-t0
@@ -130,6 +134,7 @@ def hnsf_recall_perf(data,                     #  list of elements vectors for i
     labels_bf, distances_bf = bf_index.knn_query(query_data, test_k)
     print()
     
+    rows = []
     for test_ef in test_ef_list:
         hnsw_index.set_ef(test_ef)        
         # Measure HNSW recall at specified EF
@@ -147,7 +152,7 @@ def hnsf_recall_perf(data,                     #  list of elements vectors for i
             total   += len(set(labels_hnsw[i]))
         recall = float(correct) / total
 
-        LATENCY_TESTS = 100
+        LATENCY_TESTS = min(100, len(query_data))
         t0 = time()        
         for i in range(LATENCY_TESTS):
             hnsw_index.knn_query([query_data[i]], test_k)
@@ -156,4 +161,16 @@ def hnsf_recall_perf(data,                     #  list of elements vectors for i
         print("HNSW Search latency %4.1f ms @ EF=%4d:  RECALL: %.1f" % (1000*SINGLE_QUERY_LATENCY,
                                                                          test_ef,
                                                                          100*recall))
+        rows.append({'vector_dimension':             vector_dimension,
+                     'index_elements':               index_elements,
+                     'index_M':                      index_M,
+                     'index_ef_construction':        index_ef_construction,
+                     'index_create_seconds':         HNSW_INDEX_CREATE_TIME,
+                     'index_bytes':                  index_size_bytes,
+                     'test_ef':                      test_ef,
+                     'recall':                       recall,
+                     'single_query_latency_seconds': SINGLE_QUERY_LATENCY,
+                     'distance_metric':              distance_metric,
+                     'num_threads':                  num_threads})
+    return rows
     
@@ -0,0 +1,144 @@
+# hnswlib parameter sweep: regenerate optimizer training data (results.json rows) on this hardware
+#
+#   python hnsw_sweep.py --dimensions 96,384,768 --elements 10000,100000 --processes 4 --output results.json
+#   python hnsw_sweep.py --dataset embeddings.npy --elements 100000,1000000 --metrics cosine
+#
+# Each config (dataset, dimension, elements, M, ef_construction, metric) is built once and measured at every
+# --ef value by hnsf_recall_perf.  Configs run in parallel worker processes, each pinned to its own set of
+# cores.  Rows are appended to --output as configs complete; configs already present in --output are skipped,
+# so an interrupted sweep resumes where it left off.
+
+import os
+import json
+import argparse
+import itertools
+import multiprocessing
+import subprocess
+import numpy as np
+import psutil
+
+from hnsw_recall import hnsf_recall_perf
+
+
+QUERIES = 1000
+
+
+def cpu_info():
+    try:
+        o = subprocess.check_output(['cat', '/proc/cpuinfo']).decode()
+        return [x for x in o.split("\n") if "model name" in x][0].split(":")[-1].strip()
+    except Exception:
+        return str(subprocess.check_output(["sysctl", "-n", "machdep.cpu.brand_string"]).decode().strip())
+
+
+def config_key(row):
+    return (row.get('dataset', 'random'),
+            row['vector_dimension'],
+            row['index_elements'],
+            row['index_M'],
+            row['index_ef_construction'],
+            row['distance_metric'])
+
+
+def load_data(dataset, dimension, elements, seed):
+    """
+    return (data, queries) for the config: uniform random vectors, or rows of a user supplied .npy dataset
+    with the queries held out of the indexed rows where the dataset is large enough
+    """
+    rng = np.random.default_rng(seed)
+    if dataset == 'random':
+        return (rng.random((elements, dimension), dtype=np.float32),
+                rng.random((QUERIES, dimension), dtype=np.float32))
+    vectors = np.load(dataset, mmap_mode='r')
+    rows = rng.permutation(len(vectors))
+    data = np.asarray(vectors[np.sort(rows[:elements])], dtype=np.float32)
+    held_out = rows[elements:elements+QUERIES]
+    if len(held_out) < QUERIES:
+        held_out = rows[:QUERIES]
+    return data, np.asarray(vectors[np.sort(held_out)], dtype=np.float32)
+
+
+_cores = None
+
+
+def init_worker(core_sets):
+    """
+    pin this worker process to the next free set of cores
+    """
+    global _cores
+    _cores = core_sets.get()
+    os.sched_setaffinity(0, _cores)
+
+
+def run_config(config):
+    dataset, dimension, elements, M, ef_construction, metric, ef_list = config
+    data, queries = load_data(dataset, dimension, elements, seed=hash((dimension, elements)) & 0xffffffff)
+    if len(data) < elements:
+        return []
+    rows = hnsf_recall_perf(data,
+                            queries,
+                            M,
+                            ef_construction,
+                            [ef for ef in ef_list if ef <= elements],
+                            distance_metric=metric,
+                            num_threads=len(_cores))
+    for row in rows:
+        row['dataset'] = dataset
+    return rows
+
+
+def write_results(filename, results):
+    tmp = filename + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(results, f)
+    os.replace(tmp, filename)
+
+
+def main():
+    ints = lambda s: [int(x) for x in s.split(',')]
+    parser = argparse.ArgumentParser(description="Sweep hnswlib parameters to generate optimizer training data")
+    parser.add_argument('--dataset', action='append', default=[], help='.npy float (n, dimension) dataset; default random vectors')
+    parser.add_argument('--dimensions', type=ints, default=[96, 256, 384, 768, 1536], help='dimensions of random datasets')
+    parser.add_argument('--elements', type=ints, default=[10000, 100000, 1000000])
+    parser.add_argument('--M', type=ints, default=[16, 32, 48, 64, 96, 128])
+    parser.add_argument('--ef-construction', type=ints, default=[100, 200, 500, 1000])
+    parser.add_argument('--ef', type=ints, default=[50, 100, 200, 500, 1000, 2000])
+    parser.add_argument('--metrics', type=lambda s: s.split(','), default=['cosine'])
+    parser.add_argument('--processes', type=int, default=1, help='configs to run in parallel, each on its own cores')
+    parser.add_argument('--output', default='results.json', help='results.json to append rows to')
+    args = parser.parse_args()
+
+    results = json.load(open(args.output)) if os.path.exists(args.output) else []
+    done = {config_key(row) for row in results}
+
+    if args.dataset:
+        sources = [(dataset, np.load(dataset, mmap_mode='r').shape[1]) for dataset in args.dataset]
+    else:
+        sources = [('random', dimension) for dimension in args.dimensions]
+    configs = [(dataset, dimension, elements, M, ef_construction, metric, args.ef)
+               for (dataset, dimension), elements, M, ef_construction, metric
+               in itertools.product(sources, args.elements, args.M, args.ef_construction, args.metrics)]
+    todo = [c for c in configs if c[:6] not in done]
+    print("%d configs, %d already in %s, %d to run" % (len(configs), len(configs)-len(todo), args.output, len(todo)))
+
+    # split the cores into one disjoint set per worker process
+    cores = sorted(os.sched_getaffinity(0))
+    per_process = max(1, len(cores) // args.processes)
+    core_sets = multiprocessing.Manager().Queue()
+    for i in range(args.processes):
+        core_sets.put(set(cores[i*per_process:(i+1)*per_process]) or set(cores))
+
+    cpu = cpu_info()
+    freq = psutil.cpu_freq()
+    with multiprocessing.Pool(args.processes, initializer=init_worker, initargs=(core_sets,)) as pool:
+        for rows in pool.imap_unordered(run_config, todo):
+            for row in rows:
+                row['cpu_info'] = cpu
+                row['max_cpu_freq'] = freq.max if freq else None
+            results.extend(rows)
+            write_results(args.output, results)
+            print("%d rows in %s" % (len(results), args.output))
+
+
+if __name__ == "__main__":
+    main()
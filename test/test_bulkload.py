@@ -0,0 +1,93 @@
+# test the binary COPY streams of the bulk loader against an independent parser of the PGCOPY format
+#
+#   PYTHONPATH=../app python test_bulkload.py
+
+import struct
+import numpy as np
+
+import bulkload
+
+
+def parse_copy(buf):
+    """
+    parse a binary COPY stream into a list of rows of raw field bytes, following the postgres COPY BINARY spec
+    """
+    assert buf[:11] == b'PGCOPY\n\xff\r\n\x00'
+    flags, extension = struct.unpack_from('>ii', buf, 11)
+    assert flags == 0
+    offset = 19 + extension
+    rows = []
+    while True:
+        nfields, = struct.unpack_from('>h', buf, offset)
+        offset += 2
+        if nfields == -1:
+            break
+        fields = []
+        for i in range(nfields):
+            length, = struct.unpack_from('>i', buf, offset)
+            offset += 4
+            fields.append(buf[offset:offset+length])
+            offset += length
+        rows.append(fields)
+    assert offset == len(buf), "trailing bytes after the COPY trailer"
+    return rows
+
+
+def parse_float4_array(field):
+    ndim, hasnull, elemtype, dim, lbound = struct.unpack_from('>iiiii', field, 0)
+    assert (ndim, hasnull, elemtype, lbound) == (1, 0, bulkload.FLOAT4_OID, 1)
+    offset = 20
+    values = []
+    for i in range(dim):
+        length, value = struct.unpack_from('>if', field, offset)
+        assert length == 4
+        values.append(value)
+        offset += 8
+    assert offset == len(field)
+    return values
+
+
+def random_batch(count, dimension):
+    vector_ids = np.random.randint(-2**62, 2**62, size=count, dtype=np.int64)
+    vectors = np.random.standard_normal((count, dimension)).astype(np.float32)
+    return vector_ids, vectors
+
+
+def test_copy_stream():
+    vector_ids, vectors = random_batch(100, 7)
+    rows = parse_copy(bulkload.copy_stream(vector_ids, vectors).getvalue())
+    assert len(rows) == len(vector_ids)
+    for (id_field, vector_field), vector_id, vector in zip(rows, vector_ids, vectors):
+        assert struct.unpack('>q', id_field)[0] == vector_id
+        assert parse_float4_array(vector_field) == vector.tolist()
+
+
+def test_copy_stream_bytea():
+    vector_ids, vectors = random_batch(100, 7)
+    for storage, dtype in [('float32', '<f4'), ('float16', '<f2')]:
+        rows = parse_copy(bulkload.copy_stream_bytea(vector_ids, vectors, storage).getvalue())
+        assert len(rows) == len(vector_ids)
+        for (id_field, data_field), vector_id, vector in zip(rows, vector_ids, vectors):
+            assert struct.unpack('>q', id_field)[0] == vector_id
+            assert np.array_equal(np.frombuffer(data_field, dtype=dtype), vector.astype(dtype))
+
+
+def test_empty_stream():
+    rows = parse_copy(bulkload.copy_stream(np.zeros(0, dtype=np.int64), np.zeros((0, 3), dtype=np.float32)).getvalue())
+    assert rows == []
+
+
+def test_dedup_last():
+    vector_ids = np.array([5, 3, 5, 1, 3], dtype=np.int64)
+    vectors = np.arange(5, dtype=np.float32)[:, None]
+    ids, vecs = bulkload.dedup_last(vector_ids, vectors)
+    assert ids.tolist() == [5, 1, 3]
+    assert vecs[:, 0].tolist() == [2, 3, 4]
+
+
+if __name__ == "__main__":
+    test_copy_stream()
+    test_copy_stream_bytea()
+    test_empty_stream()
+    test_dedup_last()
+    print("ok")
@@ -0,0 +1,72 @@
+# test that pruning the vector change log keeps the changes a queued incremental index build needs
+# requires the JIGGY_POSTGRES_* environment of the API; the rows it creates are removed when it completes
+#
+#   PYTHONPATH=../app python test_changelog.py
+
+from time import time
+from sqlmodel import Session, delete
+
+from db import engine
+from models import *
+from changelog import CHANGE_LOG_MARGIN, prune_vector_changes, vector_changes
+
+
+def make_index(collection, created_at, state, base_created_at=None):
+    return Index(tag = 'test',
+                 name = 'test/%s:test' % collection.name,
+                 collection_id = collection.id,
+                 target_library = IndexLibraries.hnswlib,
+                 metric = DistanceMetric.cosine,
+                 created_at = created_at,
+                 base_created_at = base_created_at,
+                 incremental = base_created_at is not None,
+                 state = state,
+                 completed_at = created_at,
+                 build_status = 'test',
+                 objkey = 'test-changelog/%d' % collection.id)
+
+
+def test_incremental_build_keeps_its_changes():
+    now = time()
+    base_created_at = now - 3600
+    with Session(engine) as session:
+        collection = Collection(name='test-changelog-%d' % int(now))
+        session.add(collection)
+        session.commit()
+        session.refresh(collection)
+        try:
+            # changes since the base index was requested, all older than the margin but the last
+            session.add(VectorChange(collection_id=collection.id, vector_id=1, op=VectorChangeOp.insert, created_at=now - 3000))
+            session.add(VectorChange(collection_id=collection.id, vector_id=2, op=VectorChangeOp.delete, created_at=now - 2000))
+            session.add(VectorChange(collection_id=collection.id, vector_id=3, op=VectorChangeOp.insert, created_at=now - 10))
+            # a change the base index already includes
+            session.add(VectorChange(collection_id=collection.id, vector_id=4, op=VectorChangeOp.insert, created_at=base_created_at - 2*CHANGE_LOG_MARGIN))
+            # post_index replaces the base index with a queued incremental index requested now
+            index = make_index(collection, now, IndexBuildState.queued, base_created_at)
+            session.add(index)
+            session.flush()
+            prune_vector_changes(session, collection.id)
+            session.commit()
+
+            inserted, deleted = vector_changes(session, collection.id, base_created_at - CHANGE_LOG_MARGIN)
+            assert sorted(inserted) == [1, 3], inserted
+            assert deleted == [2], deleted
+
+            # once built, the index only needs the changes since it was requested for the next incremental build
+            index.state = IndexBuildState.complete
+            session.add(index)
+            prune_vector_changes(session, collection.id)
+            session.commit()
+            inserted, deleted = vector_changes(session, collection.id, 0)
+            assert inserted == [3] and deleted == [], (inserted, deleted)
+        finally:
+            session.rollback()
+            session.exec(delete(VectorChange).where(VectorChange.collection_id == collection.id))
+            session.exec(delete(Index).where(Index.collection_id == collection.id))
+            session.exec(delete(Collection).where(Collection.id == collection.id))
+            session.commit()
+
+
+if __name__ == "__main__":
+    test_incremental_build_keeps_its_changes()
+    print("ok")
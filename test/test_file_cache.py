@@ -0,0 +1,87 @@
+# test the node-local index file cache eviction with a budget smaller than two entries
+#
+#   PYTHONPATH=../app python test_file_cache.py
+
+import os
+import shutil
+import hashlib
+import tempfile
+
+from file_cache import FileCache
+
+
+ENTRY_BYTES = 1000
+
+
+class LocalBucket:
+    """
+    a bucket of objects in a local directory, with the download_file interface of s3_bucket.Bucket
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.downloads = 0
+
+    def put(self, key, data):
+        with open(os.path.join(self.directory, key), 'wb') as f:
+            f.write(data)
+        return hashlib.md5(data).hexdigest()
+
+    def download_file(self, key, local_filepath):
+        self.downloads += 1
+        shutil.copyfile(os.path.join(self.directory, key), local_filepath)
+
+
+def make_cache(tmpdir, max_bytes):
+    os.makedirs(os.path.join(tmpdir, 'bucket'))
+    bucket = LocalBucket(os.path.join(tmpdir, 'bucket'))
+    return bucket, FileCache(os.path.join(tmpdir, 'cache'), max_bytes)
+
+
+def test_entries_in_use_are_not_evicted():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        bucket, cache = make_cache(tmpdir, int(1.5 * ENTRY_BYTES))
+        md5s = {key: bucket.put(key, os.urandom(ENTRY_BYTES)) for key in ['a', 'b', 'c']}
+        # like an ivfpq shard: the second file is fetched while the first is still being loaded
+        with cache.open(bucket, 'a', md5s['a']) as a:
+            with cache.open(bucket, 'b', md5s['b']) as b:
+                assert os.path.exists(a) and os.path.exists(b)
+                assert open(a, 'rb').read() != open(b, 'rb').read()
+        # once released, the least recently used entries are evicted to make room
+        with cache.open(bucket, 'c', md5s['c']) as c:
+            assert os.path.exists(c)
+        assert not os.path.exists(a) and not os.path.exists(b)
+        # a cached entry is not downloaded again
+        with cache.open(bucket, 'c', md5s['c']) as c:
+            assert os.path.exists(c)
+        assert bucket.downloads == 3
+
+
+def test_entry_larger_than_budget():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        bucket, cache = make_cache(tmpdir, ENTRY_BYTES // 2)
+        md5 = bucket.put('big', os.urandom(ENTRY_BYTES))
+        with cache.open(bucket, 'big', md5) as path:
+            assert os.path.getsize(path) == ENTRY_BYTES
+            cache.evict()
+            assert os.path.exists(path)
+        cache.evict()
+        assert not os.path.exists(path)
+
+
+def test_md5_mismatch():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        bucket, cache = make_cache(tmpdir, 10 * ENTRY_BYTES)
+        bucket.put('a', os.urandom(ENTRY_BYTES))
+        try:
+            with cache.open(bucket, 'a', '0' * 32):
+                assert False
+        except ValueError:
+            pass
+        assert not [name for name in os.listdir(cache.directory) if name != 'locks']
+
+
+if __name__ == "__main__":
+    test_entries_in_use_are_not_evicted()
+    test_entry_larger_than_budget()
+    test_md5_mismatch()
+    print("ok")
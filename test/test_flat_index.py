@@ -0,0 +1,84 @@
+# test the blocked exact knn against brute force, and the recall measurement of index tests
+#
+#   PYTHONPATH=../app python test_flat_index.py
+
+import numpy as np
+
+import flat_index
+from flat_index import exact_knn, recall, hold_out
+
+
+flat_index.FLAT_BLOCK = 7    # many blocks, so the running top k is merged across them
+
+
+def brute_force_distances(vectors, queries, space):
+    vectors = vectors.astype(np.float64)
+    queries = queries.astype(np.float64)
+    if space == 'l2':
+        return ((queries[:, None, :] - vectors[None, :, :])**2).sum(axis=2)
+    if space == 'cosine':
+        vectors = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+        queries = queries / np.linalg.norm(queries, axis=1, keepdims=True)
+    return 1 - queries @ vectors.T
+
+
+def test_exact_knn():
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((100, 16)).astype(np.float32)
+    queries = rng.standard_normal((20, 16)).astype(np.float32)
+    for space in ['l2', 'ip', 'cosine']:
+        truth = brute_force_distances(vectors, queries, space)
+        for k in [1, 5, 7, 8, 100, 150]:
+            indices, distances = exact_knn(vectors, queries, k, space)
+            expected_k = min(k, len(vectors))
+            assert indices.shape == distances.shape == (len(queries), expected_k)
+            # the distances of the returned vectors are the k smallest, nearest first
+            returned = np.take_along_axis(truth, indices, axis=1)
+            assert np.allclose(returned, np.sort(truth, axis=1)[:, :expected_k], atol=1e-4), (space, k)
+            assert np.allclose(distances, returned, atol=1e-4), (space, k)
+            assert all(len(set(row)) == expected_k for row in indices.tolist())
+
+
+def test_recall():
+    truth = np.array([[1, 2, 3], [4, 5, 6]])
+    assert recall(truth, truth) == 1
+    assert recall(np.array([[3, 2, 9], [7, 8, 9]]), truth) == 2 / 6
+    # order does not matter, only membership in the true neighbors
+    assert recall(truth[:, ::-1], truth) == 1
+
+
+def test_hold_out():
+    # each query is its own nearest neighbor when sampled from the index
+    labels = np.array([[10, 1, 2, 3],
+                       [1, 20, 2, 3],
+                       [1, 2, 3, 4]])
+    self_labels = np.array([10, 20, 30])
+    held = hold_out(labels, self_labels, 3)
+    # the query's own label is removed wherever it is, or the last result if it was not found
+    assert held.tolist() == [[1, 2, 3],
+                             [1, 2, 3],
+                             [1, 2, 3]]
+
+
+def test_recall_with_self_matches():
+    rng = np.random.default_rng(1)
+    vectors = rng.standard_normal((200, 8)).astype(np.float32)
+    vids = np.arange(1000, 1200)
+    self_rows = rng.choice(len(vectors), 30, replace=False)
+    k = 10
+    truth_idx, _ = exact_knn(vectors, vectors[self_rows], k + 1, 'l2')
+    truth = hold_out(vids[truth_idx], vids[self_rows], k)
+    assert not (truth == vids[self_rows][:, None]).any()
+    # an index returning the exact results, with the self matches, has a recall of 1 once they are held out
+    assert recall(hold_out(vids[truth_idx], vids[self_rows], k), truth) == 1
+    # an index missing the self match keeps its k+1 neighbors, of which the last is dropped
+    without_self = np.concatenate([vids[truth_idx][:, 1:], np.full((len(self_rows), 1), -1)], axis=1)
+    assert recall(hold_out(without_self, vids[self_rows], k), truth) == 1
+
+
+if __name__ == "__main__":
+    test_exact_knn()
+    test_recall()
+    test_hold_out()
+    test_recall_with_self_matches()
+    print("ok")
@@ -0,0 +1,83 @@
+# test the optimizer's Pareto front and parameter selection over predicted grids
+#
+#   PYTHONPATH=../app python test_optimizer.py
+
+import numpy as np
+
+import optimizer
+
+
+def random_predictions(n, rng):
+    return {'recall':           rng.uniform(0.5, 1, n),
+            'latency_seconds':  rng.uniform(1e-4, 1e-2, n),
+            'index_bytes':      rng.integers(1, 100, n).astype(np.float64),   # integers, so ties occur
+            'creation_seconds': rng.integers(1, 100, n).astype(np.float64)}
+
+
+def dominates(p, i, j):
+    """
+    brute force: candidate i has at least the recall and at most the costs of j, and is strictly better in one
+    """
+    no_worse = (p['recall'][i] >= p['recall'][j] and
+                p['latency_seconds'][i] <= p['latency_seconds'][j] and
+                p['index_bytes'][i] <= p['index_bytes'][j] and
+                p['creation_seconds'][i] <= p['creation_seconds'][j])
+    better = (p['recall'][i] > p['recall'][j] or
+              p['latency_seconds'][i] < p['latency_seconds'][j] or
+              p['index_bytes'][i] < p['index_bytes'][j] or
+              p['creation_seconds'][i] < p['creation_seconds'][j])
+    return no_worse and better
+
+
+def test_pareto_front():
+    rng = np.random.default_rng(0)
+    for n in [1, 2, 10, 200]:
+        p = random_predictions(n, rng)
+        candidates = np.flatnonzero(rng.random(n) < 0.7)
+        front = set(optimizer.pareto_front(p, candidates).tolist())
+        expected = {j for j in candidates if not any(dominates(p, i, j) for i in candidates)}
+        assert front == expected, n
+
+
+def test_pareto_front_ties():
+    p = {'recall':           np.array([0.9, 0.9, 0.95, 0.8]),
+         'latency_seconds':  np.array([1.0, 1.0, 2.0, 1.0]),
+         'index_bytes':      np.array([5.0, 5.0, 5.0, 6.0]),
+         'creation_seconds': np.array([3.0, 3.0, 3.0, 3.0])}
+    # identical points do not dominate each other; the last is dominated by both of them
+    assert optimizer.pareto_front(p, np.arange(4)).tolist() == [0, 1, 2]
+
+
+def test_optimize_hnswlib_params():
+    rng = np.random.default_rng(1)
+    p = random_predictions(len(optimizer.GRID), rng)
+    predict_grid = optimizer.predict_grid
+    optimizer.predict_grid = lambda vector_dimension, index_elements, cpu_info=None: p
+    try:
+        def selected(**budgets):
+            result = optimizer.optimize_hnswlib_params(128, 10000, **budgets)
+            i = [tuple(row) for row in optimizer.GRID.tolist()].index((result['index_M'],
+                                                                       result['index_ef_construction'],
+                                                                       result['test_ef']))
+            return i, result
+        # the fastest of the points reaching the recall
+        i, result = selected(min_recall=0.9)
+        feasible = np.flatnonzero(p['recall'] >= 0.9)
+        assert result['recall'] >= 0.9
+        assert p['latency_seconds'][i] == p['latency_seconds'][feasible].min()
+        # budgets are hard limits
+        i, result = selected(min_recall=0.9, max_index_bytes=50, max_build_seconds=50)
+        assert result['recall'] >= 0.9 and result['index_bytes'] <= 50 and result['creation_seconds'] <= 50
+        # recall is traded away when no point within the budgets reaches it
+        i, result = selected(min_recall=1.0, max_index_bytes=10)
+        within = np.flatnonzero(p['index_bytes'] <= 10)
+        assert result['index_bytes'] <= 10 and p['recall'][i] == p['recall'][within].max()
+    finally:
+        optimizer.predict_grid = predict_grid
+
+
+if __name__ == "__main__":
+    test_pareto_front()
+    test_pareto_front_ties()
+    test_optimize_hnswlib_params()
+    print("ok")
@@ -0,0 +1,105 @@
+# test the zstd seekable format compressed index artifacts
+#
+#   PYTHONPATH=../app python test_zstd_codec.py
+
+import io
+import os
+import tempfile
+
+import zstandard
+import zstd_codec
+
+
+zstd_codec.FRAME_BYTES = 1000    # many frames from small files
+
+
+def write_file(filename, size):
+    # half random, half repetitive, so frames compress unevenly
+    data = os.urandom(size // 2) + b'jiggy' * ((size - size // 2) // 5 + 1)
+    data = data[:size]
+    with open(filename, 'wb') as f:
+        f.write(data)
+    return data
+
+
+def compress(filename, threads, read_size=-1):
+    reader = zstd_codec.CompressedReader(filename, 3, threads)
+    try:
+        chunks = []
+        while True:
+            chunk = reader.read(read_size)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            if read_size < 0:
+                break
+    finally:
+        reader.close()
+    data = b''.join(chunks)
+    assert reader.nbytes == len(data)
+    return data
+
+
+def test_round_trip():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        src = os.path.join(tmpdir, 'index')
+        zst = src + zstd_codec.COMPRESSED_SUFFIX
+        dst = os.path.join(tmpdir, 'decompressed')
+        for size in [0, 1, 999, 1000, 1001, 10 * 1000, 12345]:
+            data = write_file(src, size)
+            for threads, read_size in [(1, -1), (4, 7), (3, 4096)]:
+                compressed = compress(src, threads, read_size)
+                with open(zst, 'wb') as f:
+                    f.write(compressed)
+                zstd_codec.decompress_file(zst, dst, threads)
+                assert open(dst, 'rb').read() == data, (size, threads, read_size)
+
+
+def test_seek_table():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        src = os.path.join(tmpdir, 'index')
+        zst = src + zstd_codec.COMPRESSED_SUFFIX
+        data = write_file(src, 3500)
+        with open(zst, 'wb') as f:
+            f.write(compress(src, 2))
+        fd = os.open(zst, os.O_RDONLY)
+        try:
+            frames = zstd_codec.read_seek_table(fd)
+        finally:
+            os.close(fd)
+        assert [d for _, _, _, d in frames] == [1000, 1000, 1000, 500]
+        assert [d_offset for _, _, d_offset, _ in frames] == [0, 1000, 2000, 3000]
+        compressed = open(zst, 'rb').read()
+        for c_offset, c, d_offset, d in frames:
+            frame = compressed[c_offset:c_offset+c]
+            assert zstandard.ZstdDecompressor().decompress(frame) == data[d_offset:d_offset+d]
+
+
+def test_standard_decoder():
+    # the frames and the skippable seek table frame decompress with any zstd decoder
+    with tempfile.TemporaryDirectory() as tmpdir:
+        src = os.path.join(tmpdir, 'index')
+        data = write_file(src, 4321)
+        compressed = compress(src, 2)
+        reader = zstandard.ZstdDecompressor().stream_reader(io.BytesIO(compressed), read_across_frames=True)
+        assert reader.read() == data
+
+
+def test_not_seekable():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        zst = os.path.join(tmpdir, 'index' + zstd_codec.COMPRESSED_SUFFIX)
+        with open(zst, 'wb') as f:
+            f.write(zstandard.ZstdCompressor().compress(b'plain zstd frame without a seek table'))
+        try:
+            zstd_codec.decompress_file(zst, os.path.join(tmpdir, 'decompressed'))
+            assert False
+        except ValueError:
+            pass
+
+
+if __name__ == "__main__":
+    test_round_trip()
+    test_seek_table()
+    test_standard_decoder()
+    test_not_seekable()
+    print("ok")